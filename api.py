@@ -1,9 +1,29 @@
-from flask import request, session, jsonify
-from flask_restx import Api, Resource, fields, Namespace
+import json
+import math
+import time
+import hashlib
+from flask import request, session, jsonify, Response
+from flask_restx import Api, Resource, fields, Namespace, marshal
 from werkzeug.exceptions import Unauthorized, NotFound, BadRequest
 from app import app, db
-from models import Admin, Student, Bus, Station, BusLocation, Notice
+from models import Admin, Student, Bus, Station, BusLocation, Notice, Deletion
 from utils import calculate_eta, get_station_status
+from cache import get_bus, get_student, get_station, get_route
+from serializers import (json_response, json_list, with_field, bus_location_fragment, station_status_fragment,
+                         compact_route_fragment)
+from polling import latest_fixes, next_poll_after, poll_headers
+from locations import latest_fixes_by_bus
+from feed_watchdog import feed_status, fleet_counts, ACTIVE, STALE, OFFLINE, UNKNOWN
+from stats import count, get_stats
+from fragments import route_version
+from arrivals import (get_feed, drain, take_wait_slot, release_wait_slot, HEARTBEAT_SECONDS,
+                      LONG_POLL_MAX_SECONDS, WAIT_SLOT_RETRY_SECONDS)
+from ingest import ingest
+from pagination import CursorError, bus_page, station_page, student_page
+from deletion import DeletionBlocked, start_bus_deletion, deletion_document
+from importer import CSVImportError, import_stations, import_students
+from profiler import FORMATS, ProfileBusy, start_session, find_session, seconds_until_ready, profile_document
+from werkzeug.datastructures import FileStorage
 from datetime import datetime
 
 # Initialize Flask-RESTX
@@ -39,14 +59,17 @@ login_response = api.model('LoginResponse', {
 
 bus_location_model = api.model('BusLocation', {
     'latitude': fields.Float(required=True, description='GPS Latitude'),
-    'longitude': fields.Float(required=True, description='GPS Longitude')
+    'longitude': fields.Float(required=True, description='GPS Longitude'),
+    'timestamp': fields.Raw(description='Device time of the fix: unix seconds or ISO 8601 (optional)'),
+    'seq': fields.Integer(description='Per-bus sequence number; re-sent fixes are stored once (optional, needs timestamp)')
 })
 
 bus_info_model = api.model('BusInfo', {
     'bus_number': fields.String(description='Bus number'),
     'driver_name': fields.String(description='Driver name'),
     'driver_phone': fields.String(description='Driver phone'),
-    'current_location': fields.Raw(description='Current GPS location')
+    'current_location': fields.Raw(description='Current GPS location'),
+    'next_poll_after': fields.Integer(description='Seconds until the next request is worthwhile')
 })
 
 station_model = api.model('Station', {
@@ -135,46 +158,35 @@ class StudentLogin(Resource):
         else:
             return {'success': False, 'message': 'Invalid credentials'}, 401
 
-# Bus GPS update endpoint
+# Bus GPS update endpoints
 @bus_ns.route('/<int:bus_id>/location')
 class BusLocationUpdate(Resource):
     @bus_ns.expect(bus_location_model)
     @bus_ns.response(200, 'Location updated successfully')
     @bus_ns.response(404, 'Bus not found')
     @bus_ns.response(400, 'Invalid coordinates')
+    @bus_ns.response(429, 'Rate limit exceeded; wait Retry-After seconds')
     def post(self, bus_id):
-        """Update bus GPS location"""
-        try:
-            data = request.get_json() or request.form
-            latitude = data.get('latitude')
-            longitude = data.get('longitude')
-            
-            if latitude is None or longitude is None:
-                return {'error': 'Missing latitude or longitude'}, 400
-                
-            latitude = float(latitude)
-            longitude = float(longitude)
-            
-            # Verify bus exists
-            bus = Bus.query.get(bus_id)
-            if not bus:
-                return {'error': 'Bus not found'}, 404
-            
-            # Create new location record
-            location = BusLocation()
-            location.bus_id = bus_id
-            location.latitude = latitude
-            location.longitude = longitude
-            location.timestamp = datetime.utcnow()
-            db.session.add(location)
-            db.session.commit()
-            
-            return {'message': 'Location updated successfully'}, 200
-            
-        except (ValueError, TypeError):
-            return {'error': 'Invalid latitude or longitude'}, 400
-        except Exception as e:
-            return {'error': 'Internal server error'}, 500
+        """Update bus GPS location
+
+        Also accepts a single application/octet-stream record; see gps_codec.py for the format.
+        """
+        return ingest(request, bus_id)
+
+@bus_ns.route('/<int:bus_id>/locations')
+class BusLocationBatch(Resource):
+    @bus_ns.expect([bus_location_model])
+    @bus_ns.response(200, 'Locations stored successfully')
+    @bus_ns.response(404, 'Bus not found')
+    @bus_ns.response(400, 'Invalid coordinates')
+    @bus_ns.response(413, 'Batch too large')
+    @bus_ns.response(429, 'Rate limit exceeded; wait Retry-After seconds')
+    def post(self, bus_id):
+        """Upload a batch of buffered GPS locations
+
+        Accepts a JSON list or application/octet-stream records; see gps_codec.py for the format.
+        """
+        return ingest(request, bus_id, batch=True)
 
 # Student endpoints
 @student_ns.route('/my-bus')
@@ -187,15 +199,17 @@ class MyBus(Resource):
         if 'student_id' not in session:
             return {'error': 'Authentication required'}, 401
             
-        student = Student.query.get(session['student_id'])
+        student = get_student(session['student_id'])
         if not student:
             return {'error': 'Student not found'}, 404
             
-        bus = Bus.query.get(student.bus_id)
+        bus = get_bus(student.bus_id)
         if not bus:
             return {'error': 'Bus not found'}, 404
             
-        latest_location = BusLocation.query.filter_by(bus_id=student.bus_id).order_by(BusLocation.timestamp.desc()).first()
+        fixes = latest_fixes(student.bus_id)
+        latest_location = fixes[0] if fixes else None
+        poll_after = next_poll_after(fixes, get_station(student.station_id))
         
         return {
             'bus_number': bus.bus_number,
@@ -205,41 +219,120 @@ class MyBus(Resource):
                 'latitude': latest_location.latitude if latest_location else None,
                 'longitude': latest_location.longitude if latest_location else None,
                 'timestamp': latest_location.timestamp.isoformat() if latest_location else None
-            }
-        }
+            },
+            'next_poll_after': poll_after
+        }, 200, poll_headers(poll_after)
 
 @student_ns.route('/my-bus/stations')
 class MyBusStations(Resource):
-    @student_ns.marshal_list_with(station_model)
-    @student_ns.response(200, 'Success')
+    @student_ns.response(200, 'Success', [station_model])
     @student_ns.response(401, 'Authentication required')
+    @student_ns.header('Next-Poll-After', 'Seconds until the next request is worthwhile')
     def get(self):
         """Get ordered list of stations for student's bus with status and ETA"""
         if 'student_id' not in session:
             return {'error': 'Authentication required'}, 401
             
-        student = Student.query.get(session['student_id'])
+        student = get_student(session['student_id'])
         if not student:
             return {'error': 'Student not found'}, 404
             
-        stations = Station.query.filter_by(bus_id=student.bus_id).order_by(Station.order).all()
-        
+        # Serialized from cached fragments; see serializers.py
         stations_info = []
-        for station in stations:
+        for station in get_route(student.bus_id):
             status = get_station_status(student.bus_id, station.station_id)
             eta = calculate_eta(student.bus_id, station.station_id)
+            stations_info.append(station_status_fragment(station, status, eta))
+        
+        poll_after = next_poll_after(latest_fixes(student.bus_id), get_station(student.station_id))
+        return json_response(json_list(stations_info), headers=poll_headers(poll_after))
+
+arrival_event_model = api.model('ArrivalEvent', {
+    'id': fields.Integer(description='Event number; send the last one back as Last-Event-ID or since'),
+    'type': fields.String(description='Event type (approaching)'),
+    'bus_id': fields.Integer(description='Bus ID'),
+    'bus_number': fields.String(description='Bus number'),
+    'station_id': fields.Integer(description='Station the bus is approaching'),
+    'station_name': fields.String(description='Station name'),
+    'timestamp': fields.String(description='Time of the fix that triggered the event')
+})
+
+def wait_slots_busy():
+    return ({'error': 'Too many clients waiting for events; retry later'}, 503,
+            {'Retry-After': str(WAIT_SLOT_RETRY_SECONDS)})
+
+@student_ns.route('/events')
+class StudentEventStream(Resource):
+    @student_ns.response(200, 'text/event-stream of ArrivalEvent documents')
+    @student_ns.response(401, 'Authentication required')
+    @student_ns.response(503, 'Every event slot is taken; wait Retry-After seconds')
+    def get(self):
+        """Server-sent "bus approaching" events for the student's pickup station
+
+        The stream ends after EVENT_STREAM_MAX_SECONDS; reconnecting clients send
+        Last-Event-ID and receive recent events they missed.
+        """
+        if 'student_id' not in session:
+            return {'error': 'Authentication required'}, 401
             
-            stations_info.append({
-                'station_id': station.station_id,
-                'station_name': station.station_name,
-                'latitude': station.latitude,
-                'longitude': station.longitude,
-                'order': station.order,
-                'status': status,
-                'eta': eta
-            })
+        student = get_student(session['student_id'])
+        if not student:
+            return {'error': 'Student not found'}, 404
+            
+        if not take_wait_slot():
+            return wait_slots_busy()
+        feed = get_feed()
+        station_id = student.station_id
+        subscriber = feed.subscribe(station_id, request.headers.get('Last-Event-ID', type=int))
+        deadline = time.monotonic() + app.config['EVENT_STREAM_MAX_SECONDS']
         
-        return stations_info
+        def stream():
+            yield 'retry: 5000\n\n'
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                events = drain(subscriber, min(HEARTBEAT_SECONDS, remaining))
+                if not events:
+                    yield ': keepalive\n\n'
+                for event in events:
+                    yield 'id: %d\nevent: %s\ndata: %s\n\n' % (event['id'], event['type'], json.dumps(event))
+        
+        def close():
+            feed.unsubscribe(station_id, subscriber)
+            release_wait_slot()
+        
+        response = Response(stream(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # Runs even if the client leaves before the first chunk is sent
+        response.call_on_close(close)
+        return response
+
+@student_ns.route('/events/poll')
+class StudentEventPoll(Resource):
+    @student_ns.doc(params={'since': 'ID of the last event received', 'timeout': 'Seconds to wait (max 30)'})
+    @student_ns.response(200, 'Success', [arrival_event_model])
+    @student_ns.response(401, 'Authentication required')
+    @student_ns.response(503, 'Every event slot is taken; wait Retry-After seconds')
+    def get(self):
+        """Long-poll for "bus approaching" events at the student's pickup station"""
+        if 'student_id' not in session:
+            return {'error': 'Authentication required'}, 401
+            
+        student = get_student(session['student_id'])
+        if not student:
+            return {'error': 'Student not found'}, 404
+            
+        timeout = min(max(request.args.get('timeout', 25, type=float), 0), LONG_POLL_MAX_SECONDS)
+        if not take_wait_slot():
+            return wait_slots_busy()
+        feed = get_feed()
+        subscriber = feed.subscribe(student.station_id, request.args.get('since', type=int))
+        try:
+            return drain(subscriber, timeout)
+        finally:
+            feed.unsubscribe(student.station_id, subscriber)
+            release_wait_slot()
 
 # Notice endpoints
 @notices_ns.route('/active')
@@ -335,6 +428,7 @@ class AdminNotices(Resource):
         
         db.session.add(notice)
         db.session.commit()
+        count('active_notices')
         
         return {'message': 'Notice created successfully', 'notice_id': notice.notice_id}, 201
 
@@ -349,11 +443,281 @@ class AdminNoticeDetail(Resource):
             return {'error': 'Admin authentication required'}, 401
             
         notice = Notice.query.get_or_404(notice_id)
-        notice.is_active = False
-        db.session.commit()
+        if notice.is_active:
+            notice.is_active = False
+            db.session.commit()
+            count('active_notices', -1)
         
         return {'message': 'Notice deactivated successfully'}
 
+stats_model = api.model('Stats', {
+    'buses': fields.Integer(description='Total buses'),
+    'stations': fields.Integer(description='Total stations'),
+    'students': fields.Integer(description='Total students'),
+    'active_notices': fields.Integer(description='Notices marked active'),
+    'fixes_today': fields.Integer(description='GPS fixes timestamped since midnight UTC'),
+    'active_buses': fields.Integer(description='Buses with a recent GPS fix'),
+    'stale_buses': fields.Integer(description='Buses whose feed is stale or offline'),
+    'unreported_buses': fields.Integer(description='Buses that have never sent a fix'),
+    'reconciled_at': fields.DateTime(description='When the counters were last re-counted from the database')
+})
+
+@admin_ns.route('/stats')
+class AdminStats(Resource):
+    @admin_ns.response(200, 'Success', stats_model)
+    @admin_ns.response(401, 'Authentication required')
+    def get(self):
+        """Dashboard counters (admin only)"""
+        if 'admin_id' not in session:
+            return {'error': 'Admin authentication required'}, 401
+        stats = get_stats()
+        feeds = fleet_counts()
+        stats.update(active_buses=feeds[ACTIVE], stale_buses=feeds[STALE] + feeds[OFFLINE],
+                     unreported_buses=feeds[UNKNOWN], reconciled_at=stats['reconciled_at'].isoformat())
+        return stats
+
+# Paginated admin lists (JSON variants of the admin bus/station/student pages)
+page_parser = api.parser()
+page_parser.add_argument('q', type=str, location='args', help='Search text')
+page_parser.add_argument('after', type=str, location='args', help='Cursor: page following this one')
+page_parser.add_argument('before', type=str, location='args', help='Cursor: page preceding this one')
+page_parser.add_argument('limit', type=int, location='args', help='Rows per page (default ADMIN_PAGE_SIZE, max 200)')
+
+def admin_page(fetch, serialize):
+    if 'admin_id' not in session:
+        return {'error': 'Admin authentication required'}, 401
+    args = page_parser.parse_args()
+    try:
+        page = fetch(q=(args['q'] or '').strip() or None, after=args['after'],
+                     before=args['before'], limit=args['limit'])
+    except CursorError:
+        raise BadRequest('Invalid cursor')
+    return {
+        'items': [serialize(row) for row in page.items],
+        'next': page.next_cursor,
+        'prev': page.prev_cursor,
+    }
+
+@admin_ns.route('/buses')
+class AdminBuses(Resource):
+    @admin_ns.expect(page_parser)
+    @admin_ns.response(200, 'Success')
+    @admin_ns.response(400, 'Invalid cursor')
+    @admin_ns.response(401, 'Authentication required')
+    def get(self):
+        """One page of buses ordered by bus number (admin only)"""
+        return admin_page(bus_page, lambda bus: {
+            'bus_id': bus.bus_id,
+            'bus_number': bus.bus_number,
+            'driver_name': bus.driver_name,
+            'driver_phone': bus.driver_phone,
+            'created_at': bus.created_at.isoformat(),
+        })
+
+@admin_ns.route('/stations')
+class AdminStations(Resource):
+    @admin_ns.expect(page_parser)
+    @admin_ns.response(200, 'Success')
+    @admin_ns.response(400, 'Invalid cursor')
+    @admin_ns.response(401, 'Authentication required')
+    def get(self):
+        """One page of stations ordered by bus and route order (admin only)"""
+        return admin_page(station_page, lambda station: {
+            'station_id': station.station_id,
+            'station_name': station.station_name,
+            'bus_id': station.bus_id,
+            'bus_number': station.bus.bus_number,
+            'latitude': station.latitude,
+            'longitude': station.longitude,
+            'order': station.order,
+        })
+
+@admin_ns.route('/students')
+class AdminStudents(Resource):
+    @admin_ns.expect(page_parser)
+    @admin_ns.response(200, 'Success')
+    @admin_ns.response(400, 'Invalid cursor')
+    @admin_ns.response(401, 'Authentication required')
+    def get(self):
+        """One page of students ordered by name (admin only)"""
+        return admin_page(student_page, lambda student: {
+            'student_id': student.student_id,
+            'username': student.username,
+            'name': student.name,
+            'bus_id': student.bus_id,
+            'bus_number': student.bus.bus_number if student.bus else None,
+            'station_id': student.station_id,
+            'station_name': student.pickup_station.station_name if student.pickup_station else None,
+        })
+
+deletion_model = api.model('Deletion', {
+    'id': fields.Integer(description='Deletion ID'),
+    'bus_id': fields.Integer(description='Bus being deleted'),
+    'bus_number': fields.String(description='Bus number'),
+    'status': fields.String(description='running, done, failed, or stalled (worker gone; delete again to resume)'),
+    'total': fields.Integer(description='GPS fixes to delete'),
+    'deleted': fields.Integer(description='GPS fixes deleted so far'),
+    'progress': fields.Float(description='Fraction done, 0 to 1'),
+    'error': fields.String(description='Why a failed deletion stopped')
+})
+
+@admin_ns.route('/buses/<int:bus_id>')
+class AdminBusDetail(Resource):
+    @admin_ns.response(202, 'Deletion started', deletion_model)
+    @admin_ns.response(401, 'Authentication required')
+    @admin_ns.response(404, 'Bus not found')
+    @admin_ns.response(409, 'Students are still assigned to the bus')
+    def delete(self, bus_id):
+        """Delete a bus and its history in the background (admin only)"""
+        if 'admin_id' not in session:
+            return {'error': 'Admin authentication required'}, 401
+        bus = Bus.query.get_or_404(bus_id)
+        try:
+            deletion = start_bus_deletion(bus, session['admin_id'])
+        except DeletionBlocked as e:
+            return {'error': str(e)}, 409
+        return deletion_document(deletion), 202, {'Location': api.url_for(AdminDeletion, deletion_id=deletion.id)}
+
+@admin_ns.route('/deletions/<int:deletion_id>')
+class AdminDeletion(Resource):
+    @admin_ns.response(200, 'Success', deletion_model)
+    @admin_ns.response(401, 'Authentication required')
+    @admin_ns.response(404, 'Deletion not found')
+    def get(self, deletion_id):
+        """Progress of a background bus deletion (admin only)"""
+        if 'admin_id' not in session:
+            return {'error': 'Admin authentication required'}, 401
+        return deletion_document(Deletion.query.get_or_404(deletion_id))
+
+# Bulk CSV import
+import_parser = api.parser()
+import_parser.add_argument('file', type=FileStorage, location='files', required=True, help='CSV file')
+
+import_result_model = api.model('ImportResult', {
+    'created': fields.Integer(description='Rows imported'),
+    'failed': fields.Integer(description='Rows rejected'),
+    'errors': fields.List(fields.Raw, description='{line, error} for rejected rows (first IMPORT_MAX_ERRORS)')
+})
+
+def run_csv_import(run_import):
+    if 'admin_id' not in session:
+        return {'error': 'Admin authentication required'}, 401
+    upload = import_parser.parse_args()['file']
+    try:
+        result = run_import(upload.stream)
+    except CSVImportError as e:
+        raise BadRequest(str(e))
+    return {
+        'created': result.created,
+        'failed': result.failed,
+        'errors': [{'line': line, 'error': message} for line, message in result.errors],
+    }
+
+@admin_ns.route('/import/stations')
+class AdminImportStations(Resource):
+    @admin_ns.expect(import_parser)
+    @admin_ns.response(200, 'Import finished', import_result_model)
+    @admin_ns.response(400, 'Not a CSV file or missing columns')
+    @admin_ns.response(401, 'Authentication required')
+    def post(self):
+        """Import stations from CSV: station_name, latitude, longitude, bus_number, order (admin only)"""
+        return run_csv_import(import_stations)
+
+@admin_ns.route('/import/students')
+class AdminImportStudents(Resource):
+    @admin_ns.expect(import_parser)
+    @admin_ns.response(200, 'Import finished', import_result_model)
+    @admin_ns.response(400, 'Not a CSV file or missing columns')
+    @admin_ns.response(401, 'Authentication required')
+    def post(self):
+        """Import students from CSV: username, password, name, bus_number, station_name (admin only)"""
+        return run_csv_import(import_students)
+
+# On-demand profiling
+profile_parser = api.parser()
+profile_parser.add_argument('seconds', type=float, default=10, location='args',
+                            help='How long to profile (max PROFILE_MAX_SECONDS)')
+profile_parser.add_argument('endpoint', type=str, default='', location='args',
+                            help='Endpoint name, URL rule or path to profile; all requests if empty')
+profile_parser.add_argument('worker', type=int, default=0, location='args', help='Only this worker pid')
+profile_parser.add_argument('interval_ms', type=float, location='args',
+                            help='Sampling interval (default PROFILE_INTERVAL_MS)')
+
+profile_result_parser = api.parser()
+profile_result_parser.add_argument('format', type=str, choices=FORMATS, default='collapsed', location='args',
+                                   help='collapsed stacks or a speedscope document')
+
+profile_session_model = api.model('ProfileSession', {
+    'session': fields.Integer(description='Session number'),
+    'status': fields.String(description='running until every worker has written its results, then done'),
+    'retry_after': fields.Float(description='Seconds until the results are ready'),
+    'result': fields.String(description='URL of the results')
+})
+
+profile_model = api.model('Profile', {
+    'session': fields.Integer(description='Session number'),
+    'endpoint': fields.String(description='Endpoint profiled, null for all requests'),
+    'worker': fields.Integer(description='Worker pid profiled, null for all workers'),
+    'interval_ms': fields.Float(description='Sampling interval'),
+    'workers': fields.List(fields.Integer, description='Pids of the workers that served matching requests'),
+    'requests': fields.Integer(description='Matching requests sampled'),
+    'samples': fields.Integer(description='Stack samples taken'),
+    'sql': fields.List(fields.Raw, description='{statement, count, total_ms, max_ms}, slowest in total first'),
+    'collapsed': fields.String(description='"frame;frame;... samples" lines (format=collapsed)'),
+    'speedscope': fields.Raw(description='Speedscope file contents (format=speedscope)')
+})
+
+def profile_pending(profile, wait):
+    headers = {'Retry-After': str(math.ceil(wait)),
+               'Location': api.url_for(AdminProfileResult, number=profile.number)}
+    return ({'session': profile.number, 'status': 'running', 'retry_after': round(wait, 3),
+             'result': headers['Location']}, 202, headers)
+
+@admin_ns.route('/profile')
+class AdminProfile(Resource):
+    @admin_ns.expect(profile_parser)
+    @admin_ns.response(202, 'Session started; fetch the result from its URL', profile_session_model)
+    @admin_ns.response(400, 'Invalid duration or interval')
+    @admin_ns.response(401, 'Authentication required')
+    @admin_ns.response(409, 'Another profiling session is running')
+    def post(self):
+        """Start sampling matching requests for a while (admin only)"""
+        if 'admin_id' not in session:
+            return {'error': 'Admin authentication required'}, 401
+        args = profile_parser.parse_args()
+        interval_ms = args['interval_ms'] or app.config['PROFILE_INTERVAL_MS']
+        if not 0 < args['seconds'] <= app.config['PROFILE_MAX_SECONDS']:
+            raise BadRequest('seconds must be between 0 and %d' % app.config['PROFILE_MAX_SECONDS'])
+        if not 1 <= interval_ms <= 1000:
+            raise BadRequest('interval_ms must be between 1 and 1000')
+        try:
+            profile = start_session(args['seconds'], interval_ms / 1000, args['worker'], args['endpoint'].strip())
+        except ProfileBusy as e:
+            return {'error': str(e)}, 409
+        except ValueError as e:
+            raise BadRequest(str(e))
+        return profile_pending(profile, seconds_until_ready(profile))
+
+@admin_ns.route('/profile/<int:number>')
+class AdminProfileResult(Resource):
+    @admin_ns.expect(profile_result_parser)
+    @admin_ns.response(200, 'Stacks and SQL of the session', profile_model)
+    @admin_ns.response(202, 'Still running; retry after Retry-After seconds', profile_session_model)
+    @admin_ns.response(401, 'Authentication required')
+    @admin_ns.response(404, 'No such session, or a newer one has started')
+    def get(self, number):
+        """Stacks and SQL recorded by a profiling session (admin only)"""
+        if 'admin_id' not in session:
+            return {'error': 'Admin authentication required'}, 401
+        args = profile_result_parser.parse_args()
+        profile = find_session(number)
+        if profile is None:
+            return {'error': 'Profiling session not found'}, 404
+        wait = seconds_until_ready(profile)
+        if wait:
+            return profile_pending(profile, wait)
+        return profile_document(profile, args['format'])
+
 # Real-time map endpoints
 map_ns = api.namespace('map', description='Real-time map operations')
 
@@ -366,61 +730,65 @@ bus_location_response = api.model('BusLocationResponse', {
     'driver_name': fields.String(description='Driver name')
 })
 
+fleet_bus_location_response = api.inherit('FleetBusLocationResponse', bus_location_response, {
+    'feed_status': fields.String(description='GPS feed state (active/stale/offline) from the feed watchdog')
+})
+
+student_bus_location_response = api.inherit('StudentBusLocationResponse', bus_location_response, {
+    'next_poll_after': fields.Integer(description='Seconds until the next request is worthwhile')
+})
+
 @map_ns.route('/student/bus-location')
 class StudentBusLocation(Resource):
-    @map_ns.marshal_with(bus_location_response)
-    @map_ns.response(200, 'Success')
+    @map_ns.response(200, 'Success', student_bus_location_response)
     @map_ns.response(401, 'Authentication required')
+    @map_ns.response(404, 'Bus location not available')
     def get(self):
         """Get real-time location of student's assigned bus"""
         if 'student_id' not in session:
             return {'error': 'Authentication required'}, 401
             
-        student = Student.query.get(session['student_id'])
+        student = get_student(session['student_id'])
         if not student:
             return {'error': 'Student not found'}, 404
             
-        bus = Bus.query.get(student.bus_id)
-        latest_location = BusLocation.query.filter_by(bus_id=student.bus_id).order_by(BusLocation.timestamp.desc()).first()
+        bus = get_bus(student.bus_id)
+        fixes = latest_fixes(student.bus_id)
+        poll_after = next_poll_after(fixes, get_station(student.station_id))
         
-        if not latest_location:
-            return {'error': 'Bus location not available'}, 404
+        if not bus or not fixes:
+            return ({'error': 'Bus location not available', 'next_poll_after': poll_after}, 404,
+                    poll_headers(poll_after))
             
-        return {
-            'bus_id': bus.bus_id,
-            'bus_number': bus.bus_number,
-            'latitude': latest_location.latitude,
-            'longitude': latest_location.longitude,
-            'timestamp': latest_location.timestamp.isoformat(),
-            'driver_name': bus.driver_name
-        }
+        body = with_field(bus_location_fragment(bus, fixes[0]), 'next_poll_after', poll_after)
+        return json_response(body, headers=poll_headers(poll_after))
 
 @map_ns.route('/admin/all-buses')
 class AllBusesLocation(Resource):
-    @map_ns.marshal_list_with(bus_location_response)
-    @map_ns.response(200, 'Success')
+    @map_ns.response(200, 'Success', [fleet_bus_location_response])
     @map_ns.response(401, 'Authentication required')
+    @map_ns.header('Next-Poll-After', 'Seconds until the next request is worthwhile')
     def get(self):
         """Get real-time locations of all buses (admin only)"""
         if 'admin_id' not in session:
             return {'error': 'Admin authentication required'}, 401
             
-        buses = Bus.query.all()
+        bus_ids = [bus_id for bus_id, in db.session.query(Bus.bus_id).order_by(Bus.bus_id)]
         bus_locations = []
+        poll_after = app.config['POLL_IDLE_SECONDS']
         
-        for bus in buses:
-            latest_location = BusLocation.query.filter_by(bus_id=bus.bus_id).order_by(BusLocation.timestamp.desc()).first()
-            if latest_location:
-                bus_locations.append({
-                    'bus_id': bus.bus_id,
-                    'bus_number': bus.bus_number,
-                    'latitude': latest_location.latitude,
-                    'longitude': latest_location.longitude,
-                    'timestamp': latest_location.timestamp.isoformat(),
-                    'driver_name': bus.driver_name
-                })
+        # One query per location shard, run in parallel, instead of one per bus
+        fixes_by_bus = latest_fixes_by_bus(bus_ids)
+        for bus_id in bus_ids:
+            fixes = fixes_by_bus[bus_id]
+            bus = get_bus(bus_id)
+            if fixes and bus:
+                fragment = bus_location_fragment(bus, fixes[0])
+                bus_locations.append(with_field(fragment, 'feed_status', feed_status(bus_id)))
+            # The fleet view is as urgent as its busiest bus
+            poll_after = min(poll_after, next_poll_after(fixes))
         
-        return bus_locations
+        return json_response(json_list(bus_locations), headers=poll_headers(poll_after))
 
 station_location_model = api.model('StationLocation', {
     'station_id': fields.Integer(description='Station ID'),
@@ -431,21 +799,46 @@ station_location_model = api.model('StationLocation', {
     'is_pickup_station': fields.Boolean(description='Is this the student pickup station')
 })
 
+compact_route_model = api.model('CompactRoute', {
+    'format': fields.String(description='Geometry encoding: "polyline6", an encoded polyline with 6 decimal places'),
+    'bus_id': fields.Integer(description='Bus ID'),
+    'polyline': fields.String(description='Station coordinates in route order'),
+    'station_ids': fields.List(fields.Integer, description='Station IDs, parallel to the polyline points'),
+    'station_names': fields.List(fields.String, description='Station names, parallel to the polyline points'),
+    'order': fields.List(fields.Integer, description='Order in route, parallel to the polyline points')
+})
+
+route_format_parser = api.parser()
+route_format_parser.add_argument('format', type=str, location='args', choices=('full', 'compact'), default='full',
+                                 help='"compact" returns one encoded polyline and parallel station arrays')
+
+def conditional_json(body, etag, headers=None):
+    """Pre-encoded body with an ETag; 304 when the client already has it"""
+    headers = dict(headers or {}, ETag='"%s"' % etag)
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return json_response(body, headers=headers)
+
 @map_ns.route('/student/route-stations')
 class StudentRouteStations(Resource):
-    @map_ns.marshal_list_with(station_location_model)
-    @map_ns.response(200, 'Success')
+    @map_ns.expect(route_format_parser)
+    @map_ns.response(200, 'Success; with format=compact a CompactRoute plus pickup_station_id', [station_location_model])
+    @map_ns.response(304, 'Route unchanged since the ETag sent in If-None-Match (format=compact)')
     @map_ns.response(401, 'Authentication required')
     def get(self):
         """Get all stations on student's bus route for map display"""
         if 'student_id' not in session:
             return {'error': 'Authentication required'}, 401
             
-        student = Student.query.get(session['student_id'])
+        student = get_student(session['student_id'])
         if not student:
             return {'error': 'Student not found'}, 404
             
-        stations = Station.query.filter_by(bus_id=student.bus_id).order_by(Station.order).all()
+        stations = get_route(student.bus_id)
+        if route_format_parser.parse_args()['format'] == 'compact':
+            body, digest = compact_route_fragment(student.bus_id, stations, route_version(stations))
+            return conditional_json(with_field(body, 'pickup_station_id', student.station_id),
+                                    '%s-%s' % (digest, student.station_id))
         
         stations_data = []
         for station in stations:
@@ -458,4 +851,22 @@ class StudentRouteStations(Resource):
                 'is_pickup_station': station.station_id == student.station_id
             })
         
-        return stations_data
\ No newline at end of file
+        return marshal(stations_data, station_location_model)
+
+@map_ns.route('/admin/routes')
+class AllBusRoutes(Resource):
+    @map_ns.response(200, 'Success', [compact_route_model])
+    @map_ns.response(304, 'No route changed since the ETag sent in If-None-Match')
+    @map_ns.response(401, 'Authentication required')
+    def get(self):
+        """Every bus route in compact form, for drawing the fleet map (admin only)"""
+        if 'admin_id' not in session:
+            return {'error': 'Admin authentication required'}, 401
+        
+        routes = []
+        for bus_id, in db.session.query(Bus.bus_id).order_by(Bus.bus_id):
+            stations = get_route(bus_id)
+            if stations:
+                routes.append(compact_route_fragment(bus_id, stations, route_version(stations)))
+        etag = hashlib.sha1(''.join(digest for body, digest in routes).encode()).hexdigest()[:16]
+        return conditional_json(json_list([body for body, digest in routes]), etag)
\ No newline at end of file
@@ -1,12 +1,14 @@
 import os
-import logging
+import tempfile
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
+from engine_profiles import engine_options, apply_engine_profile
+from logging_setup import configure_logging
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (queued, JSON by default; see logging_setup.py)
+configure_logging()
 
 class Base(DeclarativeBase):
     pass
@@ -20,30 +22,111 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///sqlite.db")
-#app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-#    "pool_recycle": 300,
-#    "pool_pre_ping": True,
-#}
+# Pool, timeout and pragma settings per backend; DB_PROFILE selects them (see engine_profiles.py)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Bus/student/station metadata cache (see cache.py)
+app.config["METADATA_CACHE_SIZE"] = int(os.environ.get("METADATA_CACHE_SIZE", 1024))
+app.config["METADATA_CACHE_TTL"] = int(os.environ.get("METADATA_CACHE_TTL", 60))
+
+# Per-request query instrumentation (see instrumentation.py); warnings only in debug mode
+app.config["QUERY_BUDGET"] = int(os.environ.get("QUERY_BUDGET", 20))
+app.config["QUERY_REPEAT_LIMIT"] = int(os.environ.get("QUERY_REPEAT_LIMIT", 5))
+
+# /metrics endpoint (see metrics.py). METRICS_DIR enables cross-worker aggregation;
+# gunicorn.conf.py sets it up for gunicorn deployments.
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+app.config["METRICS_FLUSH_INTERVAL"] = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1.0))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+app.config["STALE_BUS_SECONDS"] = int(os.environ.get("STALE_BUS_SECONDS", 120))
+
+# Stale-feed watchdog (see feed_watchdog.py): buses are stale after STALE_BUS_SECONDS
+# without a fix and offline after FEED_OFFLINE_SECONDS. FEED_STATE_FILE shares
+# fix times across workers; gunicorn.conf.py sets it.
+app.config["FEED_OFFLINE_SECONDS"] = int(os.environ.get("FEED_OFFLINE_SECONDS", 900))
+app.config["FEED_STATE_FILE"] = os.environ.get("FEED_STATE_FILE")
+app.config["FEED_DELAY_NOTICE"] = os.environ.get("FEED_DELAY_NOTICE", "0") == "1"
+app.config["FEED_NOTICE_MINUTES"] = int(os.environ.get("FEED_NOTICE_MINUTES", 30))
+
+# "Bus approaching" events (see arrivals.py). The two files share approach flags
+# and the event stream across workers; gunicorn.conf.py sets them.
+app.config["ARRIVAL_RADIUS_KM"] = float(os.environ.get("ARRIVAL_RADIUS_KM", 0.5))
+app.config["ARRIVAL_FLAGS_FILE"] = os.environ.get("ARRIVAL_FLAGS_FILE")
+app.config["ARRIVAL_EVENTS_FILE"] = os.environ.get("ARRIVAL_EVENTS_FILE")
+app.config["PUSH_BACKEND"] = os.environ.get("PUSH_BACKEND", "log")
+# Request threads per worker that may wait on events (SSE or long-poll); gunicorn.conf.py
+# adds them to its thread count so waiting clients never take threads from other requests.
+# Streams are closed after EVENT_STREAM_MAX_SECONDS and clients reconnect.
+app.config["EVENT_WAIT_SLOTS"] = int(os.environ.get("EVENT_WAIT_SLOTS", 4))
+app.config["EVENT_STREAM_MAX_SECONDS"] = int(os.environ.get("EVENT_STREAM_MAX_SECONDS", 300))
+
+# Rows per page on the admin bus/station/student lists (see pagination.py)
+app.config["ADMIN_PAGE_SIZE"] = int(os.environ.get("ADMIN_PAGE_SIZE", 50))
+
+# Bulk CSV import (see importer.py); 0 hash workers means one per CPU core
+app.config["IMPORT_CHUNK_SIZE"] = int(os.environ.get("IMPORT_CHUNK_SIZE", 500))
+app.config["IMPORT_HASH_WORKERS"] = int(os.environ.get("IMPORT_HASH_WORKERS", 0))
+app.config["IMPORT_MAX_ERRORS"] = int(os.environ.get("IMPORT_MAX_ERRORS", 500))
+
+# Background bus deletion (see deletion.py): GPS fixes removed per transaction,
+# pause between transactions, and how long without progress counts as stalled
+app.config["DELETE_CHUNK_SIZE"] = int(os.environ.get("DELETE_CHUNK_SIZE", 5000))
+app.config["DELETE_PAUSE_SECONDS"] = float(os.environ.get("DELETE_PAUSE_SECONDS", 0.05))
+app.config["DELETE_STALL_SECONDS"] = int(os.environ.get("DELETE_STALL_SECONDS", 120))
+
+# Admin dashboard counters (see stats.py), shared across workers through
+# STATS_FILE (set by gunicorn.conf.py) and re-counted from the database this often
+app.config["STATS_FILE"] = os.environ.get("STATS_FILE")
+app.config["STATS_RECONCILE_SECONDS"] = int(os.environ.get("STATS_RECONCILE_SECONDS", 300))
+
+# Rendered template fragments (see fragments.py); the state file shares the
+# notice version across workers and is set by gunicorn.conf.py
+app.config["FRAGMENT_CACHE_SIZE"] = int(os.environ.get("FRAGMENT_CACHE_SIZE", 2048))
+app.config["FRAGMENT_CACHE_TTL"] = int(os.environ.get("FRAGMENT_CACHE_TTL", 60))
+app.config["FRAGMENT_STATE_FILE"] = os.environ.get("FRAGMENT_STATE_FILE")
+
+# Client polling hints (see polling.py), in seconds
+app.config["POLL_MIN_SECONDS"] = int(os.environ.get("POLL_MIN_SECONDS", 5))
+app.config["POLL_MOVING_MAX_SECONDS"] = int(os.environ.get("POLL_MOVING_MAX_SECONDS", 30))
+app.config["POLL_PARKED_SECONDS"] = int(os.environ.get("POLL_PARKED_SECONDS", 60))
+app.config["POLL_IDLE_SECONDS"] = int(os.environ.get("POLL_IDLE_SECONDS", 300))
+
+# Per-bus GPS upload token buckets (see ratelimit.py); buses can override both.
+# RATE_LIMIT_FILE shares the buckets across workers; gunicorn.conf.py sets it.
+app.config["INGEST_RATE_LIMIT"] = float(os.environ.get("INGEST_RATE_LIMIT", 2.0))
+app.config["INGEST_BURST"] = int(os.environ.get("INGEST_BURST", 10))
+app.config["RATE_LIMIT_FILE"] = os.environ.get("RATE_LIMIT_FILE")
+
+# On-demand sampling profiler (see profiler.py): longest session, default sampling
+# interval, where workers leave their results, and the session state shared by
+# the workers (set by gunicorn.conf.py)
+app.config["PROFILE_MAX_SECONDS"] = int(os.environ.get("PROFILE_MAX_SECONDS", 60))
+app.config["PROFILE_INTERVAL_MS"] = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "bustrack-profiles"))
+app.config["PROFILE_STATE_FILE"] = os.environ.get("PROFILE_STATE_FILE")
+
+# Optional hash-sharded GPS history (see locations.py): LOCATION_SHARDS > 0 moves
+# bus_locations into that many databases, one per LOCATION_SHARD_URL with {shard}
+# replaced by the shard number, or one Postgres schema each if it has no {shard}
+app.config["LOCATION_SHARDS"] = int(os.environ.get("LOCATION_SHARDS", 0))
+app.config["LOCATION_SHARD_URL"] = os.environ.get(
+    "LOCATION_SHARD_URL", "sqlite:///" + os.path.join(app.instance_path, "locations-{shard}.db")
+)
+
+# Standalone asyncio GPS ingest server (see gateway.py): fixes written per
+# transaction, how long the writer waits to fill a batch, uploads queued before
+# devices are told to back off, seconds an idle keep-alive connection stays open
+# and between reloads of the bus registry
+app.config["GATEWAY_BATCH_SIZE"] = int(os.environ.get("GATEWAY_BATCH_SIZE", 2000))
+app.config["GATEWAY_BATCH_WAIT"] = float(os.environ.get("GATEWAY_BATCH_WAIT", 0.01))
+app.config["GATEWAY_QUEUE_SIZE"] = int(os.environ.get("GATEWAY_QUEUE_SIZE", 20000))
+app.config["GATEWAY_IDLE_TIMEOUT"] = int(os.environ.get("GATEWAY_IDLE_TIMEOUT", 120))
+app.config["GATEWAY_REGISTRY_TTL"] = int(os.environ.get("GATEWAY_REGISTRY_TTL", 30))
+
 # Initialize the app with the extension
 db.init_app(app)
 
+# Tables and the default admin are created by bootstrap.py, not on import
 with app.app_context():
-    # Import models to create tables
-    import models  # noqa: F401
-    db.create_all()
-    
-    # Create default admin user if not exists
-    from models import Admin
-    from werkzeug.security import generate_password_hash
-    
-    default_admin = Admin.query.filter_by(username='admin').first()
-    if not default_admin:
-        admin = Admin(
-            username='admin',
-            password_hash=generate_password_hash('admin123')
-        )
-        db.session.add(admin)
-        db.session.commit()
-        logging.info("Default admin user created (username: admin, password: admin123)")
+    apply_engine_profile(db.engine)
@@ -0,0 +1,261 @@
+"""Bus-approaching events, detected at ingest and pushed to students.
+
+When a stored fix puts a bus within ARRIVAL_RADIUS_KM of a station on its
+route, one event fires for that (bus, station); it re-arms once the bus is
+more than REARM_FACTOR times the radius away, so the next trip fires again.
+The flags live in a shared per-bus bitmask (the first 64 stations of a
+route), so however many workers receive a bus's fixes, each approach fires
+exactly once.
+
+Events reach students two ways:
+
+* Push: the detecting worker hands the event to a background thread that
+  looks up the students picked up at that station in the cached
+  station-to-students index and calls the PUSH_BACKEND once per student.
+  "log" is the local stand-in for a real push service, "none" disables it,
+  and "package.module.Class" plugs in any class with a send() method.
+* Streams: events go into a ring shared by all workers (ARRIVAL_EVENTS_FILE,
+  set by gunicorn.conf.py); each worker tails it and puts them on the queues
+  of subscribers waiting on that station, for the SSE and long-poll
+  endpoints in api.py. Holding a stream open needs a threaded worker class;
+  at most EVENT_WAIT_SLOTS requests per worker wait at once (the rest get a
+  503) and streams end after EVENT_STREAM_MAX_SECONDS.
+
+The ingest path only pays for the stations on the bus's route; fan-out work
+is proportional to the students at stations actually reached.
+"""
+import os
+import time
+import importlib
+import queue
+import struct
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from app import app
+from cache import get_bus, get_station, get_route, get_station_students
+from shared_slots import SlotFile, EventRing
+from utils import calculate_distance
+
+REARM_FACTOR = 2
+MAX_ROUTE_STATIONS = 64  # one bit per station in the shared flags
+RECENT_EVENTS = 256  # kept per worker so reconnecting clients can catch up
+TAIL_INTERVAL = 0.2  # seconds between checks of the shared event ring
+HEARTBEAT_SECONDS = 15  # SSE comment sent on idle streams to keep proxies from closing them
+LONG_POLL_MAX_SECONDS = 30
+WAIT_SLOT_RETRY_SECONDS = 5  # Retry-After when every wait slot is taken
+
+FLAGS = struct.Struct('<qQ')  # bus_id, bit per route station inside the radius
+EVENT = struct.Struct('<qqd')  # bus_id, station_id, unix time
+
+logger = logging.getLogger(__name__)
+push_logger = logging.getLogger('bustrack.push')
+
+class LogPushBackend:
+    """Stand-in for a push service: logs what would have been sent"""
+
+    def send(self, student_id, event):
+        push_logger.info("Push to student %s: bus %s approaching %s",
+                         student_id, event['bus_number'], event['station_name'])
+
+PUSH_BACKENDS = {'log': LogPushBackend}
+
+def load_push_backend(name):
+    """Instantiate a backend by short name or dotted class path; 'none' gives None"""
+    if name == 'none':
+        return None
+    if name in PUSH_BACKENDS:
+        return PUSH_BACKENDS[name]()
+    module_name, _, class_name = name.rpartition('.')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+class ApproachFlags:
+    """Which route stations each bus is currently inside the radius of"""
+
+    def __init__(self, slots=None):
+        self._slots = slots
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def update(self, bus_id, inside, far):
+        """Set `inside` bits, clear `far` ones; returns the bits that were newly set"""
+        if self._slots is None:
+            with self._lock:
+                flags = self._local.get(bus_id, 0)
+                self._local[bus_id] = (flags | inside) & ~far
+            return inside & ~flags
+        with self._slots.slot(bus_id) as (read, write):
+            owner, flags = read()
+            if owner != bus_id:
+                flags = 0
+            write(bus_id, (flags | inside) & ~far)
+        return inside & ~flags
+
+def event_document(number, bus_id, station_id, when):
+    bus = get_bus(bus_id)
+    station = get_station(station_id)
+    return {
+        'id': number,
+        'type': 'approaching',
+        'bus_id': bus_id,
+        'bus_number': bus.bus_number if bus else None,
+        'station_id': station_id,
+        'station_name': station.station_name if station else None,
+        'timestamp': datetime.utcfromtimestamp(when).isoformat(),
+    }
+
+class ArrivalFeed:
+    def __init__(self, ring=None, flag_slots=None, push_backend=None):
+        self.flags = ApproachFlags(flag_slots)
+        self._ring = ring
+        self._cursor = 0
+        self._local_number = 0
+        self._recent = deque(maxlen=RECENT_EVENTS)
+        self._subscribers = {}  # station_id -> set of queues
+        self._lock = threading.Lock()
+        self._push_backend = push_backend
+        self._push_queue = queue.Queue(maxsize=10000)
+
+    def start(self):
+        if self._ring is not None:
+            # Only events published from now on are streamed by this worker
+            self._cursor = self._ring.newest()
+            threading.Thread(target=self._tail, name='arrival-tail', daemon=True).start()
+        if self._push_backend is not None:
+            threading.Thread(target=self._push, name='arrival-push', daemon=True).start()
+
+    def check(self, bus_id, latitude, longitude, when):
+        """Fire events for stations this fix brought the bus close to"""
+        radius = app.config['ARRIVAL_RADIUS_KM']
+        inside = far = 0
+        route = get_route(bus_id)[:MAX_ROUTE_STATIONS]
+        for index, station in enumerate(route):
+            distance = calculate_distance(latitude, longitude, station.latitude, station.longitude)
+            if distance < radius:
+                inside |= 1 << index
+            elif distance > radius * REARM_FACTOR:
+                far |= 1 << index
+        if not inside:
+            self.flags.update(bus_id, 0, far)
+            return
+        reached = self.flags.update(bus_id, inside, far)
+        for index, station in enumerate(route):
+            if reached & (1 << index):
+                self.publish(bus_id, station.station_id, when)
+
+    def publish(self, bus_id, station_id, when):
+        if self._ring is not None:
+            number = self._ring.append(bus_id, station_id, when)
+        else:
+            with self._lock:
+                self._local_number += 1
+                number = self._local_number
+            self._deliver(number, bus_id, station_id, when)
+        if self._push_backend is not None:
+            try:
+                self._push_queue.put_nowait((number, bus_id, station_id, when))
+            except queue.Full:
+                logger.warning("Push queue full; dropped arrival event %s", number)
+
+    def _deliver(self, number, bus_id, station_id, when):
+        """Hand an event to this worker's stream subscribers"""
+        with app.app_context():
+            event = event_document(number, bus_id, station_id, when)
+        with self._lock:
+            self._recent.append(event)
+            subscribers = list(self._subscribers.get(station_id, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                pass  # a stalled client misses events rather than growing without bound
+
+    def _tail(self):
+        while True:
+            time.sleep(TAIL_INTERVAL)
+            try:
+                self._cursor, records = self._ring.read_since(self._cursor)
+                for number, bus_id, station_id, when in records:
+                    self._deliver(number, bus_id, station_id, when)
+            except Exception:
+                logger.exception("Failed to read arrival events")
+
+    def _push(self):
+        while True:
+            number, bus_id, station_id, when = self._push_queue.get()
+            try:
+                with app.app_context():
+                    event = event_document(number, bus_id, station_id, when)
+                    for student_id in get_station_students(station_id):
+                        self._push_backend.send(student_id, event)
+            except Exception:
+                logger.exception("Failed to push arrival event %s", number)
+
+    def subscribe(self, station_id, since=None):
+        """A queue receiving this station's events, preloaded with any after `since`"""
+        subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            if since is not None:
+                for event in self._recent:
+                    if event['id'] > since and event['station_id'] == station_id:
+                        subscriber.put_nowait(event)
+            self._subscribers.setdefault(station_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, station_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(station_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[station_id]
+
+_feed = None
+_owner_pid = None
+_start_lock = threading.Lock()
+
+def get_feed():
+    """This process's arrival feed, started on first use after a fork"""
+    global _feed, _owner_pid
+    pid = os.getpid()
+    if _owner_pid != pid:
+        with _start_lock:
+            if _owner_pid != pid:
+                config = app.config
+                _feed = ArrivalFeed(
+                    EventRing(config['ARRIVAL_EVENTS_FILE'], EVENT) if config['ARRIVAL_EVENTS_FILE'] else None,
+                    SlotFile(config['ARRIVAL_FLAGS_FILE'], FLAGS) if config['ARRIVAL_FLAGS_FILE'] else None,
+                    load_push_backend(config['PUSH_BACKEND']),
+                )
+                _feed.start()
+                _owner_pid = pid
+    return _feed
+
+def check_arrivals(bus_id, latitude, longitude, when):
+    """Called by ingest after a fix is committed; never fails the upload"""
+    try:
+        get_feed().check(bus_id, latitude, longitude, when)
+    except Exception:
+        logger.exception("Arrival check failed for bus %s", bus_id)
+
+_wait_slots = threading.BoundedSemaphore(app.config['EVENT_WAIT_SLOTS'])
+
+def take_wait_slot():
+    """Reserve one of this worker's event-waiting threads; False if all are busy"""
+    return _wait_slots.acquire(blocking=False)
+
+def release_wait_slot():
+    _wait_slots.release()
+
+def drain(subscriber, timeout):
+    """Wait up to `timeout` for one event, then take whatever else is queued"""
+    try:
+        events = [subscriber.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while True:
+        try:
+            events.append(subscriber.get_nowait())
+        except queue.Empty:
+            return events
@@ -0,0 +1,324 @@
+"""Microbenchmarks for the route utilities and hot API resources.
+
+Seeds an in-memory SQLite database at each requested fleet size, times
+utils.py functions directly and API resources through the Flask test
+client, and records SQL query counts next to wall time:
+
+    python benchmark.py --buses 10,100 --stations 10,40 --history 200 --output bench.json
+    python benchmark.py --baseline bench.json --threshold 0.25
+    python benchmark.py --concurrent-rw 10 --writers 4 --readers 8
+
+With --baseline, exits non-zero when any case got slower by more than the
+threshold or issues more queries than before. --concurrent-rw instead
+hammers a temporary SQLite file with concurrent GPS writers and readers,
+once per engine profile, to check the engine_profiles.py settings.
+--sharded-writes runs concurrent GPS writers against 1, 2, 4... SQLite
+location shards (see locations.py) to show write throughput per shard count:
+
+    python benchmark.py --sharded-writes 10 --shards 1,2,4,8 --writers 8
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+from datetime import datetime, timedelta
+
+# Must be set before app.py is imported; it reads the database URL and engine options at import time
+os.environ["DATABASE_URL"] = "sqlite://"
+# GPS uploads are timed back to back; the per-bus token buckets would turn them into 429s
+os.environ["INGEST_RATE_LIMIT"] = "0"
+
+from sqlalchemy import event, insert, select, create_engine
+from sqlalchemy.exc import OperationalError
+from app import app, db
+import main  # noqa: F401  registers routes and API resources
+import cache
+import locations
+from models import Admin, Bus, Station, Student, BusLocation
+from utils import calculate_distance, calculate_eta, get_station_status
+from engine_profiles import engine_options, apply_engine_profile
+
+BENCH_PASSWORD = "bench"
+
+class QueryCounter:
+    """Counts statements executed on the engine while active"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(db.engine, "after_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, "after_cursor_execute", self)
+
+def seed(bus_count, stations_per_route, history):
+    """Reset the in-memory database and fill it with a synthetic fleet"""
+    db.drop_all()
+    db.create_all()
+    for c in (cache.bus_cache, cache.student_cache, cache.station_cache, cache.route_cache,
+              cache.station_students_cache):
+        c.invalidate()
+
+    buses = [Bus(bus_number=f"B{i:04d}", driver_name=f"Driver {i}", driver_phone="0000000000")
+             for i in range(bus_count)]
+    db.session.add_all(buses)
+    db.session.flush()
+
+    station_rows = []
+    for bus in buses:
+        for order in range(1, stations_per_route + 1):
+            station_rows.append({
+                "station_name": f"{bus.bus_number} stop {order}",
+                "latitude": 27.67 + order * 0.002,
+                "longitude": 84.44 + bus.bus_id * 0.001,
+                "bus_id": bus.bus_id,
+                "order": order,
+            })
+    db.session.execute(insert(Station), station_rows)
+
+    now = datetime.utcnow()
+    location_rows = []
+    for bus in buses:
+        for i in range(history):
+            location_rows.append({
+                "bus_id": bus.bus_id,
+                "latitude": 27.67 + (i % stations_per_route) * 0.002,
+                "longitude": 84.44 + bus.bus_id * 0.001,
+                "timestamp": now - timedelta(seconds=3 * (history - i)),
+            })
+    if location_rows:
+        db.session.execute(insert(BusLocation), location_rows)
+
+    first_bus = buses[0]
+    pickup = Station.query.filter_by(bus_id=first_bus.bus_id).order_by(Station.order.desc()).first()
+    student = Student(username="bench", name="Bench Student", bus_id=first_bus.bus_id,
+                      station_id=pickup.station_id)
+    student.set_password(BENCH_PASSWORD)
+    admin = Admin(username="bench")
+    admin.set_password(BENCH_PASSWORD)
+    db.session.add_all([student, admin])
+    db.session.commit()
+    return first_bus.bus_id, pickup.station_id
+
+def measure(fn, repeat):
+    """Run fn `repeat` times; return per-call timings and queries per call"""
+    fn()  # warm caches and lazy imports
+    timings = []
+    with QueryCounter() as counter:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - started)
+    return {
+        "median_us": round(statistics.median(timings) * 1e6, 2),
+        "mean_us": round(statistics.fmean(timings) * 1e6, 2),
+        "min_us": round(min(timings) * 1e6, 2),
+        "queries": round(counter.count / repeat, 2),
+    }
+
+def http_case(client, method, url, **kwargs):
+    def call():
+        response = client.open(url, method=method, **kwargs)
+        assert response.status_code == 200, (url, response.status_code)
+    return call
+
+def run_size(bus_count, stations_per_route, history, repeat):
+    bus_id, station_id = seed(bus_count, stations_per_route, history)
+
+    student_client = app.test_client()
+    student_client.post("/api/auth/student/login", json={"username": "bench", "password": BENCH_PASSWORD})
+    admin_client = app.test_client()
+    admin_client.post("/api/auth/admin/login", json={"username": "bench", "password": BENCH_PASSWORD})
+
+    cases = {
+        "utils.calculate_distance": lambda: calculate_distance(27.67, 84.44, 27.68, 84.43),
+        "utils.calculate_eta": lambda: calculate_eta(bus_id, station_id),
+        "utils.get_station_status": lambda: get_station_status(bus_id, station_id),
+        "GET /api/student/my-bus/stations": http_case(student_client, "GET", "/api/student/my-bus/stations"),
+        "GET /api/map/student/bus-location": http_case(student_client, "GET", "/api/map/student/bus-location"),
+        "GET /api/map/student/route-stations": http_case(student_client, "GET", "/api/map/student/route-stations"),
+        "GET /student/dashboard": http_case(student_client, "GET", "/student/dashboard"),
+        "GET /api/map/admin/all-buses": http_case(admin_client, "GET", "/api/map/admin/all-buses"),
+        "POST /api/bus/<id>/location": http_case(admin_client, "POST", f"/api/bus/{bus_id}/location",
+                                                 json={"latitude": 27.675, "longitude": 84.44}),
+    }
+    return {name: measure(fn, repeat) for name, fn in cases.items()}
+
+def compare(results, baseline, threshold):
+    """Return human-readable regressions against a previous results file"""
+    regressions = []
+    for size, cases in results.items():
+        for name, current in cases.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+            if current["median_us"] > previous["median_us"] * (1 + threshold):
+                regressions.append(f"{size} {name}: {previous['median_us']}us -> {current['median_us']}us")
+            if current["queries"] > previous["queries"]:
+                regressions.append(f"{size} {name}: {previous['queries']} -> {current['queries']} queries")
+    return regressions
+
+def concurrent_rw(profile, seconds, writers, readers):
+    """Writers insert fixes while readers fetch the latest one, on a real file"""
+    directory = tempfile.mkdtemp()
+    url = "sqlite:///" + os.path.join(directory, "rw.db")
+    engine = create_engine(url, **engine_options(url, profile))
+    apply_engine_profile(engine, profile)
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        bus_id = conn.execute(insert(Bus).values(bus_number="RW", driver_name="d", driver_phone="0")).inserted_primary_key[0]
+
+    locations = BusLocation.__table__
+    latest = select(locations).where(locations.c.bus_id == bus_id).order_by(locations.c.timestamp.desc()).limit(1)
+    counts = {"writes": 0, "reads": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def writer():
+        while time.monotonic() < deadline:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(insert(locations).values(bus_id=bus_id, latitude=27.67, longitude=84.44,
+                                                          timestamp=datetime.utcnow()))
+                key = "writes"
+            except OperationalError:
+                key = "errors"
+            with lock:
+                counts[key] += 1
+
+    def reader():
+        while time.monotonic() < deadline:
+            try:
+                with engine.connect() as conn:
+                    conn.execute(latest).first()
+                key = "reads"
+            except OperationalError:
+                key = "errors"
+            with lock:
+                counts[key] += 1
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    engine.dispose()
+
+    return {
+        "writes_per_s": round(counts["writes"] / seconds, 1),
+        "reads_per_s": round(counts["reads"] / seconds, 1),
+        "errors": counts["errors"],
+    }
+
+def sharded_writes(shards, seconds, writers, buses=256, batch=20):
+    """Writers store batches of fixes for their own buses through locations.store_rows"""
+    directory = tempfile.mkdtemp()
+    app.config["LOCATION_SHARDS"] = shards
+    app.config["LOCATION_SHARD_URL"] = "sqlite:///" + os.path.join(directory, "locations-{shard}.db")
+    locations.reset_shards()
+    with app.app_context():
+        locations.create_shard_tables()
+    counts = {"fixes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def writer(number):
+        own = [bus_id for bus_id in range(1, buses + 1) if bus_id % writers == number]
+        sequence = 0
+        while time.monotonic() < deadline:
+            sequence += 1
+            bus_id = own[sequence % len(own)]
+            rows = [{"bus_id": bus_id, "latitude": 27.67, "longitude": 84.44, "timestamp": datetime.utcnow(),
+                     "sequence": sequence * batch + i} for i in range(batch)]
+            try:
+                with app.app_context():
+                    stored = sum(locations.store_rows([rows]))
+                key = "fixes"
+            except OperationalError:
+                stored, key = 1, "errors"
+            with lock:
+                counts[key] += stored
+
+    threads = [threading.Thread(target=writer, args=(number,)) for number in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    locations.reset_shards()
+    return {"fixes_per_s": round(counts["fixes"] / seconds, 1), "errors": counts["errors"]}
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--buses", type=int_list, default=[10, 100], help="comma-separated fleet sizes")
+    parser.add_argument("--stations", type=int_list, default=[10, 40], help="comma-separated stations per route")
+    parser.add_argument("--history", type=int, default=200, help="GPS fixes stored per bus")
+    parser.add_argument("--repeat", type=int, default=50, help="timed calls per case")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", help="results JSON from a previous release to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--concurrent-rw", type=float, metavar="SECONDS",
+                        help="run the concurrent read/write engine profile benchmark instead")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--sharded-writes", type=float, metavar="SECONDS",
+                        help="run the location shard write benchmark instead")
+    parser.add_argument("--shards", type=int_list, default=[1, 2, 4, 8], help="comma-separated shard counts")
+    parser.add_argument("--readers", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    if args.concurrent_rw:
+        results = {}
+        for profile in ("default", "tuned"):
+            results[profile] = concurrent_rw(profile, args.concurrent_rw, args.writers, args.readers)
+            print(f"{profile:8} {results[profile]}")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+    if args.sharded_writes:
+        results = {}
+        for shards in args.shards:
+            results[f"shards={shards}"] = sharded_writes(shards, args.sharded_writes, args.writers)
+            print(f"shards={shards:<4} {results[f'shards={shards}']}")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+    results = {}
+    with app.app_context():
+        for bus_count in args.buses:
+            for stations_per_route in args.stations:
+                size = f"buses={bus_count},stations={stations_per_route},history={args.history}"
+                print(size)
+                results[size] = run_size(bus_count, stations_per_route, args.history, args.repeat)
+                for name, r in results[size].items():
+                    print(f"  {name:40} {r['median_us']:>12.1f}us {r['queries']:>8} queries")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
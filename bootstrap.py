@@ -0,0 +1,88 @@
+"""One-time database bootstrap, kept out of the import path of app.py.
+
+Run it explicitly with ``flask --app main init-db`` or ``python bootstrap.py``;
+gunicorn.conf.py runs it once in the master before any worker forks. It is
+idempotent and serialized by an advisory lock, so concurrent deployments
+starting at the same time cannot race each other.
+"""
+import os
+import fcntl
+import logging
+from contextlib import contextmanager
+from sqlalchemy import text, inspect
+from app import app, db
+import locations
+
+# Arbitrary constant identifying this app's bootstrap lock in pg_advisory_lock
+INIT_LOCK_KEY = 0x62757374  # "bust"
+
+# (table, column, DDL type) added to existing tables since the first release
+ADDED_COLUMNS = [
+    ('bus_locations', 'sequence', 'BIGINT'),
+    ('buses', 'ingest_rate', 'FLOAT'),
+    ('buses', 'ingest_burst', 'INTEGER'),
+]
+
+@contextmanager
+def init_lock():
+    """Hold a cross-process lock for the duration of the bootstrap"""
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as conn:
+            conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': INIT_LOCK_KEY})
+            try:
+                yield
+            finally:
+                conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': INIT_LOCK_KEY})
+        return
+
+    os.makedirs(app.instance_path, exist_ok=True)
+    with open(os.path.join(app.instance_path, 'init.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def upgrade_schema():
+    """Add columns and indexes introduced after a database was first created.
+
+    create_all() only creates missing tables, so additive changes to
+    existing ones are applied here; each step checks before acting.
+    """
+    inspector = inspect(db.engine)
+    for table, column, ddl_type in ADDED_COLUMNS:
+        if column not in {c['name'] for c in inspector.get_columns(table)}:
+            with db.engine.begin() as conn:
+                conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, ddl_type)))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        locations.drop_replaced_indexes(conn)
+
+def init_db():
+    """Create missing tables and the default admin account"""
+    import models  # noqa: F401
+    from models import Admin
+
+    with app.app_context():
+        with init_lock():
+            db.create_all()
+            upgrade_schema()
+            if locations.sharded():
+                locations.create_shard_tables()
+
+            default_admin = Admin.query.filter_by(username='admin').first()
+            if not default_admin:
+                admin = Admin(username='admin')
+                admin.set_password('admin123')
+                db.session.add(admin)
+                db.session.commit()
+                logging.info("Default admin user created (username: admin, password: admin123)")
+        db.session.remove()
+        db.engine.dispose()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create tables and the default admin user."""
+    init_db()
+
+if __name__ == "__main__":
+    init_db()
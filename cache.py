@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from app import app, db
+from models import Bus, Station, Student
+
+DEFAULT_MAXSIZE = 1024
+DEFAULT_TTL = 60  # seconds; bounds staleness across gunicorn workers
+
+class LRUCache:
+    """Bounded read-through cache with least-recently-used eviction"""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """Return the cached value for key, calling loader on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > now:
+                self._data.move_to_end(key)
+                return entry[0]
+
+        value = loader(key)
+        if value is None:
+            # Never cache misses so newly created rows are visible immediately
+            return None
+
+        with self._lock:
+            self._data[key] = (value, now + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop a single key, or everything when key is None"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+def _snapshot(obj):
+    """Copy column values off an ORM object so it can outlive its session"""
+    if obj is None:
+        return None
+    return SimpleNamespace(**{
+        attr.key: getattr(obj, attr.key) for attr in obj.__mapper__.column_attrs
+    })
+
+def _loader(model):
+    def load(pk):
+        return _snapshot(model.query.get(pk))
+    return load
+
+def _load_route(bus_id):
+    stations = Station.query.filter_by(bus_id=bus_id).order_by(Station.order).all()
+    return [_snapshot(station) for station in stations]
+
+_maxsize = app.config.get('METADATA_CACHE_SIZE', DEFAULT_MAXSIZE)
+_ttl = app.config.get('METADATA_CACHE_TTL', DEFAULT_TTL)
+
+bus_cache = LRUCache(_maxsize, _ttl)
+student_cache = LRUCache(_maxsize, _ttl)
+station_cache = LRUCache(_maxsize, _ttl)
+route_cache = LRUCache(_maxsize, _ttl)
+station_students_cache = LRUCache(1, _ttl)
+
+_load_bus = _loader(Bus)
+_load_student = _loader(Student)
+_load_station = _loader(Station)
+
+def get_bus(bus_id):
+    """Cached bus metadata, or None if the bus does not exist"""
+    return bus_cache.get(bus_id, _load_bus)
+
+def get_student(student_id):
+    """Cached student metadata, or None if the student does not exist"""
+    return student_cache.get(student_id, _load_student)
+
+def get_station(station_id):
+    """Cached station metadata, or None if the station does not exist"""
+    return station_cache.get(station_id, _load_station)
+
+def get_route(bus_id):
+    """Cached, ordered station list for a bus"""
+    return route_cache.get(bus_id, _load_route)
+
+def _load_station_students(_key):
+    index = {}
+    for student_id, station_id in db.session.query(Student.student_id, Student.station_id):
+        index.setdefault(station_id, []).append(student_id)
+    return index
+
+def get_station_students(station_id):
+    """Ids of students picked up at a station, from one cached index of all students"""
+    return station_students_cache.get('index', _load_station_students).get(station_id, ())
+
+def invalidate_bus(bus_id):
+    bus_cache.invalidate(bus_id)
+
+def invalidate_student(student_id=None):
+    student_cache.invalidate(student_id)
+    station_students_cache.invalidate()
+
+def invalidate_station(station_id=None):
+    station_cache.invalidate(station_id)
+    # A station edit can move it between routes, so drop every cached route
+    route_cache.invalidate()
@@ -0,0 +1,147 @@
+"""Deleting buses without loading their GPS history.
+
+``db.session.delete(bus)`` cascades through Bus.locations, which loads every
+fix of the bus into memory and deletes them one row at a time in a single
+long transaction. Instead the history is removed DELETE_CHUNK_SIZE rows per
+transaction by a background thread, pausing between chunks so GPS ingest is
+never locked out for long; the stations and the bus row go last, together.
+
+Progress is kept in a Deletion row, updated in the same transaction as each
+chunk (right after it when history is sharded, see locations.py), so any
+worker can report it. Deleting is idempotent: if the worker
+running a deletion dies, its heartbeat stops and deleting the bus again
+resumes where it left off.
+
+Other workers (and gateway.py) keep the bus in their caches for a while
+after it is gone and may still store fixes for it: the insert fails on the
+foreign key where it is enforced and the device gets a 404, but SQLite and
+the shards take the row. Those fixes are swept right after the bus is
+deleted and once more when every cache has expired.
+"""
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from app import app, db
+from models import Bus, Station, Student, Deletion
+from locations import count_fixes, delete_fixes
+from cache import invalidate_bus, invalidate_station
+from stats import count
+
+SWEEP_MARGIN_SECONDS = 5  # on top of the cache lifetime, for uploads already past the lookup
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+class DeletionBlocked(ValueError):
+    """The bus or station still has students assigned to it"""
+
+def _check_no_students(**criteria):
+    count = db.session.query(db.func.count(Student.student_id)).filter_by(**criteria).scalar()
+    if count:
+        raise DeletionBlocked('%d student%s still assigned; reassign or delete them first'
+                              % (count, '' if count == 1 else 's'))
+
+def is_stalled(deletion):
+    """A running deletion whose worker has stopped updating it"""
+    limit = timedelta(seconds=app.config['DELETE_STALL_SECONDS'])
+    return deletion.status == RUNNING and datetime.utcnow() - deletion.updated_at > limit
+
+def running_deletions():
+    """bus_id -> Deletion for buses currently being deleted"""
+    return {deletion.bus_id: deletion for deletion in Deletion.query.filter_by(status=RUNNING)}
+
+def start_bus_deletion(bus, admin_id):
+    """Start (or resume) deleting a bus in the background; returns its Deletion"""
+    _check_no_students(bus_id=bus.bus_id)
+    deletion = Deletion.query.filter_by(bus_id=bus.bus_id, status=RUNNING).first()
+    if deletion is not None and not is_stalled(deletion):
+        return deletion
+    if deletion is None:
+        deletion = Deletion(bus_id=bus.bus_id, bus_number=bus.bus_number, created_by=admin_id, deleted=0)
+        db.session.add(deletion)
+    deletion.total = deletion.deleted + count_fixes(bus.bus_id)
+    deletion.updated_at = datetime.utcnow()
+    db.session.commit()
+    threading.Thread(target=_run, args=(deletion.id,), name='delete-bus-%d' % bus.bus_id, daemon=True).start()
+    return deletion
+
+def _run(deletion_id):
+    with app.app_context():
+        deletion = db.session.get(Deletion, deletion_id)
+        bus_id = deletion.bus_id
+        size = app.config['DELETE_CHUNK_SIZE']
+        done = False
+        try:
+            while True:
+                removed = delete_fixes(bus_id, size)
+                deletion.deleted += removed
+                deletion.updated_at = datetime.utcnow()
+                if removed < size:
+                    # Whatever arrived since the last chunk goes with the bus itself
+                    deletion.deleted += delete_fixes(bus_id)
+                    stations = db.session.execute(db.delete(Station).where(Station.bus_id == bus_id)).rowcount
+                    db.session.execute(db.delete(Bus).where(Bus.bus_id == bus_id))
+                    deletion.status = DONE
+                    db.session.commit()
+                    count('buses', -1)
+                    count('stations', -stations)
+                    done = True
+                    break
+                db.session.commit()
+                time.sleep(app.config['DELETE_PAUSE_SECONDS'])
+        except Exception as e:
+            db.session.rollback()
+            logger.exception("Deleting bus %s failed", bus_id)
+            deletion.status = FAILED
+            deletion.error = str(e)
+            db.session.commit()
+        finally:
+            invalidate_bus(bus_id)
+            invalidate_station()
+            db.session.remove()
+        if done:
+            _sweep_late_fixes(bus_id)
+
+def _sweep_late_fixes(bus_id):
+    """Delete fixes stored for a deleted bus by workers that still had it cached"""
+    lifetime = max(app.config['METADATA_CACHE_TTL'], app.config['GATEWAY_REGISTRY_TTL'])
+    try:
+        for delay in (0, lifetime + SWEEP_MARGIN_SECONDS):
+            time.sleep(delay)
+            removed = delete_fixes(bus_id)
+            db.session.commit()
+            if removed:
+                logger.info("Removed %d late fix(es) of deleted bus %s", removed, bus_id)
+    except Exception:
+        db.session.rollback()
+        logger.exception("Sweeping late fixes of deleted bus %s failed", bus_id)
+    finally:
+        db.session.remove()
+
+def remove_station(station):
+    """Delete one station with a single statement instead of an ORM cascade"""
+    _check_no_students(station_id=station.station_id)
+    db.session.execute(db.delete(Station).where(Station.station_id == station.station_id))
+    db.session.commit()
+    count('stations', -1)
+    invalidate_station(station.station_id)
+
+def deletion_document(deletion):
+    if deletion.total:
+        progress = min(1.0, deletion.deleted / deletion.total)
+    else:
+        progress = 1.0 if deletion.status == DONE else 0.0
+    return {
+        'id': deletion.id,
+        'bus_id': deletion.bus_id,
+        'bus_number': deletion.bus_number,
+        'status': 'stalled' if is_stalled(deletion) else deletion.status,
+        'total': deletion.total,
+        'deleted': deletion.deleted,
+        'progress': round(progress, 3),
+        'error': deletion.error,
+    }
@@ -0,0 +1,60 @@
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# DB_PROFILE=tuned (default) applies the settings below; DB_PROFILE=default
+# leaves SQLAlchemy and the driver at their stock behaviour.
+DEFAULT_PROFILE = 'tuned'
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def current_profile():
+    return os.environ.get('DB_PROFILE', DEFAULT_PROFILE)
+
+def sqlite_pragmas():
+    """Per-connection pragmas letting GPS writes and student reads overlap"""
+    return {
+        'journal_mode': 'WAL',  # readers no longer block on the writer
+        'synchronous': 'NORMAL',  # fsync at checkpoints only; safe with WAL
+        'busy_timeout': _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000),
+        'mmap_size': _env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+        'cache_size': -_env_int('SQLITE_CACHE_SIZE_KB', 64 * 1024),  # negative means KiB
+        'temp_store': 'MEMORY',
+    }
+
+def engine_options(uri, profile=None):
+    """SQLALCHEMY_ENGINE_OPTIONS for the database behind uri"""
+    if (profile or current_profile()) != 'tuned':
+        return {}
+
+    backend = make_url(uri).get_backend_name()
+    if backend == 'postgresql':
+        statement_timeout = _env_int('DB_STATEMENT_TIMEOUT_MS', 5000)
+        idle_timeout = _env_int('DB_IDLE_IN_TRANSACTION_TIMEOUT_MS', 30000)
+        return {
+            'pool_size': _env_int('DB_POOL_SIZE', 5),
+            'max_overflow': _env_int('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': _env_int('DB_POOL_TIMEOUT', 10),
+            'pool_recycle': _env_int('DB_POOL_RECYCLE', 300),
+            'pool_pre_ping': True,
+            'connect_args': {
+                'options': '-c statement_timeout=%d -c idle_in_transaction_session_timeout=%d'
+                           % (statement_timeout, idle_timeout),
+            },
+        }
+    return {}
+
+def apply_engine_profile(engine, profile=None):
+    """Install connect-time settings that cannot be passed as engine options"""
+    if (profile or current_profile()) != 'tuned' or engine.dialect.name != 'sqlite':
+        return
+
+    pragmas = sqlite_pragmas()
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s=%s' % (name, value))
+        cursor.close()
@@ -0,0 +1,240 @@
+"""Background watchdog that notices when a bus's GPS feed goes silent.
+
+Every bus has one pending deadline in a min-heap: STALE_BUS_SECONDS after its
+newest fix while it is active, FEED_OFFLINE_SECONDS after it once it is
+stale. Ingest only records the newest fix time (and pushes a deadline when
+the bus has none pending), and a thread sleeps until the earliest deadline,
+so nothing ever scans bus_locations after the one query that seeds the heap.
+
+Each worker runs its own watchdog; with FEED_STATE_FILE set (gunicorn.conf.py
+does this) newest fix times are shared through shared_slots.py, so a worker
+re-checks the shared time before declaring a bus stale and all workers agree.
+With FEED_DELAY_NOTICE enabled a bus going stale posts a delay Notice; the
+shared slot records which fix a notice was sent for, so only one worker
+posts it.
+"""
+import os
+import time
+import heapq
+import struct
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from app import app, db
+from models import Admin, Bus, Notice
+from locations import newest_fix_times
+from cache import get_bus
+from shared_slots import SlotFile
+from stats import count
+
+ACTIVE = 'active'
+STALE = 'stale'
+OFFLINE = 'offline'
+UNKNOWN = 'unknown'  # never reported a fix
+
+SLOT = struct.Struct('<qdd')  # bus_id, newest fix time, fix time a delay notice was posted for
+
+logger = logging.getLogger(__name__)
+
+def _unix_time(timestamp):
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+class FeedWatchdog:
+    def __init__(self, stale_after, offline_after, slots=None):
+        self.stale_after = stale_after
+        self.offline_after = offline_after
+        self._slots = slots
+        self._heap = []  # (deadline, bus_id)
+        self._next = {}  # bus_id -> its live deadline; other heap entries are superseded
+        self._last = {}  # bus_id -> newest fix time known to this process
+        self._state = {}
+        self._notified = {}  # delay notices posted, when there is no shared file
+        self._cond = threading.Condition()
+
+    def _schedule(self, bus_id, deadline):
+        if self._next.get(bus_id, float('inf')) <= deadline:
+            return  # an earlier check is already pending and will reschedule
+        self._next[bus_id] = deadline
+        heapq.heappush(self._heap, (deadline, bus_id))
+        if self._heap[0][1] == bus_id:
+            self._cond.notify()
+
+    def _observe(self, bus_id, fix_time, now):
+        """Merge a fix time into this process's view; caller holds the condition"""
+        if fix_time <= self._last.get(bus_id, 0):
+            return
+        self._last[bus_id] = fix_time
+        self._evaluate(bus_id, now)
+
+    def _shared_time(self, bus_id):
+        if self._slots is None:
+            return 0.0
+        with self._slots.slot(bus_id) as (read, write):
+            owner, last, notified = read()
+        return last if owner == bus_id else 0.0
+
+    def seen(self, bus_id, fix_time):
+        """Record the newest fix of a stored upload"""
+        if self._slots is not None:
+            with self._slots.slot(bus_id) as (read, write):
+                owner, last, notified = read()
+                if owner != bus_id:
+                    last = notified = 0.0
+                if fix_time > last:
+                    write(bus_id, fix_time, notified)
+        with self._cond:
+            self._observe(bus_id, fix_time, time.time())
+
+    def status(self, bus_id):
+        """ACTIVE, STALE, OFFLINE or UNKNOWN for one bus"""
+        state = self._state.get(bus_id)
+        if state == ACTIVE:
+            return state
+        # Another worker may have stored a fix since this one last looked
+        shared = self._shared_time(bus_id)
+        with self._cond:
+            if shared:
+                self._observe(bus_id, shared, time.time())
+            return self._state.get(bus_id, UNKNOWN)
+
+    def counts(self, bus_ids):
+        """Number of buses in each state"""
+        totals = {ACTIVE: 0, STALE: 0, OFFLINE: 0, UNKNOWN: 0}
+        for bus_id in bus_ids:
+            totals[self.status(bus_id)] += 1
+        return totals
+
+    def _evaluate(self, bus_id, now):
+        """Set a bus's state from the age of its newest fix and schedule its next check"""
+        age = now - self._last[bus_id]
+        if age < self.stale_after:
+            state = ACTIVE
+            self._schedule(bus_id, self._last[bus_id] + self.stale_after)
+        elif age < self.offline_after:
+            state = STALE
+            self._schedule(bus_id, self._last[bus_id] + self.offline_after)
+        else:
+            state = OFFLINE
+        self._state[bus_id] = state
+        return state
+
+    def _due(self):
+        """Wait for the earliest deadline; returns [(bus_id, old state, new state)]"""
+        with self._cond:
+            while not self._heap or self._heap[0][0] > time.time():
+                self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, bus_id = heapq.heappop(self._heap)
+                if self._next.get(bus_id) != deadline:
+                    continue
+                del self._next[bus_id]
+                due.append(bus_id)
+        shared = {bus_id: self._shared_time(bus_id) for bus_id in due}
+
+        changes = []
+        with self._cond:
+            for bus_id in due:
+                old = self._state.get(bus_id)
+                self._observe(bus_id, shared[bus_id], now)
+                new = self._evaluate(bus_id, now)
+                if new != old:
+                    changes.append((bus_id, old, new))
+        return changes
+
+    def seed(self):
+        """Load every bus's newest fix once at startup"""
+        rows = newest_fix_times()
+        now = time.time()
+        with self._cond:
+            for bus_id, newest in rows:
+                self._observe(bus_id, _unix_time(newest), now)
+
+    def _claim_notice(self, bus_id):
+        """True for exactly one worker per silent stretch of a bus's feed"""
+        last = self._last[bus_id]
+        if self._slots is None:
+            if self._notified.get(bus_id) == last:
+                return False
+            self._notified[bus_id] = last
+            return True
+        with self._slots.slot(bus_id) as (read, write):
+            owner, shared_last, notified = read()
+            if owner != bus_id or shared_last != last or notified == last:
+                return False
+            write(bus_id, shared_last, last)
+        return True
+
+    def post_delay_notice(self, bus_id):
+        if not self._claim_notice(bus_id):
+            return
+        bus = get_bus(bus_id)
+        admin = Admin.query.order_by(Admin.id).first()
+        if not bus or not admin:
+            return
+        last_seen = datetime.utcfromtimestamp(self._last[bus_id])
+        notice = Notice(
+            title='Bus %s may be delayed' % bus.bus_number,
+            message='Bus %s has not reported its location since %s UTC. '
+                    'Expect delays until tracking resumes.' % (bus.bus_number, last_seen.strftime('%H:%M')),
+            notice_type='delay',
+            created_by=admin.id,
+            expires_at=datetime.utcnow() + timedelta(minutes=app.config['FEED_NOTICE_MINUTES']),
+        )
+        db.session.add(notice)
+        db.session.commit()
+        count('active_notices')
+
+    def run(self):
+        with app.app_context():
+            try:
+                self.seed()
+            except Exception:
+                logger.exception("Could not seed the feed watchdog")
+            finally:
+                db.session.remove()
+        while True:
+            for bus_id, old, new in self._due():
+                logger.info("Bus %s GPS feed is %s (was %s)", bus_id, new, old or UNKNOWN)
+                if new == STALE and old == ACTIVE and app.config['FEED_DELAY_NOTICE']:
+                    with app.app_context():
+                        try:
+                            self.post_delay_notice(bus_id)
+                        except Exception:
+                            db.session.rollback()
+                            logger.exception("Could not post a delay notice for bus %s", bus_id)
+                        finally:
+                            db.session.remove()
+
+_watchdog = None
+_owner_pid = None
+_start_lock = threading.Lock()
+
+def get_watchdog():
+    """This process's watchdog, started on first use after a fork"""
+    global _watchdog, _owner_pid
+    pid = os.getpid()
+    if _owner_pid != pid:
+        with _start_lock:
+            if _owner_pid != pid:
+                path = app.config.get('FEED_STATE_FILE')
+                _watchdog = FeedWatchdog(app.config['STALE_BUS_SECONDS'], app.config['FEED_OFFLINE_SECONDS'],
+                                         SlotFile(path, SLOT) if path else None)
+                threading.Thread(target=_watchdog.run, name='feed-watchdog', daemon=True).start()
+                _owner_pid = pid
+    return _watchdog
+
+def record_fix_time(bus_id, fix_time):
+    get_watchdog().seen(bus_id, fix_time)
+
+def feed_status(bus_id):
+    return get_watchdog().status(bus_id)
+
+def fleet_counts():
+    """Number of buses in each feed state; reads only the small buses table"""
+    return get_watchdog().counts(bus_id for bus_id, in db.session.query(Bus.bus_id))
+
+@app.before_request
+def start_watchdog():
+    get_watchdog()
@@ -0,0 +1,97 @@
+"""Cached fragments of rendered templates.
+
+``{% cache 'name', version, ... %} ... {% endcache %}`` renders its body once
+per distinct key and serves the stored markup after that. Keys list the
+versions of everything the fragment shows, so a change simply produces a key
+that misses; superseded entries age out of the LRU. Anything expensive the
+body needs should be computed inside the block (for example by calling a
+function the view passed in) so a hit skips it too.
+
+Versions used by the student dashboard:
+
+* position: id of the bus's newest fix, which the view reads anyway
+* route: the contents of the cached route snapshot (see cache.get_route)
+* notices: a counter bumped after every commit that touches a Notice. With
+  FRAGMENT_STATE_FILE set (gunicorn.conf.py does this) it is shared by all
+  workers. Entries also expire after FRAGMENT_CACHE_TTL, which bounds how
+  long a notice can outlive its expiry time.
+"""
+import struct
+import threading
+from jinja2 import nodes
+from jinja2.ext import Extension
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import app
+from models import Notice
+from cache import LRUCache
+from shared_slots import MappedFile
+
+VERSION = struct.Struct('<q')
+
+fragment_cache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(key)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        return fragment_cache.get(tuple(key), lambda _key: caller())
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+class VersionCounter:
+    """A number every worker sees, bumped when the data behind it changes"""
+
+    def __init__(self, path=None):
+        self._file = MappedFile(path, VERSION.size) if path else None
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._file is None:
+            return self._value
+        with self._file.locked(0, VERSION.size) as data:
+            return VERSION.unpack_from(data, 0)[0]
+
+    def bump(self):
+        if self._file is None:
+            with self._lock:
+                self._value += 1
+            return
+        with self._file.locked(0, VERSION.size) as data:
+            VERSION.pack_into(data, 0, VERSION.unpack_from(data, 0)[0] + 1)
+
+_notices = VersionCounter(app.config['FRAGMENT_STATE_FILE'])
+
+def notice_version():
+    return _notices.get()
+
+def route_version(route):
+    """Changes whenever anything the route fragment shows about a station does"""
+    return hash(tuple((station.station_id, station.station_name, station.latitude, station.longitude, station.order)
+                      for station in route))
+
+def position_version(location):
+    return location.bus_location_id if location is not None else 0
+
+@event.listens_for(Session, 'after_flush')
+def _note_notice_changes(session, flush_context):
+    if any(isinstance(obj, Notice) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info['notices_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _bump_notice_version(session):
+    if session.info.pop('notices_changed', False):
+        _notices.bump()
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_notice_changes(session):
+    session.info.pop('notices_changed', None)
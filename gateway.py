@@ -0,0 +1,377 @@
+"""Standalone asyncio server for GPS uploads, separate from the web workers.
+
+Serves the same contract as the Flask routes in ingest.py, on its own port:
+
+    POST /bus/<id>/location      (also /api/bus/<id>/location)
+    POST /bus/<id>/locations     (also /api/bus/<id>/locations)
+
+with the same encodings, rate limits and response bodies, so devices can be
+pointed at it without changes while dashboards keep the gunicorn workers to
+themselves. Run it next to gunicorn:
+
+    python gateway.py --port 8001
+
+One event loop holds every device connection (HTTP/1.1 keep-alive, bodies
+sent with Content-Length); an idle connection costs a few kilobytes and no
+thread. Uploads are checked on the loop against a registry of all buses
+reloaded every GATEWAY_REGISTRY_TTL seconds (and at most once a second when
+an unknown bus id shows up, so new buses are picked up quickly), then handed
+to one writer thread. The writer inserts whatever has queued up, up to
+GATEWAY_BATCH_SIZE fixes, in one transaction (one per shard with
+LOCATION_SHARDS, see locations.py) and only then answers the devices, so a
+200 still means the fix is stored. When GATEWAY_QUEUE_SIZE uploads are
+waiting devices get a 503 with Retry-After instead.
+
+Rate-limit buckets, feed times, arrival flags and dashboard counters are
+shared with gunicorn's workers through the same temp files it creates (see
+shared_slots.py), so start gunicorn first or set those variables for both.
+"""
+import os
+import re
+import sys
+import json
+import time
+import queue
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+from http import HTTPStatus
+from sqlalchemy.exc import IntegrityError
+from shared_slots import use_shared_files
+
+# Must be set before app.py is imported; it reads them into app.config
+use_shared_files()
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "bustrack-metrics"))
+
+from app import app, db  # noqa: E402
+from models import Bus  # noqa: E402
+from ratelimit import take_token  # noqa: E402
+from stats import count, fixes_today  # noqa: E402
+from metrics import record_rejected_fix, record_late_fix  # noqa: E402
+from locations import store_rows  # noqa: E402
+from ingest import (IngestError, parse_body, check_fixes, prepare_rows, fixes_committed,  # noqa: E402
+                    bus_not_found, error_response, stored_response, ingest_log)
+
+ROUTE = re.compile(r'^(?:/api)?/bus/(\d+)/location(s?)$')
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024  # comfortably above MAX_BATCH_SIZE fixes as JSON
+MISS_RELOAD_SECONDS = 1
+OVERLOAD_RETRY_SECONDS = 1.0
+BACKLOG = 4096
+
+logger = logging.getLogger(__name__)
+
+class BusRegistry:
+    """bus_id -> (bus_id, ingest_rate, ingest_burst) for every bus, for checks on the loop"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._buses = {}
+        self._loaded_at = 0.0
+        self._reload = None
+
+    def load(self):
+        """Read the buses table; runs in a thread since it blocks"""
+        with app.app_context():
+            buses = {row.bus_id: row for row in db.session.query(Bus.bus_id, Bus.ingest_rate, Bus.ingest_burst)}
+        self._buses = buses
+        self._loaded_at = time.monotonic()
+
+    async def reload(self):
+        """Reload in a thread; concurrent callers share one reload"""
+        if self._reload is None:
+            self._reload = asyncio.get_running_loop().run_in_executor(None, self.load)
+            self._reload.add_done_callback(lambda _future: setattr(self, '_reload', None))
+        await asyncio.shield(self._reload)
+
+    async def get(self, bus_id):
+        bus = self._buses.get(bus_id)
+        if bus is None and time.monotonic() - self._loaded_at > MISS_RELOAD_SECONDS:
+            await self.reload()
+            bus = self._buses.get(bus_id)
+        return bus
+
+    def forget(self, bus_ids):
+        """Drop buses found to be deleted before the next reload notices"""
+        for bus_id in bus_ids:
+            self._buses.pop(bus_id, None)
+
+    async def refresh(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Could not reload the bus registry")
+
+def _resolve(future, result=None, error=None):
+    """Complete an upload's future on the loop, unless its device already hung up"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class BatchWriter:
+    """One thread writing queued uploads to bus_locations, a batch per transaction"""
+
+    def __init__(self, loop, registry, batch_size, batch_wait, queue_size):
+        self.loop = loop
+        self.registry = registry
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue(queue_size)
+
+    def start(self):
+        threading.Thread(target=self._run, name='gateway-writer', daemon=True).start()
+
+    def submit(self, bus_id, fixes, received):
+        """Queue checked fixes; the returned future gives (stored, duplicates)"""
+        future = self.loop.create_future()
+        try:
+            self._queue.put_nowait((bus_id, fixes, received, future))
+        except queue.Full:
+            raise IngestError('Server busy', status=503, reason='overloaded', retry_after=OVERLOAD_RETRY_SECONDS)
+        return future
+
+    def _take(self):
+        """Block for one upload, then take whatever else arrives within batch_wait"""
+        uploads = [self._queue.get()]
+        size = len(uploads[0][1])
+        deadline = time.monotonic() + self.batch_wait
+        while size < self.batch_size:
+            try:
+                upload = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            uploads.append(upload)
+            size += len(upload[1])
+        return uploads
+
+    def _run(self):
+        while True:
+            uploads = self._take()
+            with app.app_context():
+                try:
+                    results = self._write(uploads)
+                except Exception as e:
+                    db.session.rollback()
+                    ingest_log.exception("Failed to store %d location upload(s)", len(uploads))
+                    for upload in uploads:
+                        self.loop.call_soon_threadsafe(_resolve, upload[3], None, e)
+                    continue
+            for upload, result in zip(uploads, results):
+                if isinstance(result, IngestError):
+                    self.loop.call_soon_threadsafe(_resolve, upload[3], None, result)
+                else:
+                    self.loop.call_soon_threadsafe(_resolve, upload[3], result)
+
+    def _store(self, uploads, groups):
+        """store_rows() and commit; returns (stored per group, ids of buses found deleted)"""
+        try:
+            stored = store_rows(groups)
+            db.session.commit()
+            return stored, set()
+        except IntegrityError:
+            # A bus deleted since the registry loaded it (see deletion.py); write the others
+            db.session.rollback()
+        bus_ids = {upload[0] for upload in uploads}
+        existing = {bus_id for bus_id, in db.session.query(Bus.bus_id).filter(Bus.bus_id.in_(bus_ids))}
+        deleted = bus_ids - existing
+        self.loop.call_soon_threadsafe(self.registry.forget, deleted)
+        stored = store_rows([rows if upload[0] in existing else [] for upload, rows in zip(uploads, groups)])
+        db.session.commit()
+        return stored, deleted
+
+    def _write(self, uploads):
+        """Insert every upload's new rows in one transaction.
+
+        Returns (stored, duplicates) per upload, or an IngestError for uploads
+        to buses that no longer exist.
+        """
+        prepared = []
+        seen = set()  # sequence keys already in this batch, e.g. a retry of a queued upload
+        for bus_id, fixes, received, _future in uploads:
+            rows, keys, duplicates, late = prepare_rows(bus_id, fixes, received)
+            kept = []
+            for row in rows:
+                if row['sequence'] is not None:
+                    key = (bus_id, row['sequence'], row['timestamp'])
+                    if key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(key)
+                kept.append(row)
+            prepared.append((kept, keys, duplicates, late))
+
+        stored, deleted = self._store(uploads, [rows for rows, _keys, _duplicates, _late in prepared])
+        count('fixes_today', sum(fixes_today(rows, saved)
+                                 for (rows, _keys, _duplicates, _late), saved in zip(prepared, stored)))
+
+        results = []
+        for (bus_id, fixes, received, _future), (rows, keys, duplicates, late), saved in zip(uploads, prepared, stored):
+            if bus_id in deleted:
+                results.append(bus_not_found())
+                continue
+            if rows:
+                try:
+                    fixes_committed(bus_id, fixes, rows, keys, saved, received)
+                except Exception:
+                    ingest_log.exception("Post-commit hooks failed for bus %s", bus_id)
+            duplicates += len(rows) - saved
+            if duplicates:
+                record_rejected_fix('duplicate', duplicates)
+            if late:
+                record_late_fix(late)
+            results.append((saved, duplicates))
+        return results
+
+class Gateway:
+    def __init__(self, registry, writer, idle_timeout):
+        self.registry = registry
+        self.writer = writer
+        self.idle_timeout = idle_timeout
+
+    async def ingest(self, bus_id, mimetype, body, batch):
+        """The gateway's ingest.ingest(); returns (body, status, headers)"""
+        try:
+            bus = await self.registry.get(bus_id)
+            if bus is None:
+                raise bus_not_found()
+            wait = take_token(bus)
+            if wait:
+                raise IngestError('Rate limit exceeded', status=429, reason='rate_limited', retry_after=wait)
+            fixes = parse_body(mimetype, body, batch)
+            received = time.time()
+            check_fixes(fixes, received)
+            stored, duplicates = await self.writer.submit(bus_id, fixes, received)
+        except IngestError as e:
+            return error_response(e)
+        except Exception:
+            record_rejected_fix('error')
+            ingest_log.exception("Failed to store location for bus %s", bus_id)
+            return {'error': 'Internal server error'}, 500, {}
+        return stored_response(stored, duplicates, batch)
+
+    async def dispatch(self, method, target, headers, body):
+        match = ROUTE.match(target.split('?', 1)[0])
+        if match is None:
+            return {'error': 'Not found'}, 404, {}
+        if method != 'POST':
+            return {'error': 'Method not allowed'}, 405, {'Allow': 'POST'}
+        mimetype = headers.get('content-type', '').split(';', 1)[0].strip().lower()
+        return await self.ingest(int(match.group(1)), mimetype, body, bool(match.group(2)))
+
+    async def handle(self, reader, writer):
+        """Serve requests on one connection until either side closes it"""
+        try:
+            while await self._serve_one(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_one(self, reader, writer):
+        """Answer one request; returns whether to keep the connection open"""
+        try:
+            async with asyncio.timeout(self.idle_timeout):
+                head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            await _respond(writer, {'error': 'Request headers too large'}, 431, {}, False)
+            return False
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            await _respond(writer, {'error': 'Bad request'}, 400, {}, False)
+            return False
+        method, target, version = parts
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        if 'transfer-encoding' in headers:
+            await _respond(writer, {'error': 'Send the body with a Content-Length'}, 411, {}, False)
+            return False
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            await _respond(writer, {'error': 'Bad request'}, 400, {}, False)
+            return False
+        if length > MAX_BODY_BYTES:
+            await _respond(writer, {'error': 'Request body too large'}, 413, {}, False)
+            return False
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        async with asyncio.timeout(self.idle_timeout):
+            body = await reader.readexactly(length)
+
+        response, status, extra = await self.dispatch(method, target, headers, body)
+        await _respond(writer, response, status, extra, keep_alive)
+        return keep_alive
+
+async def _respond(writer, body, status, headers, keep_alive):
+    payload = json.dumps(body).encode()
+    lines = ['HTTP/1.1 %d %s' % (status, HTTPStatus(status).phrase),
+             'Content-Type: application/json',
+             'Content-Length: %d' % len(payload)]
+    if not keep_alive:
+        lines.append('Connection: close')
+    lines.extend('%s: %s' % header for header in headers.items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+    await writer.drain()
+
+def raise_open_file_limit():
+    """Every connection is a file descriptor; allow as many as the hard limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            return soft
+        return hard
+    return soft
+
+async def serve(host, port):
+    loop = asyncio.get_running_loop()
+    config = app.config
+    registry = BusRegistry(config['GATEWAY_REGISTRY_TTL'])
+    await registry.reload()
+    writer = BatchWriter(loop, registry, config['GATEWAY_BATCH_SIZE'], config['GATEWAY_BATCH_WAIT'],
+                         config['GATEWAY_QUEUE_SIZE'])
+    writer.start()
+    gateway = Gateway(registry, writer, config['GATEWAY_IDLE_TIMEOUT'])
+    server = await asyncio.start_server(gateway.handle, host, port, limit=MAX_HEADER_BYTES, backlog=BACKLOG)
+    refresh = asyncio.create_task(registry.refresh())
+    logger.info("GPS gateway listening on %s",
+                ', '.join('%s:%s' % sock.getsockname()[:2] for sock in server.sockets))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        refresh.cancel()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Standalone asyncio GPS ingest server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("GATEWAY_PORT", 8001)))
+    args = parser.parse_args(argv)
+    limit = raise_open_file_limit()
+    logger.info("GPS gateway can hold about %d connections (open file limit)", limit)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    sys.exit(main())
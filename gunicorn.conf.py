@@ -0,0 +1,32 @@
+# Picked up automatically by gunicorn when started from the project root
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from shared_slots import use_shared_files  # noqa: E402  stdlib only; the master never imports the app
+
+# Threaded workers, so clients holding an event stream or long-poll open
+# (arrivals.py) do not each tie up a whole process. The app lets at most
+# EVENT_WAIT_SLOTS requests wait on events; those threads come on top of
+# GUNICORN_THREADS so everything else keeps the full pool.
+threads = int(os.environ.get("GUNICORN_THREADS", 8)) + int(os.environ.get("EVENT_WAIT_SLOTS", 4))
+
+def on_starting(server):
+    """Prepare shared state once in the master before any worker starts"""
+    metrics_dir = os.environ.setdefault(
+        "METRICS_DIR", os.path.join(tempfile.gettempdir(), "bustrack-metrics")
+    )
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    # Per-bus state shared by all workers (see shared_slots.py), reset on every start
+    use_shared_files(reset=True)
+
+    # Bootstrap the database once, in a child process so the master never
+    # imports the app and workers fork without inherited DB connections
+    if os.environ.get("AUTO_INIT_DB", "1") == "1":
+        bootstrap = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bootstrap.py")
+        subprocess.run([sys.executable, bootstrap], check=True)
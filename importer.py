@@ -0,0 +1,214 @@
+"""Bulk CSV import of stations and students for the admin pages.
+
+The file is read row by row and handled IMPORT_CHUNK_SIZE rows at a time:
+each row is validated against lookup tables loaded once per import (bus
+numbers, station names per bus, existing usernames), the chunk's passwords
+are hashed in a process pool across all cores (see passwords.py; the pool
+lives as long as the import), and the valid rows go in with
+one bulk INSERT and one commit. Rows that fail validation, or cannot be read as
+CSV or UTF-8, are reported with their line number and skipped; every other
+row is imported. Only a problem with the header rejects the whole file.
+
+Station CSV columns: station_name, latitude, longitude, bus_number, order
+Student CSV columns: username, password, name, bus_number, station_name
+"""
+import io
+import re
+import csv
+import os
+from collections import namedtuple
+from itertools import islice
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from passwords import PasswordHasher
+from models import Bus, Station, Student
+from cache import invalidate_station, invalidate_student
+from stats import count
+
+STATION_COLUMNS = ('station_name', 'latitude', 'longitude', 'bus_number', 'order')
+STUDENT_COLUMNS = ('username', 'password', 'name', 'bus_number', 'station_name')
+
+# Bytes that are not UTF-8 decode to lone surrogates with errors='surrogateescape'
+UNDECODABLE = re.compile('[\udc80-\udcff]')
+
+ImportResult = namedtuple('ImportResult', 'created failed errors')  # errors: [(line, message)], capped
+
+class CSVImportError(ValueError):
+    """The file as a whole cannot be imported (not CSV, missing columns)"""
+
+class RowError(ValueError):
+    pass
+
+def _required(row, column, max_length=None):
+    value = (row.get(column) or '').strip()
+    if not value:
+        raise RowError('%s is required' % column)
+    if max_length and len(value) > max_length:
+        raise RowError('%s is longer than %d characters' % (column, max_length))
+    return value
+
+def _number(row, column, convert, low=None, high=None):
+    value = _required(row, column)
+    try:
+        number = convert(value)
+    except ValueError:
+        raise RowError('%s is not a valid number' % column)
+    if (low is not None and number < low) or (high is not None and number > high):
+        raise RowError('%s is out of range' % column)
+    return number
+
+def _bus_ids():
+    return {number: bus_id for bus_id, number in db.session.query(Bus.bus_id, Bus.bus_number)}
+
+def _station_ids():
+    """(bus_id, station name) -> station_id; None where a bus has two stations of that name"""
+    stations = {}
+    for station_id, bus_id, name in db.session.query(Station.station_id, Station.bus_id, Station.station_name):
+        key = (bus_id, name)
+        stations[key] = None if key in stations else station_id
+    return stations
+
+def _hash_workers():
+    return app.config['IMPORT_HASH_WORKERS'] or os.cpu_count() or 1
+
+def _undecodable(values):
+    return any(isinstance(value, str) and UNDECODABLE.search(value) for value in values)
+
+def _read_rows(stream, columns):
+    """(line number, row dict) for each data row of a CSV byte stream.
+
+    A line that cannot be read comes back with a RowError instead of a row,
+    so the lines after it are still imported.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='surrogateescape', newline='')
+    reader = csv.DictReader(text)
+    try:
+        header = reader.fieldnames or ()
+    except csv.Error:
+        header = None
+    if header is None or _undecodable(header):
+        raise CSVImportError('The file is not a UTF-8 CSV file')
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise CSVImportError('Missing columns: %s' % ', '.join(missing))
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield reader.line_num, RowError('Unreadable CSV: %s' % e)
+            continue
+        if _undecodable(row.values()):
+            yield reader.line_num, RowError('Line is not valid UTF-8')
+            continue
+        yield reader.line_num, row
+
+class _Report:
+    def __init__(self):
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < app.config['IMPORT_MAX_ERRORS']:
+            self.errors.append((line, message))
+
+    def result(self):
+        return ImportResult(self.created, self.failed, self.errors)
+
+def _run_import(stream, columns, parse, prepare, model, counter):
+    """Validate rows with `parse`, finish each chunk with `prepare`, bulk insert into `model`"""
+    report = _Report()
+    rows = _read_rows(stream, columns)
+    while True:
+        chunk = list(islice(rows, app.config['IMPORT_CHUNK_SIZE']))
+        if not chunk:
+            return report.result()
+        lines, values = [], []
+        for line, row in chunk:
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                values.append(parse(row))
+                lines.append(line)
+            except RowError as e:
+                report.error(line, str(e))
+        if not values:
+            continue
+        values = prepare(values)
+        try:
+            db.session.execute(db.insert(model), values)
+            db.session.commit()
+        except IntegrityError:
+            # Only a concurrent edit can get here; the chunk is all or nothing
+            db.session.rollback()
+            for line in lines:
+                report.error(line, 'Not imported: conflicts with a change made during the import')
+            continue
+        report.created += len(values)
+        count(counter, len(values))
+
+def import_stations(stream):
+    """Import stations from a CSV byte stream; returns an ImportResult"""
+    buses = _bus_ids()
+
+    def parse(row):
+        bus_id = buses.get(_required(row, 'bus_number'))
+        if bus_id is None:
+            raise RowError('Unknown bus %s' % row['bus_number'].strip())
+        return {
+            'station_name': _required(row, 'station_name', 100),
+            'latitude': _number(row, 'latitude', float, -90, 90),
+            'longitude': _number(row, 'longitude', float, -180, 180),
+            'order': _number(row, 'order', int, 0),
+            'bus_id': bus_id,
+        }
+
+    try:
+        return _run_import(stream, STATION_COLUMNS, parse, lambda values: values, Station, 'stations')
+    finally:
+        invalidate_station()
+
+def import_students(stream):
+    """Import students from a CSV byte stream; returns an ImportResult"""
+    buses = _bus_ids()
+    stations = _station_ids()
+    usernames = {username for username, in db.session.query(Student.username)}
+
+    def parse(row):
+        username = _required(row, 'username', 80)
+        if username in usernames:
+            raise RowError('Username %s already exists' % username)
+        bus_number = _required(row, 'bus_number')
+        bus_id = buses.get(bus_number)
+        if bus_id is None:
+            raise RowError('Unknown bus %s' % bus_number)
+        station_name = _required(row, 'station_name')
+        key = (bus_id, station_name)
+        if key not in stations:
+            raise RowError('Bus %s has no station %s' % (bus_number, station_name))
+        if stations[key] is None:
+            raise RowError('Bus %s has more than one station named %s' % (bus_number, station_name))
+        student = {
+            'username': username,
+            'password': _required(row, 'password'),
+            'name': _required(row, 'name', 100),
+            'bus_id': bus_id,
+            'station_id': stations[key],
+        }
+        usernames.add(username)
+        return student
+
+    def prepare(values):
+        hashes = hasher.hash([value.pop('password') for value in values])
+        for value, password_hash in zip(values, hashes):
+            value['password_hash'] = password_hash
+        return values
+
+    try:
+        with PasswordHasher(_hash_workers()) as hasher:
+            return _run_import(stream, STUDENT_COLUMNS, parse, prepare, Student, 'students')
+    finally:
+        invalidate_student()
@@ -0,0 +1,294 @@
+"""GPS fix ingestion shared by the app route and the REST API.
+
+Devices may post JSON/form fields ``latitude`` and ``longitude`` (plus an
+optional device ``timestamp`` and per-bus sequence number ``seq``) or, to save
+bandwidth on poor mobile links, the binary format described in gps_codec.py.
+Re-sent fixes with a sequence number are stored once; a ``seq`` must come with
+a ``timestamp``, since the two together identify the fix.
+
+Uploads are rate limited per bus (see ratelimit.py). An over-limit upload is
+answered with 429, a ``Retry-After`` header in whole seconds and the exact
+wait as ``retry_after`` in the body; devices should hold their fixes for at
+least that long and send them together to the batch endpoint.
+
+gateway.py serves the same contract from a standalone asyncio server, using
+the pieces of store_fixes() with its own batched writer.
+"""
+import json
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl
+from sqlalchemy.exc import IntegrityError
+from app import db
+from cache import get_bus, invalidate_bus
+from locations import store_rows
+from ratelimit import take_token, retry_after_header
+from feed_watchdog import record_fix_time
+from arrivals import check_arrivals
+from stats import count, fixes_today
+from metrics import record_fix, record_rejected_fix, record_late_fix
+from logging_setup import INGEST_LOGGER
+from gps_codec import BINARY_MIMETYPE, CodecError, decode_binary
+
+MAX_BATCH_SIZE = 1000
+SEQUENCE_WINDOW_SIZE = 256  # recent sequence numbers remembered per bus
+MAX_CLOCK_SKEW = 300  # seconds a device clock may run ahead of ours
+INVALID_COORDINATES = 'Invalid latitude or longitude'
+
+ingest_log = logging.getLogger(INGEST_LOGGER)
+
+class IngestError(Exception):
+    """A rejected upload; message and status are returned to the device"""
+
+    def __init__(self, message, status=400, reason='invalid', retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+def bus_not_found():
+    return IngestError('Bus not found', status=404, reason='unknown_bus')
+
+def _parse_timestamp(value):
+    """Device time as unix seconds; accepts a number or an ISO 8601 string"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        pass
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise IngestError('Invalid timestamp')
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def _json_fix(data):
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
+    if latitude is None or longitude is None:
+        raise IngestError('Missing latitude or longitude', reason='missing')
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+        sequence = data.get('seq')
+        sequence = int(sequence) if sequence not in (None, '') else None
+    except (ValueError, TypeError):
+        raise IngestError(INVALID_COORDINATES)
+    timestamp = _parse_timestamp(data.get('timestamp'))
+    if sequence is not None and timestamp is None:
+        # A retry stamped with our clock would never match the stored fix
+        raise IngestError('seq requires a timestamp')
+    return (timestamp, latitude, longitude, sequence)
+
+def _decode_binary(body):
+    try:
+        return decode_binary(body)
+    except CodecError as e:
+        raise IngestError(str(e))
+
+def _batch_fixes(data):
+    if not isinstance(data, list):
+        raise IngestError('Expected a JSON list of locations')
+    fixes = [_json_fix(item) for item in data if isinstance(item, dict)]
+    if len(fixes) != len(data):
+        raise IngestError(INVALID_COORDINATES)
+    return fixes
+
+def _check_count(fixes, batch):
+    if not batch and len(fixes) != 1:
+        raise IngestError('Send multiple locations to the batch endpoint')
+    if len(fixes) > MAX_BATCH_SIZE:
+        raise IngestError('Batch too large (max %d locations)' % MAX_BATCH_SIZE, status=413)
+    return fixes
+
+def parse_fixes(request, batch=False):
+    """Read the fixes in a location upload, whatever its encoding"""
+    if request.mimetype == BINARY_MIMETYPE:
+        return _check_count(_decode_binary(request.get_data(cache=False)), batch)
+    if batch:
+        return _check_count(_batch_fixes(request.get_json(silent=True)), batch)
+    data = request.get_json(silent=True)
+    return [_json_fix(data if isinstance(data, dict) else request.form)]
+
+def parse_body(mimetype, body, batch=False):
+    """parse_fixes for a raw request body, for servers without a Flask request"""
+    if mimetype == BINARY_MIMETYPE:
+        return _check_count(_decode_binary(body), batch)
+    data = None
+    if mimetype == 'application/json' or mimetype.endswith('+json'):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            pass
+    elif mimetype == 'application/x-www-form-urlencoded' and not batch:
+        data = dict(parse_qsl(body.decode('utf-8', 'replace')))
+    if batch:
+        return _check_count(_batch_fixes(data), batch)
+    return [_json_fix(data if isinstance(data, dict) else {})]
+
+class SequenceWindow:
+    """Recently stored (sequence, timestamp) keys for one bus.
+
+    Catches the common retry-after-timeout duplicate without touching the
+    database; the unique index on bus_locations catches whatever slips past
+    (another worker, an evicted key) via ON CONFLICT DO NOTHING.
+    """
+
+    def __init__(self, size):
+        self._order = deque(maxlen=size)
+        self._keys = set()
+        self.latest = None  # newest device time stored, for late-fix accounting
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key):
+        if key in self._keys:
+            return
+        if len(self._order) == self._order.maxlen:
+            self._keys.discard(self._order[0])
+        self._order.append(key)
+        self._keys.add(key)
+
+_windows = {}
+_windows_lock = threading.Lock()
+
+def _window(bus_id):
+    window = _windows.get(bus_id)
+    if window is None:
+        with _windows_lock:
+            window = _windows.setdefault(bus_id, SequenceWindow(SEQUENCE_WINDOW_SIZE))
+    return window
+
+def check_fixes(fixes, received):
+    """Reject the whole upload if any fix is out of range or from the future"""
+    max_time = received + MAX_CLOCK_SKEW
+    for timestamp, latitude, longitude, sequence in fixes:
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise IngestError(INVALID_COORDINATES)
+        if timestamp is not None and timestamp > max_time:
+            raise IngestError('Timestamp is in the future')
+
+def prepare_rows(bus_id, fixes, received):
+    """bus_locations rows for fixes not stored recently; returns (rows, keys, duplicates, late)"""
+    now = datetime.utcfromtimestamp(received)
+    window = _window(bus_id)
+    rows = []
+    keys = []
+    duplicates = late = 0
+    with _windows_lock:
+        for timestamp, latitude, longitude, sequence in fixes:
+            if sequence is not None:
+                key = (sequence, timestamp)
+                if key in window or key in keys:
+                    duplicates += 1
+                    continue
+                keys.append(key)
+            if timestamp is not None and window.latest is not None and timestamp < window.latest:
+                late += 1
+            rows.append({
+                'bus_id': bus_id,
+                'latitude': latitude,
+                'longitude': longitude,
+                'timestamp': datetime.utcfromtimestamp(timestamp) if timestamp is not None else now,
+                'sequence': sequence,
+            })
+    return rows, keys, duplicates, late
+
+def fixes_committed(bus_id, fixes, rows, keys, stored, received):
+    """Remember the stored keys and run the post-commit hooks for one upload"""
+    # Only remember keys once they are durable, so a failed insert can be retried
+    window = _window(bus_id)
+    newest = max((fix[0] for fix in fixes if fix[0] is not None), default=None)
+    with _windows_lock:
+        previous = window.latest
+        for key in keys:
+            window.add(key)
+        if newest is not None and (window.latest is None or newest > window.latest):
+            window.latest = newest
+
+    current = max(fixes, key=lambda fix: fix[0] if fix[0] is not None else received)
+    current_time = current[0] if current[0] is not None else received
+    record_fix_time(bus_id, current_time)
+    if previous is None or current_time >= previous:
+        # Late fixes are history; only the current position can approach a station
+        check_arrivals(bus_id, current[1], current[2], current_time)
+    record_fix(bus_id, stored)
+    ingest_log.info("Location update for bus %s: %d fix(es), last %s, %s",
+                    bus_id, stored, rows[-1]['latitude'], rows[-1]['longitude'])
+
+def store_fixes(bus_id, fixes):
+    """Validate and insert fixes for one bus; returns (stored, duplicates).
+
+    Fixes keep their device timestamp, so a buffered fix that arrives late
+    lands in history behind newer ones instead of becoming the current
+    position. Fixes without a timestamp are stamped with the server time.
+    """
+    if not get_bus(bus_id):
+        raise bus_not_found()
+
+    received = time.time()
+    check_fixes(fixes, received)
+    rows, keys, duplicates, late = prepare_rows(bus_id, fixes, received)
+    stored = 0
+    if rows:
+        try:
+            stored, = store_rows([rows])
+            db.session.commit()
+        except IntegrityError:
+            # Deleted since get_bus() read it from this worker's cache (see deletion.py)
+            db.session.rollback()
+            invalidate_bus(bus_id)
+            raise bus_not_found()
+        duplicates += len(rows) - stored
+        count('fixes_today', fixes_today(rows, stored))
+        fixes_committed(bus_id, fixes, rows, keys, stored, received)
+    if duplicates:
+        record_rejected_fix('duplicate', duplicates)
+    if late:
+        record_late_fix(late)
+    return stored, duplicates
+
+def check_rate_limit(bus_id):
+    """Spend one of the bus's upload tokens before the body is even parsed"""
+    bus = get_bus(bus_id)
+    if not bus:
+        raise bus_not_found()
+    wait = take_token(bus)
+    if wait:
+        raise IngestError('Rate limit exceeded', status=429, reason='rate_limited', retry_after=wait)
+
+def error_response(e):
+    """(body, status, headers) for a rejected upload"""
+    record_rejected_fix(e.reason)
+    if e.retry_after is not None:
+        return ({'error': e.message, 'retry_after': round(e.retry_after, 3)}, e.status,
+                {'Retry-After': retry_after_header(e.retry_after)})
+    return {'error': e.message}, e.status, {}
+
+def stored_response(stored, duplicates, batch=False):
+    # Duplicates still get a 200 so a retrying device stops retrying
+    if batch:
+        return {'message': 'Locations stored successfully', 'accepted': stored, 'duplicates': duplicates}, 200, {}
+    return {'message': 'Location updated successfully'}, 200, {}
+
+def ingest(request, bus_id, batch=False):
+    """Parse and store an upload; returns (body, status, headers) for the caller to wrap"""
+    try:
+        check_rate_limit(bus_id)
+        stored, duplicates = store_fixes(bus_id, parse_fixes(request, batch))
+    except IngestError as e:
+        return error_response(e)
+    except Exception:
+        db.session.rollback()
+        record_rejected_fix('error')
+        ingest_log.exception("Failed to store location for bus %s", bus_id)
+        return {'error': 'Internal server error'}, 500, {}
+    return stored_response(stored, duplicates, batch)
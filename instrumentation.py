@@ -0,0 +1,87 @@
+import re
+import time
+import logging
+from collections import Counter
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+logger = logging.getLogger(__name__)
+
+# Collapse expanded IN lists and whitespace so "same query, different ids" share a shape
+_IN_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)|\((?:\s*%\(\w+\)s\s*,)+\s*%\(\w+\)s\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+def statement_shape(statement):
+    """Normalize a SQL statement so repeated queries can be grouped"""
+    return _IN_LIST.sub('(?)', _WHITESPACE.sub(' ', statement).strip())
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append((context, time.perf_counter()))
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _context, started = conn.info['query_start'].pop()
+    _record(statement, time.perf_counter() - started)
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(exception_context):
+    """A failed statement never reaches after_cursor_execute; pop its start time here"""
+    conn = exception_context.connection
+    if conn is None:
+        return
+    starts = conn.info.get('query_start')
+    # Errors while fetching results come after the statement's entry was popped
+    if starts and starts[-1][0] is exception_context.execution_context:
+        _context, started = starts.pop()
+        _record(exception_context.statement, time.perf_counter() - started)
+
+def _record(statement, elapsed):
+    if not has_request_context() or 'query_stats' not in g:
+        return
+    stats = g.query_stats
+    stats['count'] += 1
+    stats['time'] += elapsed
+    stats['shapes'][statement] += 1
+    if 'statements' in stats:
+        # Only requests sampled by profiler.py keep every statement and its time
+        stats['statements'].append((statement, elapsed))
+
+@app.before_request
+def start_query_stats():
+    g.query_stats = {'count': 0, 'time': 0.0, 'shapes': Counter()}
+
+@app.after_request
+def report_query_stats(response):
+    stats = g.get('query_stats')
+    if stats is None:
+        return response
+
+    response.headers.add(
+        'Server-Timing',
+        'db;dur=%.2f;desc="%d queries"' % (stats['time'] * 1000, stats['count'])
+    )
+
+    if app.debug:
+        _check_query_budget(stats)
+    return response
+
+def _check_query_budget(stats):
+    """Warn about requests that blow the query budget or look like N+1 loops"""
+    endpoint = request.endpoint or request.path
+    budget = app.config['QUERY_BUDGET']
+    if stats['count'] > budget:
+        logger.warning("%s issued %d queries (budget %d, %.1f ms in DB)",
+                       endpoint, stats['count'], budget, stats['time'] * 1000)
+
+    repeat_limit = app.config['QUERY_REPEAT_LIMIT']
+    shapes = Counter()
+    for statement, count in stats['shapes'].items():
+        shapes[statement_shape(statement)] += count
+    for shape, count in shapes.most_common():
+        if count <= repeat_limit:
+            break
+        logger.warning("%s repeated a statement %d times (possible N+1): %s",
+                       endpoint, count, shape[:200])
@@ -0,0 +1,351 @@
+"""Where GPS history lives, and the router every bus_locations query goes through.
+
+By default fixes are in the bus_locations table of the main database. With
+LOCATION_SHARDS set to N > 0 they move to N shards instead, picked by a
+hash of the bus id, so one bus's history is always in one shard and writes
+for different buses do not queue behind one database write lock:
+
+* LOCATION_SHARD_URL with ``{shard}`` in it names one database per shard,
+  e.g. one SQLite file each (the default, in the instance folder)
+* without ``{shard}`` the shards are the schemas locations_0 ... locations_N-1
+  of that one (Postgres) database
+
+Each shard has its own engine, and within a process one writer at a time
+per shard, so threads wait in line instead of retrying on a busy database.
+Per-bus reads, writes and deletes go to the bus's shard; fleet-wide reads
+run on all shards in parallel and merge the results.
+
+Shard tables have the same columns and indexes as bus_locations but no
+foreign key, since the buses table is elsewhere; bootstrap.py creates them.
+Changing N re-homes buses, so history written under another N is not found
+until moved. ``flask --app main move-locations-to-shards`` moves history from
+the main table into the shards, a chunk per transaction; rows without a
+sequence number in a chunk interrupted mid-move can end up in both places
+once the command is re-run.
+
+Statements on the main database run in db.session and the caller commits;
+shard statements commit on their own.
+"""
+import os
+import zlib
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import MetaData, Table, Column, Index, create_engine, select, insert, delete, func, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from app import app, db
+from models import BusLocation
+from engine_profiles import engine_options, apply_engine_profile
+
+SHARD_SCHEMA = 'locations_%d'
+# Indexes of bus_locations superseded by ones in models.py; dropped once those exist
+REPLACED_INDEXES = ['uq_bus_locations_bus_sequence']
+MOVE_CHUNK_SIZE = 5000
+MAX_FAN_OUT = 32  # threads for fleet-wide reads, at most one per shard
+
+logger = logging.getLogger(__name__)
+
+def _shard_table():
+    """bus_locations as stored in a shard: same columns and indexes, no foreign key"""
+    source = BusLocation.__table__
+    table = Table(source.name, MetaData(),
+                  *(Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+                    for column in source.columns))
+    for index in source.indexes:
+        Index(index.name, *(table.c[column.name] for column in index.columns), unique=index.unique)
+    return table
+
+shard_locations = _shard_table()
+
+class Shard:
+    def __init__(self, number, engine):
+        self.number = number
+        self.engine = engine
+        self.write_lock = threading.Lock()
+
+    @contextmanager
+    def writing(self):
+        """A connection for this process's one writer on the shard; commit before leaving"""
+        with self.write_lock, self.engine.connect() as connection:
+            yield connection
+
+def shard_count():
+    return app.config['LOCATION_SHARDS']
+
+def sharded():
+    return shard_count() > 0
+
+def shard_number(bus_id):
+    # crc32 rather than hash(): the same bus must map to the same shard in every process
+    return zlib.crc32(struct.pack('<q', bus_id)) % shard_count()
+
+def _create_shards():
+    url = app.config['LOCATION_SHARD_URL']
+    shards = []
+    if '{shard}' in url:
+        for number in range(shard_count()):
+            shard_url = url.format(shard=number)
+            engine = create_engine(shard_url, **engine_options(shard_url))
+            apply_engine_profile(engine)
+            shards.append(Shard(number, engine))
+    else:
+        engine = create_engine(url, **engine_options(url))
+        apply_engine_profile(engine)
+        for number in range(shard_count()):
+            schema = SHARD_SCHEMA % number
+            shards.append(Shard(number, engine.execution_options(schema_translate_map={None: schema})))
+    return shards
+
+_shards = None
+_pool = None
+_owner_pid = None
+_start_lock = threading.Lock()
+
+def get_shards():
+    """This process's shard engines, created on first use after a fork"""
+    global _shards, _pool, _owner_pid
+    pid = os.getpid()
+    if _owner_pid != pid:
+        with _start_lock:
+            if _owner_pid != pid:
+                _shards = _create_shards()
+                _pool = ThreadPoolExecutor(min(len(_shards), MAX_FAN_OUT), thread_name_prefix='location-shards')
+                _owner_pid = pid
+    return _shards
+
+def reset_shards():
+    """Drop this process's shard engines so the next use follows changed config"""
+    global _owner_pid
+    with _start_lock:
+        if _shards is not None and _owner_pid == os.getpid():
+            for shard in _shards:
+                shard.engine.dispose()
+            _pool.shutdown()
+        _owner_pid = None
+
+def shard_for(bus_id):
+    return get_shards()[shard_number(bus_id)]
+
+def _fan_out(work, shards=None):
+    """work(shard) for every shard (or the given ones) in parallel; results in shard order"""
+    shards = get_shards() if shards is None else shards
+    if len(shards) == 1:
+        return [work(shards[0])]
+    return list(_pool.map(work, shards))
+
+def create_shard_tables():
+    """Create missing shard schemas, tables and indexes; run by bootstrap.py"""
+    url = app.config['LOCATION_SHARD_URL']
+    for shard in get_shards():
+        with shard.engine.begin() as connection:
+            if '{shard}' not in url:
+                connection.execute(text('CREATE SCHEMA IF NOT EXISTS %s' % (SHARD_SCHEMA % shard.number)))
+            shard_locations.create(connection, checkfirst=True)
+            for index in shard_locations.indexes:
+                index.create(connection, checkfirst=True)
+            drop_replaced_indexes(connection, None if '{shard}' in url else SHARD_SCHEMA % shard.number)
+
+def drop_replaced_indexes(connection, schema=None):
+    for name in REPLACED_INDEXES:
+        connection.execute(text('DROP INDEX IF EXISTS %s' % ('%s.%s' % (schema, name) if schema else name)))
+
+# Writes
+
+def _insert_statement(table, dialect):
+    if dialect == 'postgresql':
+        return postgresql_insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite_insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+def insert_ignoring_duplicates(executor, table, dialect, rows):
+    """Insert rows in one statement, skipping ones that hit the unique index"""
+    result = executor.execute(_insert_statement(table, dialect), rows)
+    return result.rowcount if result.rowcount >= 0 else len(rows)
+
+def _insert_groups(executor, rollback, table, dialect, groups):
+    """Insert lists of rows together; returns how many of each were stored.
+
+    One statement covers every group unless some row was already stored, in
+    which case the groups are redone one by one to tell which lost rows.
+    """
+    rows = [row for group in groups for row in group]
+    if not rows:
+        return [0] * len(groups)
+    stored = insert_ignoring_duplicates(executor, table, dialect, rows)
+    if stored == len(rows):
+        return [len(group) for group in groups]
+    if len(groups) == 1:
+        return [stored]
+    rollback()
+    return [insert_ignoring_duplicates(executor, table, dialect, group) if group else 0 for group in groups]
+
+def store_rows(groups):
+    """Insert bus_locations rows, given as lists (one per upload); returns stored per list.
+
+    Duplicates of stored fixes are skipped. A list may mix buses; with shards
+    each shard involved gets one transaction, written in parallel.
+    """
+    if not sharded():
+        return _insert_groups(db.session, db.session.rollback, BusLocation.__table__,
+                              db.engine.dialect.name, groups)
+
+    by_shard = {}
+    for position, group in enumerate(groups):
+        for row in group:
+            by_shard.setdefault(shard_number(row['bus_id']), {}).setdefault(position, []).append(row)
+    shards = get_shards()
+
+    def write(shard):
+        parts = by_shard[shard.number]
+        with shard.writing() as connection:
+            stored = _insert_groups(connection, connection.rollback, shard_locations,
+                                    connection.dialect.name, list(parts.values()))
+            connection.commit()
+        return dict(zip(parts, stored))
+
+    stored = [0] * len(groups)
+    for counts in _fan_out(write, [shards[number] for number in sorted(by_shard)]):
+        for position, count in counts.items():
+            stored[position] += count
+    return stored
+
+def delete_fixes(bus_id, limit=None):
+    """Delete a bus's fixes, at most `limit` of them; returns how many went"""
+    if not sharded():
+        table = BusLocation.__table__
+        if limit is None:
+            return db.session.execute(delete(table).where(table.c.bus_id == bus_id)).rowcount
+        ids = db.session.execute(
+            select(table.c.bus_location_id).where(table.c.bus_id == bus_id).limit(limit)
+        ).scalars().all()
+        if ids:
+            db.session.execute(delete(table).where(table.c.bus_location_id.in_(ids)))
+        return len(ids)
+
+    table = shard_locations
+    with shard_for(bus_id).writing() as connection:
+        if limit is None:
+            removed = connection.execute(delete(table).where(table.c.bus_id == bus_id)).rowcount
+        else:
+            ids = connection.execute(
+                select(table.c.bus_location_id).where(table.c.bus_id == bus_id).limit(limit)
+            ).scalars().all()
+            if ids:
+                connection.execute(delete(table).where(table.c.bus_location_id.in_(ids)))
+            removed = len(ids)
+        connection.commit()
+    return removed
+
+# Reads
+
+def _read(bus_id, statement):
+    with shard_for(bus_id).engine.connect() as connection:
+        return connection.execute(statement).all()
+
+def latest_fixes(bus_id, limit=2):
+    """The bus's newest fixes, newest first"""
+    if not sharded():
+        return BusLocation.query.filter_by(bus_id=bus_id).order_by(BusLocation.timestamp.desc()).limit(limit).all()
+    table = shard_locations
+    return _read(bus_id, select(table).where(table.c.bus_id == bus_id)
+                 .order_by(table.c.timestamp.desc()).limit(limit))
+
+def latest_fix(bus_id):
+    fixes = latest_fixes(bus_id, 1)
+    return fixes[0] if fixes else None
+
+def _latest_by_bus(table, bus_ids, limit):
+    ranked = select(
+        table,
+        func.row_number().over(partition_by=table.c.bus_id, order_by=table.c.timestamp.desc()).label('rank'),
+    ).where(table.c.bus_id.in_(bus_ids)).subquery()
+    return select(*(ranked.c[column.name] for column in table.columns)).where(
+        ranked.c.rank <= limit
+    ).order_by(ranked.c.bus_id, ranked.c.rank)
+
+def latest_fixes_by_bus(bus_ids, limit=2):
+    """bus_id -> its newest fixes, newest first, for many buses in one query per shard"""
+    bus_ids = list(bus_ids)
+    fixes = {bus_id: [] for bus_id in bus_ids}
+    if not bus_ids:
+        return fixes
+    if not sharded():
+        rows = db.session.execute(_latest_by_bus(BusLocation.__table__, bus_ids, limit)).all()
+    else:
+        by_shard = {}
+        for bus_id in bus_ids:
+            by_shard.setdefault(shard_number(bus_id), []).append(bus_id)
+        shards = get_shards()
+
+        def read(shard):
+            with shard.engine.connect() as connection:
+                return connection.execute(_latest_by_bus(shard_locations, by_shard[shard.number], limit)).all()
+
+        rows = [row for part in _fan_out(read, [shards[number] for number in sorted(by_shard)]) for row in part]
+    for row in rows:
+        fixes[row.bus_id].append(row)
+    return fixes
+
+def count_fixes(bus_id=None, since=None):
+    """Number of stored fixes, for one bus or the fleet, optionally since a time"""
+    def statement(table):
+        query = select(func.count()).select_from(table)
+        if bus_id is not None:
+            query = query.where(table.c.bus_id == bus_id)
+        if since is not None:
+            query = query.where(table.c.timestamp >= since)
+        return query
+
+    if not sharded():
+        return db.session.execute(statement(BusLocation.__table__)).scalar()
+    if bus_id is not None:
+        return _read(bus_id, statement(shard_locations))[0][0]
+
+    def read(shard):
+        with shard.engine.connect() as connection:
+            return connection.execute(statement(shard_locations)).scalar()
+
+    return sum(_fan_out(read))
+
+def newest_fix_times():
+    """(bus_id, timestamp of its newest fix) for every bus with history"""
+    def statement(table):
+        return select(table.c.bus_id, func.max(table.c.timestamp)).group_by(table.c.bus_id)
+
+    if not sharded():
+        return db.session.execute(statement(BusLocation.__table__)).all()
+
+    def read(shard):
+        with shard.engine.connect() as connection:
+            return connection.execute(statement(shard_locations)).all()
+
+    return [row for part in _fan_out(read) for row in part]
+
+# Moving history from the main database into the shards
+
+def move_to_shards(chunk_size):
+    """Move main-table history into the shards, oldest rows first; returns rows moved"""
+    table = BusLocation.__table__
+    columns = [column for column in table.columns if column.name != 'bus_location_id']
+    moved = 0
+    while True:
+        rows = db.session.execute(select(table).order_by(table.c.bus_location_id).limit(chunk_size)).all()
+        if not rows:
+            return moved
+        # Shards number their own rows, so ids from the main table are not kept
+        store_rows([[{column.name: getattr(row, column.name) for column in columns} for row in rows]])
+        db.session.execute(delete(table).where(table.c.bus_location_id <= rows[-1].bus_location_id))
+        db.session.commit()
+        moved += len(rows)
+        logger.info("Moved %d fixes to the location shards", moved)
+
+@app.cli.command('move-locations-to-shards')
+def move_to_shards_command():
+    """Move GPS history from the main database into LOCATION_SHARDS shards."""
+    if not sharded():
+        raise SystemExit('Set LOCATION_SHARDS first')
+    print('Moved %d fixes' % move_to_shards(MOVE_CHUNK_SIZE))
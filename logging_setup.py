@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; anything else was passed via `extra=`
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Logger used on the GPS ingest hot path; sampled by LOG_INGEST_SAMPLE
+INGEST_LOGGER = 'bustrack.ingest'
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with any `extra=` fields merged in"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting or blocking.
+
+    The stock handler formats the message on the calling thread so records
+    can be pickled; an in-process queue does not need that. When the queue
+    is full the record is dropped rather than stalling the request; drops
+    are exported as bustrack_log_records_dropped_total (see metrics.py).
+    """
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+class SamplingFilter(logging.Filter):
+    """Let through one record in every `rate`; warnings and above always pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = max(1, rate)
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or next(self._counter) % self.rate == 0
+
+def parse_levels(spec):
+    """Parse "sqlalchemy.engine=WARNING,werkzeug=INFO" into a dict"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = item.partition('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+_listener = None
+
+def configure_logging():
+    """Route all logging through a queue drained by a background thread.
+
+    Environment:
+        LOG_LEVEL          root level (default INFO)
+        LOG_LEVELS         per-logger overrides, e.g. "werkzeug=WARNING"
+        LOG_FORMAT         "json" (default) or "text"
+        LOG_QUEUE_SIZE     records buffered before new ones are dropped
+        LOG_INGEST_SAMPLE  keep one ingest log record in N (default 100)
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if os.environ.get('LOG_FORMAT', 'json') == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    log_queue = queue.Queue(maxsize=int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(NonBlockingQueueHandler(log_queue))
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+    levels = {'sqlalchemy.engine': 'WARNING', 'werkzeug': 'INFO'}
+    levels.update(parse_levels(os.environ.get('LOG_LEVELS', '')))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    logging.getLogger(INGEST_LOGGER).addFilter(
+        SamplingFilter(int(os.environ.get('LOG_INGEST_SAMPLE', 100)))
+    )
@@ -1,6 +1,11 @@
 from app import app
 import routes  # noqa: F401
 import api  # noqa: F401
+import instrumentation  # noqa: F401
+import profiler  # noqa: F401  after instrumentation: uses its per-request query stats
+import bootstrap  # noqa: F401  registers the init-db command
+import locations  # noqa: F401  registers the move-locations-to-shards command
 
 if __name__ == "__main__":
+    bootstrap.init_db()
     app.run(host="0.0.0.0", port=5000, debug=True)
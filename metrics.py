@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import bisect
+import threading
+from flask import g, request, Response, abort
+from app import app, db
+from feed_watchdog import fleet_counts, ACTIVE, STALE, OFFLINE, UNKNOWN
+from logging_setup import NonBlockingQueueHandler
+
+# Latency buckets in seconds, Prometheus defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = {}
+_values = {}
+_lock = threading.Lock()
+_owner_pid = None
+
+class Counter:
+    """Monotonic counter; label values are passed positionally"""
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _metrics[name] = self
+
+    def inc(self, *labelvalues, amount=1):
+        key = (self.name, labelvalues)
+        with _lock:
+            _values[key] = _values.get(key, 0) + amount
+
+class Histogram:
+    """Fixed-bucket histogram stored as [bucket counts..., sum, count]"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        _metrics[name] = self
+
+    def observe(self, value, *labelvalues):
+        key = (self.name, labelvalues)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            slot = _values.get(key)
+            if slot is None:
+                slot = _values[key] = [0] * (len(self.buckets) + 3)
+            slot[index] += 1  # index == len(buckets) is the +Inf overflow slot
+            slot[-2] += value
+            slot[-1] += 1
+
+request_latency = Histogram('bustrack_request_duration_seconds',
+                            'Request latency by endpoint', ('endpoint', 'method'))
+requests_total = Counter('bustrack_requests_total',
+                         'Requests served by endpoint and status', ('endpoint', 'method', 'status'))
+db_seconds = Counter('bustrack_db_seconds_total',
+                     'Time spent in SQL by endpoint', ('endpoint',))
+db_queries = Counter('bustrack_db_queries_total',
+                     'SQL statements issued by endpoint', ('endpoint',))
+fixes_ingested = Counter('bustrack_gps_fixes_ingested_total',
+                         'GPS fixes accepted', ('bus_id',))
+fixes_rejected = Counter('bustrack_gps_fixes_rejected_total',
+                         'GPS fixes rejected', ('reason',))
+fixes_late = Counter('bustrack_gps_fixes_late_total',
+                     'GPS fixes older than the newest fix already received')
+log_records_dropped = Counter('bustrack_log_records_dropped_total',
+                              'Log records dropped because the log queue was full')
+
+def record_fix(bus_id, count=1):
+    fixes_ingested.inc(str(bus_id), amount=count)
+
+def record_rejected_fix(reason, count=1):
+    fixes_rejected.inc(reason, amount=count)
+
+def record_late_fix(count=1):
+    fixes_late.inc(amount=count)
+
+# Multiprocess aggregation: every worker periodically dumps its values to
+# METRICS_DIR/<pid>.json and the scraping worker sums all files.
+
+def _metrics_dir():
+    return app.config.get('METRICS_DIR')
+
+def _ensure_owner():
+    """Reset inherited values after a fork and start this process's flusher"""
+    global _owner_pid
+    pid = os.getpid()
+    if _owner_pid == pid:
+        return
+    with _lock:
+        if _owner_pid == pid:
+            return
+        _owner_pid = pid
+        _values.clear()
+    if _metrics_dir():
+        threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+def _flush_loop():
+    interval = app.config['METRICS_FLUSH_INTERVAL']
+    while True:
+        time.sleep(interval)
+        try:
+            _flush()
+        except OSError:
+            app.logger.exception("Failed to flush metrics")
+
+def _copy_log_drops():
+    """Take the drop count from logging_setup, which cannot import this module; hold _lock"""
+    if NonBlockingQueueHandler.dropped:
+        _values[(log_records_dropped.name, ())] = NonBlockingQueueHandler.dropped
+
+def _flush():
+    directory = _metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    with _lock:
+        _copy_log_drops()
+        data = [[name, list(labels), value] for (name, labels), value in _values.items()]
+    path = os.path.join(directory, '%d.json' % os.getpid())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _aggregate():
+    """Sum this process's live values with every other worker's last dump"""
+    with _lock:
+        _copy_log_drops()
+        totals = {key: (list(value) if isinstance(value, list) else value)
+                  for key, value in _values.items()}
+
+    directory = _metrics_dir()
+    if directory and os.path.isdir(directory):
+        own_file = '%d.json' % os.getpid()
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json') or filename == own_file:
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in data:
+                key = (name, tuple(labels))
+                if isinstance(value, list):
+                    current = totals.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        current[i] += v
+                else:
+                    totals[key] = totals.get(key, 0) + value
+    return totals
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+               for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _fleet_gauges():
+    """Gauges computed at scrape time rather than recorded per request"""
+    counts = fleet_counts()
+    gauges = [
+        ('bustrack_buses_active', 'Buses with a GPS fix inside the stale window', counts[ACTIVE]),
+        ('bustrack_buses_stale', 'Buses silent for longer than the stale window', counts[STALE]),
+        ('bustrack_buses_offline', 'Buses silent for longer than the offline window', counts[OFFLINE]),
+        ('bustrack_buses_unreported', 'Buses that have never sent a GPS fix', counts[UNKNOWN]),
+    ]
+
+    pool = db.engine.pool
+    for attr, name, documentation in (
+        ('size', 'bustrack_db_pool_size', 'Configured connection pool size'),
+        ('checkedout', 'bustrack_db_pool_checked_out', 'Connections currently checked out'),
+        ('overflow', 'bustrack_db_pool_overflow', 'Connections opened beyond the pool size'),
+    ):
+        if hasattr(pool, attr):
+            gauges.append((name, documentation, getattr(pool, attr)()))
+    return gauges
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format"""
+    totals = _aggregate()
+    by_name = {}
+    for (name, labels), value in totals.items():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, metric in _metrics.items():
+        lines.append('# HELP %s %s' % (name, metric.documentation))
+        lines.append('# TYPE %s %s' % (name, metric.type))
+        for labels, value in sorted(by_name.get(name, ())):
+            if metric.type == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(metric.labelnames, labels, ('le', _format_value(bound))), cumulative))
+                lines.append('%s_sum%s %s' % (name, _format_labels(metric.labelnames, labels), _format_value(value[-2])))
+                lines.append('%s_count%s %d' % (name, _format_labels(metric.labelnames, labels), value[-1]))
+            else:
+                lines.append('%s%s %s' % (name, _format_labels(metric.labelnames, labels), _format_value(value)))
+
+    for name, documentation, value in _fleet_gauges():
+        lines.append('# HELP %s %s' % (name, documentation))
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %s' % (name, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def start_request_timer():
+    _ensure_owner()
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    request_latency.observe(time.perf_counter() - started, endpoint, request.method)
+    requests_total.inc(endpoint, request.method, str(response.status_code))
+
+    stats = g.get('query_stats')
+    if stats:
+        db_seconds.inc(endpoint, amount=stats['time'])
+        db_queries.inc(endpoint, amount=stats['count'])
+    return response
+
+@app.route('/metrics')
+def metrics():
+    token = app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(401)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
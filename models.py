@@ -23,6 +23,8 @@ class Bus(db.Model):
     bus_number = db.Column(db.String(20), unique=True, nullable=False)
     driver_name = db.Column(db.String(100), nullable=False)
     driver_phone = db.Column(db.String(20), nullable=False)
+    ingest_rate = db.Column(db.Float, nullable=True)  # GPS uploads per second; NULL uses INGEST_RATE_LIMIT
+    ingest_burst = db.Column(db.Integer, nullable=True)  # NULL uses INGEST_BURST
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -41,6 +43,11 @@ class Station(db.Model):
     order = db.Column(db.Integer, nullable=False)  # sequence of stations on route
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        # Route order, and the sort key of the admin station list (see pagination.py)
+        db.Index('ix_stations_bus_order', 'bus_id', 'order', 'station_id'),
+    )
+    
     # Relationships
     students = db.relationship('Student', backref='pickup_station', lazy=True)
 
@@ -55,6 +62,11 @@ class Student(db.Model):
     bus_id = db.Column(db.Integer, db.ForeignKey('buses.bus_id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        # Sort key of the admin student list (see pagination.py)
+        db.Index('ix_students_name_id', 'name', 'student_id'),
+    )
+    
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
     
@@ -69,6 +81,15 @@ class BusLocation(db.Model):
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    sequence = db.Column(db.BigInteger, nullable=True)  # per-bus device sequence number
+    
+    __table_args__ = (
+        # Makes device retries idempotent (rows without a sequence never collide), and
+        # serves the latest-fix lookups: bus_id = ? ORDER BY timestamp DESC LIMIT n
+        db.Index('uq_bus_locations_bus_time_sequence', 'bus_id', 'timestamp', 'sequence', unique=True),
+        # Range count of today's fixes when the dashboard counters are reconciled (see stats.py)
+        db.Index('ix_bus_locations_timestamp', 'timestamp'),
+    )
 
 class Notice(db.Model):
     __tablename__ = 'notices'
@@ -84,3 +105,19 @@ class Notice(db.Model):
     
     # Relationship with admin
     admin = db.relationship('Admin', backref=db.backref('notices', lazy=True))
+
+class Deletion(db.Model):
+    """Progress of a bus deletion running in the background (see deletion.py)"""
+    __tablename__ = 'deletions'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    bus_id = db.Column(db.Integer, nullable=False, index=True)  # not a foreign key: the bus goes away
+    bus_number = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), default='running')  # running, done, failed
+    total = db.Column(db.Integer, default=0)  # GPS fixes to delete, counted at the start
+    deleted = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('admins.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # heartbeat, bumped every chunk
+
@@ -0,0 +1,98 @@
+"""Keyset pagination and search for the admin bus, station and student lists.
+
+Pages are addressed by the sort key of the row they start after (or end
+before) rather than an offset, so fetching page 200 costs the same as page 1:
+one indexed range scan of ``limit + 1`` rows. Cursors are opaque, URL-safe
+encodings of that key. Related rows the templates show are loaded in the
+same query (joinedload / contains_eager) instead of one lazy load per row.
+"""
+import json
+import base64
+from collections import namedtuple
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, contains_eager
+from app import app, db
+from models import Bus, Station, Student
+
+MAX_PAGE_SIZE = 200
+
+Page = namedtuple('Page', 'items next_cursor prev_cursor q')
+
+class CursorError(ValueError):
+    pass
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise CursorError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise CursorError('Invalid cursor')
+    return values
+
+def _like(q):
+    """Case-insensitive substring pattern with LIKE wildcards escaped"""
+    escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped + '%'
+
+def keyset_page(query, keys, after=None, before=None, limit=None, q=None):
+    """One page of `query` ordered by the `keys` columns (unique together)"""
+    limit = min(max(1, limit or app.config['ADMIN_PAGE_SIZE']), MAX_PAGE_SIZE)
+    key = tuple_(*keys)
+    backwards = before is not None and after is None
+    if after is not None:
+        query = query.filter(key > tuple_(*decode_cursor(after, len(keys))))
+    elif before is not None:
+        query = query.filter(key < tuple_(*decode_cursor(before, len(keys))))
+
+    if backwards:
+        query = query.order_by(*(column.desc() for column in keys))
+    else:
+        query = query.order_by(*keys)
+    rows = query.limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    def cursor(row):
+        return encode_cursor(getattr(row, column.key) for column in keys)
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if more or backwards:
+            next_cursor = cursor(rows[-1])
+        if (more and backwards) or after is not None:
+            prev_cursor = cursor(rows[0])
+    return Page(rows, next_cursor, prev_cursor, q)
+
+def bus_page(q=None, after=None, before=None, limit=None):
+    query = Bus.query
+    if q:
+        pattern = _like(q)
+        query = query.filter(db.or_(Bus.bus_number.ilike(pattern, escape='\\'),
+                                    Bus.driver_name.ilike(pattern, escape='\\')))
+    return keyset_page(query, (Bus.bus_number, Bus.bus_id), after, before, limit, q)
+
+def station_page(q=None, after=None, before=None, limit=None):
+    query = Station.query.join(Station.bus).options(contains_eager(Station.bus))
+    if q:
+        pattern = _like(q)
+        query = query.filter(db.or_(Station.station_name.ilike(pattern, escape='\\'),
+                                    Bus.bus_number.ilike(pattern, escape='\\')))
+    return keyset_page(query, (Station.bus_id, Station.order, Station.station_id), after, before, limit, q)
+
+def student_page(q=None, after=None, before=None, limit=None):
+    query = Student.query.options(joinedload(Student.bus), joinedload(Student.pickup_station))
+    if q:
+        pattern = _like(q)
+        query = query.filter(db.or_(Student.name.ilike(pattern, escape='\\'),
+                                    Student.username.ilike(pattern, escape='\\')))
+    return keyset_page(query, (Student.name, Student.student_id), after, before, limit, q)
+
+def bus_choices():
+    """(bus_id, bus_number) pairs for the bus dropdowns, without loading full rows"""
+    return db.session.query(Bus.bus_id, Bus.bus_number).order_by(Bus.bus_number).all()
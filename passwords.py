@@ -0,0 +1,42 @@
+"""Password hashing in worker processes, for the bulk importer.
+
+Deliberately free of app imports: the pool is spawned, so each worker starts
+a fresh interpreter that imports only this module and werkzeug (plus the
+parent's ``__main__``, which under gunicorn is gunicorn itself) instead of
+the whole Flask app.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash
+
+class PasswordHasher:
+    """generate_password_hash for lists of passwords, in parallel when it pays off.
+
+    Worker processes start on first use and stop on close(); use it as a
+    context manager around one import.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def hash(self, passwords):
+        if self.workers == 1 or len(passwords) < 2:
+            return [generate_password_hash(password) for password in passwords]
+        if self._pool is None:
+            # Spawned rather than forked: the workers only need werkzeug, not
+            # copies of this process's threads, locks and DB connections
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        return list(self._pool.map(generate_password_hash, passwords, chunksize=chunksize))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
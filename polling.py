@@ -0,0 +1,61 @@
+"""Server-computed polling hints for the map and station endpoints.
+
+Clients used to poll on fixed timers whether the bus was parked overnight or
+two stops away. Location and station responses now carry ``next_poll_after``
+(seconds), in the body where the document is an object and always in the
+Next-Poll-After header, and the front-end schedules its next request from it:
+
+* no fix inside STALE_BUS_SECONDS (off route hours): POLL_IDLE_SECONDS
+* fixes arriving but the bus is not moving: POLL_PARKED_SECONDS
+* moving: a tenth of the time the bus needs to reach the student's pickup
+  station at its current speed, between POLL_MIN_SECONDS and
+  POLL_MOVING_MAX_SECONDS
+
+A little jitter spreads clients that loaded the page together.
+"""
+import random
+from datetime import datetime, timedelta
+from app import app
+import locations
+from utils import calculate_distance
+
+POLL_HEADER = 'Next-Poll-After'
+MOVING_SPEED_KMH = 3  # below this the bus counts as parked (GPS drift)
+JITTER = 0.1
+
+def latest_fixes(bus_id):
+    """The bus's two newest fixes, newest first; enough to tell if it is moving"""
+    return locations.latest_fixes(bus_id, 2)
+
+def bus_speed(fixes):
+    """Speed in km/h between the two newest fixes, or None if unknown"""
+    if len(fixes) < 2:
+        return None
+    latest, previous = fixes
+    elapsed = (latest.timestamp - previous.timestamp).total_seconds()
+    if elapsed <= 0:
+        return None
+    distance = calculate_distance(previous.latitude, previous.longitude, latest.latitude, latest.longitude)
+    return distance / elapsed * 3600
+
+def next_poll_after(fixes, station=None):
+    """Seconds a client should wait before asking about this bus again"""
+    config = app.config
+    cutoff = datetime.utcnow() - timedelta(seconds=config['STALE_BUS_SECONDS'])
+    if not fixes or fixes[0].timestamp < cutoff:
+        seconds = config['POLL_IDLE_SECONDS']
+    else:
+        speed = bus_speed(fixes)
+        if speed is None or speed < MOVING_SPEED_KMH:
+            seconds = config['POLL_PARKED_SECONDS']
+        elif station is None:
+            seconds = config['POLL_MIN_SECONDS']
+        else:
+            latest = fixes[0]
+            distance = calculate_distance(latest.latitude, latest.longitude, station.latitude, station.longitude)
+            seconds = distance / speed * 3600 / 10
+            seconds = min(max(seconds, config['POLL_MIN_SECONDS']), config['POLL_MOVING_MAX_SECONDS'])
+    return max(1, int(round(seconds * random.uniform(1 - JITTER, 1 + JITTER))))
+
+def poll_headers(seconds):
+    return {POLL_HEADER: str(seconds)}
@@ -0,0 +1,354 @@
+"""On-demand sampling profiler for diagnosing slow endpoints in production.
+
+An admin starts a session through POST /api/admin/profile, naming an
+endpoint (Flask endpoint name, URL rule or path) and/or a worker pid and a
+duration of at most PROFILE_MAX_SECONDS, and gets its number back at once.
+Until it ends, every request that matches has its thread sampled every
+``interval`` by a background thread (``sys._current_frames()``, no tracing
+hooks), and the SQL statements it runs are recorded with their timings (see
+instrumentation.py). At the end each worker that saw a matching request
+writes its aggregated stacks to PROFILE_DIR. GET /api/admin/profile/<number>
+answers 202 until then and afterwards merges them into collapsed stacks (for
+flamegraph.pl and friends) or a speedscope document, with the SQL summary
+alongside. Results are kept until the next session starts.
+
+With PROFILE_STATE_FILE set (gunicorn.conf.py does this) the session is
+shared by all workers; otherwise it covers the process that started it. When
+no session is running a request costs a couple of clock reads: workers look
+at the shared session at most every CHECK_INTERVAL seconds.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import logging
+import threading
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from flask import g, request
+from app import app
+from instrumentation import statement_shape
+from shared_slots import MappedFile
+
+CHECK_INTERVAL = 0.5  # seconds a worker may take to notice a new session
+MAX_ENDPOINT_BYTES = 200
+FORMATS = ('collapsed', 'speedscope')
+
+# session number, end (unix time), sampling interval (s), worker pid (0: any), endpoint ('': any)
+RECORD = struct.Struct('<qddq%ds' % MAX_ENDPOINT_BYTES)
+
+Session = namedtuple('Session', 'number deadline interval pid endpoint')
+
+logger = logging.getLogger(__name__)
+
+class ProfileBusy(Exception):
+    """Another profiling session has not finished yet"""
+
+class SessionState:
+    """The current session, in a file shared by the workers or in this process"""
+
+    def __init__(self, path=None):
+        self._file = MappedFile(path, RECORD.size) if path else None
+        self._buffer = bytearray(RECORD.size)
+        self._lock = threading.Lock()
+        self._cached = None
+        self._checked_at = float('-inf')
+
+    @contextmanager
+    def _locked(self):
+        if self._file is not None:
+            with self._file.locked(0, RECORD.size) as data:
+                yield data
+        else:
+            with self._lock:
+                yield self._buffer
+
+    def _read(self, data):
+        number, deadline, interval, pid, endpoint = RECORD.unpack_from(data, 0)
+        return Session(number, deadline, interval, pid, endpoint.rstrip(b'\0').decode('utf-8'))
+
+    def start(self, seconds, interval, pid, endpoint):
+        """Begin a session unless one is running; returns it"""
+        encoded = endpoint.encode('utf-8')
+        if len(encoded) > MAX_ENDPOINT_BYTES:
+            raise ValueError('Endpoint is too long')
+        with self._locked() as data:
+            current = self._read(data)
+            if current.deadline > time.time():
+                raise ProfileBusy('A profiling session is already running')
+            session = Session(current.number + 1, time.time() + seconds, interval, pid, endpoint)
+            RECORD.pack_into(data, 0, session.number, session.deadline, interval, pid, encoded)
+        self._checked_at = float('-inf')
+        return session
+
+    def current(self):
+        """The latest session started, running or not (None before the first)"""
+        with self._locked() as data:
+            session = self._read(data)
+        return session if session.number else None
+
+    def active(self):
+        """The running session, or None; re-reads the shared state every CHECK_INTERVAL"""
+        now = time.monotonic()
+        if now - self._checked_at >= CHECK_INTERVAL:
+            self._checked_at = now
+            with self._locked() as data:
+                self._cached = self._read(data)
+        session = self._cached
+        if session is None or session.deadline <= time.time():
+            return None
+        return session
+
+def _frame_key(code):
+    return (code.co_qualname, code.co_filename, code.co_firstlineno)
+
+class Sampler:
+    """Samples the threads serving matching requests in this process until the session ends"""
+
+    def __init__(self, session, directory):
+        self.session = session
+        self.directory = directory
+        self._threads = set()
+        self._stacks = Counter()  # tuple of code objects, root first -> samples
+        self._sql = {}  # statement shape -> [count, total seconds, max seconds]
+        self._requests = 0
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name='profile-sampler', daemon=True).start()
+
+    def enter(self, ident):
+        """Start sampling a request thread; False once the session is over"""
+        with self._lock:
+            if self._finished:
+                return False
+            self._threads.add(ident)
+            self._requests += 1
+        return True
+
+    def leave(self, ident, statements):
+        with self._lock:
+            self._threads.discard(ident)
+            if self._finished:
+                return
+            for statement, elapsed in statements:
+                entry = self._sql.setdefault(statement_shape(statement), [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] = max(entry[2], elapsed)
+
+    def _sample(self):
+        own = threading.get_ident()
+        with self._lock:
+            threads = [ident for ident in self._threads if ident != own]
+        if not threads:
+            return
+        frames = sys._current_frames()
+        stacks = []
+        for ident in threads:
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                stacks.append(tuple(reversed(stack)))
+        with self._lock:
+            self._stacks.update(stacks)
+
+    def _run(self):
+        while time.time() < self.session.deadline:
+            time.sleep(self.session.interval)
+            self._sample()
+        with self._lock:
+            self._finished = True
+        try:
+            self._write()
+        except OSError:
+            logger.exception("Could not write profile for session %s", self.session.number)
+
+    def _write(self):
+        frames = {}
+        stacks = []
+        for stack, samples in self._stacks.items():
+            stacks.append([[frames.setdefault(code, len(frames)) for code in stack], samples])
+        result = {
+            'pid': os.getpid(),
+            'requests': self._requests,
+            'frames': [_frame_key(code) for code in frames],
+            'stacks': stacks,
+            'sql': [[shape] + entry for shape, entry in self._sql.items()],
+        }
+        path = _session_directory(self.directory, self.session.number)
+        os.makedirs(path, exist_ok=True)
+        tmp_path = os.path.join(path, '%d.json.tmp' % os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, os.path.join(path, '%d.json' % os.getpid()))
+
+def _session_directory(directory, number):
+    return os.path.join(directory, 'session-%d' % number)
+
+_state = None
+_sampler = None
+_sampler_pid = None
+_sampler_lock = threading.Lock()
+
+def get_state():
+    global _state
+    if _state is None:
+        with _sampler_lock:
+            if _state is None:
+                _state = SessionState(app.config.get('PROFILE_STATE_FILE'))
+    return _state
+
+def _get_sampler(session):
+    """This process's sampler for `session`, started by the first matching request"""
+    global _sampler, _sampler_pid
+    pid = os.getpid()
+    if _sampler_pid != pid or _sampler.session.number != session.number:
+        with _sampler_lock:
+            if _sampler_pid != pid or _sampler.session.number != session.number:
+                _sampler = Sampler(session, app.config['PROFILE_DIR'])
+                _sampler.start()
+                _sampler_pid = pid
+    return _sampler
+
+def _matches(session):
+    if session.pid and session.pid != os.getpid():
+        return False
+    if not session.endpoint:
+        return True
+    rule = request.url_rule.rule if request.url_rule is not None else None
+    return session.endpoint in (request.endpoint, rule, request.path)
+
+@app.before_request
+def start_request_sampling():
+    session = get_state().active()
+    if session is None or not _matches(session):
+        return
+    sampler = _get_sampler(session)
+    if sampler.enter(threading.get_ident()):
+        g.profile_sampler = sampler
+        stats = g.get('query_stats')
+        if stats is not None:
+            stats['statements'] = []  # filled in by instrumentation.py
+
+@app.teardown_request
+def stop_request_sampling(exc):
+    sampler = g.pop('profile_sampler', None)
+    if sampler is not None:
+        stats = g.get('query_stats') or {}
+        sampler.leave(threading.get_ident(), stats.get('statements', ()))
+
+def start_session(seconds, interval, pid=0, endpoint=''):
+    """Start profiling; returns the Session (ProfileBusy if one is running)"""
+    session = get_state().start(seconds, interval, pid, endpoint)
+    # Only the latest session's results are kept; session numbers also restart
+    # with the state file, so this drops results left by an earlier run
+    directory = app.config['PROFILE_DIR']
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if name.startswith('session-'):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return session
+
+def find_session(number):
+    """The Session numbered `number` if it is the latest one, else None"""
+    session = get_state().current()
+    return session if session is not None and session.number == number else None
+
+def seconds_until_ready(session):
+    """How long until every worker has written its results; 0 once they have"""
+    # Samplers stop at the deadline, then need a moment to write their files
+    return max(0.0, session.deadline + session.interval + CHECK_INTERVAL - time.time())
+
+def collect(session):
+    """Merge what every worker recorded for a finished session"""
+    path = _session_directory(app.config['PROFILE_DIR'], session.number)
+    workers = []
+    requests = 0
+    stacks = Counter()
+    sql = {}
+    try:
+        filenames = sorted(os.listdir(path))
+    except FileNotFoundError:
+        filenames = []
+    for filename in filenames:
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(path, filename)) as f:
+            result = json.load(f)
+        workers.append(result['pid'])
+        requests += result['requests']
+        frames = [tuple(frame) for frame in result['frames']]
+        for stack, samples in result['stacks']:
+            stacks[tuple(frames[index] for index in stack)] += samples
+        for shape, count, total, longest in result['sql']:
+            entry = sql.setdefault(shape, [0, 0.0, 0.0])
+            entry[0] += count
+            entry[1] += total
+            entry[2] = max(entry[2], longest)
+    return workers, requests, stacks, sql
+
+def _frame_name(frame):
+    name, filename, line = frame
+    return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+def collapsed(stacks):
+    """One "root;...;leaf samples" line per distinct stack, heaviest first"""
+    return ''.join('%s %d\n' % (';'.join(_frame_name(frame) for frame in stack), samples)
+                   for stack, samples in stacks.most_common())
+
+def speedscope(stacks, session):
+    """A speedscope "sampled" profile, one weighted sample per distinct stack"""
+    frames = {}
+    samples = []
+    weights = []
+    interval_ms = session.interval * 1000
+    for stack, count in stacks.most_common():
+        samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+        weights.append(count * interval_ms)
+    name = 'bustrack session %d: %s' % (session.number, session.endpoint or 'all requests')
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': [{'name': function, 'file': filename, 'line': line}
+                              for function, filename, line in frames]},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights,
+        }],
+        'name': name,
+        'exporter': 'bustrack profiler',
+    }
+
+def profile_document(session, output_format):
+    workers, requests, stacks, sql = collect(session)
+    document = {
+        'session': session.number,
+        'endpoint': session.endpoint or None,
+        'worker': session.pid or None,
+        'interval_ms': session.interval * 1000,
+        'workers': workers,
+        'requests': requests,
+        'samples': sum(stacks.values()),
+        'sql': [{'statement': shape, 'count': count, 'total_ms': round(total * 1000, 3),
+                 'max_ms': round(longest * 1000, 3)}
+                for shape, (count, total, longest) in sorted(sql.items(), key=lambda item: -item[1][1])],
+    }
+    if output_format == 'speedscope':
+        document['speedscope'] = speedscope(stacks, session)
+    else:
+        document['collapsed'] = collapsed(stacks)
+    return document
@@ -0,0 +1,86 @@
+"""Per-bus token buckets for GPS ingest.
+
+Each bus may send ``rate`` uploads per second with bursts of up to ``burst``;
+both default to INGEST_RATE_LIMIT / INGEST_BURST and can be overridden per bus
+from the admin bus page. A rejected upload gets the seconds until the next
+token, which devices should wait before sending again (see ingest.py).
+
+With RATE_LIMIT_FILE set (gunicorn.conf.py does this) the buckets live in a
+memory-mapped file shared by every worker (see shared_slots.py). Without it
+they are per-process.
+"""
+import math
+import time
+import struct
+import threading
+from app import app
+from shared_slots import SlotFile
+
+SLOT = struct.Struct('<qdd')  # bus_id, tokens, last refill (unix time)
+SLOT_COUNT = 4096
+
+def _refill(tokens, updated, now, rate, burst):
+    if updated <= 0:
+        return float(burst)
+    return min(float(burst), tokens + max(0.0, now - updated) * rate)
+
+class LocalBuckets:
+    """Buckets held in this process only"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, bus_id, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(bus_id, (0.0, 0.0))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[bus_id] = (tokens - 1 if not wait else tokens, now)
+        return wait
+
+class SharedBuckets:
+    """Buckets in a memory-mapped file shared across worker processes.
+
+    A slot taken over by a different bus id (more than SLOT_COUNT buses)
+    starts from a full bucket, so collisions only ever loosen the limit.
+    """
+
+    def __init__(self, path):
+        self._slots = SlotFile(path, SLOT, SLOT_COUNT)
+
+    def take(self, bus_id, rate, burst, now):
+        with self._slots.slot(bus_id) as (read, write):
+            owner, tokens, updated = read()
+            if owner != bus_id:
+                updated = 0.0
+            tokens = _refill(tokens, updated, now, rate, burst)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            write(bus_id, tokens - 1 if not wait else tokens, now)
+        return wait
+
+_buckets = None
+
+def _get_buckets():
+    global _buckets
+    if _buckets is None:
+        path = app.config.get('RATE_LIMIT_FILE')
+        _buckets = SharedBuckets(path) if path else LocalBuckets()
+    return _buckets
+
+def bus_limits(bus):
+    """(rate, burst) for a bus snapshot; rate <= 0 means unlimited"""
+    rate = bus.ingest_rate if bus.ingest_rate is not None else app.config['INGEST_RATE_LIMIT']
+    burst = bus.ingest_burst if bus.ingest_burst is not None else app.config['INGEST_BURST']
+    return rate, max(1, burst)
+
+def take_token(bus):
+    """Spend one upload from the bus's bucket; returns seconds to wait, 0 if allowed"""
+    rate, burst = bus_limits(bus)
+    if rate <= 0:
+        return 0.0
+    return _get_buckets().take(bus.bus_id, rate, burst, time.time())
+
+def retry_after_header(wait):
+    """Retry-After takes whole seconds; round up so devices never retry early"""
+    return str(max(1, math.ceil(wait)))
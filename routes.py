@@ -1,8 +1,17 @@
-from flask import render_template, request, redirect, url_for, flash, session, jsonify
+from flask import render_template, request, redirect, url_for, flash, session, jsonify, abort
 from app import app, db
 from models import Admin, Bus, Station, Student, BusLocation, Notice
 from auth import admin_required, student_required, logout_admin, logout_student
 from utils import calculate_eta, get_station_status
+from cache import get_bus, get_student, get_station, get_route, invalidate_bus, invalidate_student, invalidate_station
+from ingest import ingest
+from polling import latest_fixes, next_poll_after, poll_headers
+from pagination import CursorError, bus_page, station_page, student_page, bus_choices
+from deletion import DeletionBlocked, start_bus_deletion, remove_station, running_deletions, is_stalled
+from stats import count, get_stats
+from feed_watchdog import fleet_counts, ACTIVE, STALE, OFFLINE, UNKNOWN
+from fragments import position_version, route_version, notice_version
+from importer import CSVImportError, import_stations, import_students, STATION_COLUMNS, STUDENT_COLUMNS
 from datetime import datetime
 
 @app.route('/')
@@ -36,22 +45,34 @@ def admin_logout():
 @app.route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
-    bus_count = Bus.query.count()
-    station_count = Station.query.count()
-    student_count = Student.query.count()
-    notice_count = Notice.query.filter_by(is_active=True).count()
+    stats = get_stats()
+    feeds = fleet_counts()
     
     return render_template('admin/dashboard.html', 
-                         bus_count=bus_count, 
-                         station_count=station_count,
-                         student_count=student_count,
-                         notice_count=notice_count)
+                         bus_count=stats['buses'], 
+                         station_count=stats['stations'],
+                         student_count=stats['students'],
+                         notice_count=stats['active_notices'],
+                         fixes_today=stats['fixes_today'],
+                         active_bus_count=feeds[ACTIVE],
+                         stale_bus_count=feeds[STALE] + feeds[OFFLINE],
+                         unreported_bus_count=feeds[UNKNOWN])
+
+def _admin_page(fetch):
+    """Run a pagination query with the search and cursor arguments of the request"""
+    try:
+        return fetch(q=request.args.get('q', '').strip() or None,
+                     after=request.args.get('after'), before=request.args.get('before'),
+                     limit=request.args.get('limit', type=int))
+    except CursorError:
+        abort(400)
 
 @app.route('/admin/buses')
 @admin_required
 def manage_buses():
-    buses = Bus.query.all()
-    return render_template('admin/manage_buses.html', buses=buses)
+    page = _admin_page(bus_page)
+    return render_template('admin/manage_buses.html', buses=page.items, page=page,
+                           deletions=running_deletions(), is_stalled=is_stalled)
 
 @app.route('/admin/buses/add', methods=['POST'])
 @admin_required
@@ -73,6 +94,8 @@ def add_bus():
     )
     db.session.add(bus)
     db.session.commit()
+    invalidate_bus(bus.bus_id)
+    count('buses')
     flash('Bus added successfully', 'success')
     return redirect(url_for('manage_buses'))
 
@@ -84,8 +107,16 @@ def edit_bus(bus_id):
     bus.bus_number = request.form['bus_number']
     bus.driver_name = request.form['driver_name']
     bus.driver_phone = request.form['driver_phone']
+    try:
+        # Blank falls back to the INGEST_RATE_LIMIT / INGEST_BURST defaults
+        bus.ingest_rate = float(request.form['ingest_rate']) if request.form.get('ingest_rate') else None
+        bus.ingest_burst = int(request.form['ingest_burst']) if request.form.get('ingest_burst') else None
+    except ValueError:
+        flash('Invalid GPS rate limit', 'error')
+        return redirect(url_for('manage_buses'))
     
     db.session.commit()
+    invalidate_bus(bus_id)
     flash('Bus updated successfully', 'success')
     return redirect(url_for('manage_buses'))
 
@@ -93,17 +124,19 @@ def edit_bus(bus_id):
 @admin_required
 def delete_bus(bus_id):
     bus = Bus.query.get_or_404(bus_id)
-    db.session.delete(bus)
-    db.session.commit()
-    flash('Bus deleted successfully', 'success')
+    try:
+        start_bus_deletion(bus, session['admin_id'])
+    except DeletionBlocked as e:
+        flash('Cannot delete bus %s: %s' % (bus.bus_number, e), 'error')
+        return redirect(url_for('manage_buses'))
+    flash('Deleting bus %s and its location history in the background' % bus.bus_number, 'success')
     return redirect(url_for('manage_buses'))
 
 @app.route('/admin/stations')
 @admin_required
 def manage_stations():
-    stations = Station.query.join(Bus).all()
-    buses = Bus.query.all()
-    return render_template('admin/manage_stations.html', stations=stations, buses=buses)
+    page = _admin_page(station_page)
+    return render_template('admin/manage_stations.html', stations=page.items, page=page, buses=bus_choices())
 
 @app.route('/admin/stations/add', methods=['POST'])
 @admin_required
@@ -123,9 +156,16 @@ def add_station():
     )
     db.session.add(station)
     db.session.commit()
+    invalidate_station(station.station_id)
+    count('stations')
     flash('Station added successfully', 'success')
     return redirect(url_for('manage_stations'))
 
+@app.route('/admin/stations/import', methods=['POST'])
+@admin_required
+def import_stations_csv():
+    return _import_csv(import_stations, 'Stations', STATION_COLUMNS, 'manage_stations')
+
 @app.route('/admin/stations/<int:station_id>/edit', methods=['POST'])
 @admin_required
 def edit_station(station_id):
@@ -138,6 +178,7 @@ def edit_station(station_id):
     station.order = int(request.form['order'])
     
     db.session.commit()
+    invalidate_station(station_id)
     flash('Station updated successfully', 'success')
     return redirect(url_for('manage_stations'))
 
@@ -145,18 +186,19 @@ def edit_station(station_id):
 @admin_required
 def delete_station(station_id):
     station = Station.query.get_or_404(station_id)
-    db.session.delete(station)
-    db.session.commit()
+    try:
+        remove_station(station)
+    except DeletionBlocked as e:
+        flash('Cannot delete station %s: %s' % (station.station_name, e), 'error')
+        return redirect(url_for('manage_stations'))
     flash('Station deleted successfully', 'success')
     return redirect(url_for('manage_stations'))
 
 @app.route('/admin/students')
 @admin_required
 def manage_students():
-    students = Student.query.join(Bus).join(Station).all()
-    buses = Bus.query.all()
-    stations = Station.query.all()
-    return render_template('admin/manage_students.html', students=students, buses=buses, stations=stations)
+    page = _admin_page(student_page)
+    return render_template('admin/manage_students.html', students=page.items, page=page, buses=bus_choices())
 
 @app.route('/admin/students/add', methods=['POST'])
 @admin_required
@@ -182,9 +224,29 @@ def add_student():
     student.set_password(password)
     db.session.add(student)
     db.session.commit()
+    invalidate_student(student.student_id)
+    count('students')
     flash('Student added successfully', 'success')
     return redirect(url_for('manage_students'))
 
+@app.route('/admin/students/import', methods=['POST'])
+@admin_required
+def import_students_csv():
+    return _import_csv(import_students, 'Students', STUDENT_COLUMNS, 'manage_students')
+
+def _import_csv(run_import, kind, columns, back_to):
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Choose a CSV file to import', 'error')
+        return redirect(url_for(back_to))
+    try:
+        result = run_import(upload.stream)
+    except CSVImportError as e:
+        flash(str(e), 'error')
+        return redirect(url_for(back_to))
+    return render_template('admin/import_result.html', result=result, kind=kind,
+                           columns=columns, back_to=back_to)
+
 @app.route('/admin/students/<int:student_id>/edit', methods=['POST'])
 @admin_required
 def edit_student(student_id):
@@ -200,6 +262,7 @@ def edit_student(student_id):
         student.set_password(request.form['password'])
     
     db.session.commit()
+    invalidate_student(student_id)
     flash('Student updated successfully', 'success')
     return redirect(url_for('manage_students'))
 
@@ -209,6 +272,8 @@ def delete_student(student_id):
     student = Student.query.get_or_404(student_id)
     db.session.delete(student)
     db.session.commit()
+    invalidate_student(student_id)
+    count('students', -1)
     flash('Student deleted successfully', 'success')
     return redirect(url_for('manage_students'))
 
@@ -267,79 +332,70 @@ def student_logout():
 @app.route('/student/dashboard')
 @student_required
 def student_dashboard():
-    student = Student.query.get(session['student_id'])
-    bus = Bus.query.get(student.bus_id)
-    pickup_station = Station.query.get(student.station_id)
-    
-    # Get latest bus location
-    latest_location = BusLocation.query.filter_by(bus_id=student.bus_id).order_by(BusLocation.timestamp.desc()).first()
-    
-    # Get all stations for the bus
-    stations = Station.query.filter_by(bus_id=student.bus_id).order_by(Station.order).all()
-    
-    # Add status and ETA to each station
-    station_info = []
-    for station in stations:
-        status = get_station_status(student.bus_id, station.station_id)
-        eta = calculate_eta(student.bus_id, station.station_id)
-        station_info.append({
-            'station': station,
-            'status': status,
-            'eta': eta
-        })
-    
-    # Get active notices
-    now = datetime.utcnow()
-    notices = Notice.query.filter(
-        Notice.is_active == True,
-        db.or_(Notice.expires_at.is_(None), Notice.expires_at > now)
-    ).order_by(Notice.created_at.desc()).all()
+    student = get_student(session['student_id'])
+    bus = get_bus(student.bus_id)
+    pickup_station = get_station(student.station_id)
+    
+    # Get latest bus location; the page reloads itself after next_poll_after seconds
+    fixes = latest_fixes(student.bus_id)
+    latest_location = fixes[0] if fixes else None
+    poll_after = next_poll_after(fixes, pickup_station)
+    route = get_route(student.bus_id)
+    
+    # The template calls these only when its cached fragments are out of date
+    def route_progress():
+        station_info = []
+        for station in route:
+            status = get_station_status(student.bus_id, station.station_id)
+            eta = calculate_eta(student.bus_id, station.station_id)
+            station_info.append({
+                'station': station,
+                'status': status,
+                'eta': eta
+            })
+        return station_info
+    
+    def active_notices():
+        now = datetime.utcnow()
+        return Notice.query.filter(
+            Notice.is_active == True,
+            db.or_(Notice.expires_at.is_(None), Notice.expires_at > now)
+        ).order_by(Notice.created_at.desc()).all()
     
     return render_template('student/dashboard.html', 
                          student=student,
                          bus=bus,
                          pickup_station=pickup_station,
                          latest_location=latest_location,
-                         station_info=station_info,
-                         notices=notices)
+                         station_count=len(route),
+                         route_progress=route_progress,
+                         active_notices=active_notices,
+                         position_version=position_version(latest_location),
+                         route_version=route_version(route),
+                         notice_version=notice_version(),
+                         next_poll_after=poll_after)
 
 # API Routes for GPS Updates
 @app.route('/bus/<int:bus_id>/location', methods=['POST'])
 def update_bus_location(bus_id):
-    try:
-        data = request.get_json() or request.form
-        latitude = float(data.get('latitude'))
-        longitude = float(data.get('longitude'))
-        
-        # Verify bus exists
-        bus = Bus.query.get(bus_id)
-        if not bus:
-            return jsonify({'error': 'Bus not found'}), 404
-        
-        # Create new location record
-        location = BusLocation(
-            bus_id=bus_id,
-            latitude=latitude,
-            longitude=longitude,
-            timestamp=datetime.utcnow()
-        )
-        db.session.add(location)
-        db.session.commit()
-        
-        return jsonify({'message': 'Location updated successfully'}), 200
-        
-    except (ValueError, TypeError) as e:
-        return jsonify({'error': 'Invalid latitude or longitude'}), 400
-    except Exception as e:
-        return jsonify({'error': 'Internal server error'}), 500
+    body, status, headers = ingest(request, bus_id)
+    return jsonify(body), status, headers
+
+@app.route('/bus/<int:bus_id>/locations', methods=['POST'])
+def upload_bus_locations(bus_id):
+    """Batch upload of buffered fixes, as a JSON list or binary records"""
+    body, status, headers = ingest(request, bus_id, batch=True)
+    return jsonify(body), status, headers
 
 # API Routes for Student App
 @app.route('/student/my-bus')
 @student_required
 def get_my_bus():
-    student = Student.query.get(session['student_id'])
-    bus = Bus.query.get(student.bus_id)
-    latest_location = BusLocation.query.filter_by(bus_id=student.bus_id).order_by(BusLocation.timestamp.desc()).first()
+    student = get_student(session['student_id'])
+    bus = get_bus(student.bus_id)
+    fixes = latest_fixes(student.bus_id)
+    latest_location = fixes[0] if fixes else None
+    poll_after = next_poll_after(fixes, get_station(student.station_id))
     
     bus_info = {
         'bus_number': bus.bus_number,
@@ -349,15 +405,16 @@ def get_my_bus():
             'latitude': latest_location.latitude if latest_location else None,
             'longitude': latest_location.longitude if latest_location else None,
             'timestamp': latest_location.timestamp.isoformat() if latest_location else None
-        }
+        },
+        'next_poll_after': poll_after
     }
     
-    return jsonify(bus_info)
+    return jsonify(bus_info), 200, poll_headers(poll_after)
 
 @app.route('/student/my-bus/stations')
 @student_required
 def get_my_bus_stations():
-    student = Student.query.get(session['student_id'])
+    student = get_student(session['student_id'])
     stations = Station.query.filter_by(bus_id=student.bus_id).order_by(Station.order).all()
     
     stations_info = []
@@ -375,7 +432,8 @@ def get_my_bus_stations():
             'eta': eta
         })
     
-    return jsonify(stations_info)
+    poll_after = next_poll_after(latest_fixes(student.bus_id), get_station(student.station_id))
+    return jsonify(stations_info), 200, poll_headers(poll_after)
 
 @app.route('/admin/get-stations/<int:bus_id>')
 @admin_required
@@ -417,6 +475,7 @@ def add_notice():
     
     db.session.add(notice)
     db.session.commit()
+    count('active_notices')
     flash('Notice added successfully', 'success')
     return redirect(url_for('manage_notices'))
 
@@ -426,6 +485,7 @@ def toggle_notice(notice_id):
     notice = Notice.query.get_or_404(notice_id)
     notice.is_active = not notice.is_active
     db.session.commit()
+    count('active_notices', 1 if notice.is_active else -1)
     
     status = "activated" if notice.is_active else "deactivated"
     flash(f'Notice {status} successfully', 'success')
@@ -435,8 +495,11 @@ def toggle_notice(notice_id):
 @admin_required
 def delete_notice(notice_id):
     notice = Notice.query.get_or_404(notice_id)
+    was_active = notice.is_active
     db.session.delete(notice)
     db.session.commit()
+    if was_active:
+        count('active_notices', -1)
     flash('Notice deleted successfully', 'success')
     return redirect(url_for('manage_notices'))
 
@@ -444,9 +507,9 @@ def delete_notice(notice_id):
 @app.route('/student/map')
 @student_required
 def student_map():
-    student = Student.query.get(session['student_id'])
-    bus = Bus.query.get(student.bus_id)
-    pickup_station = Station.query.get(student.station_id)
+    student = get_student(session['student_id'])
+    bus = get_bus(student.bus_id)
+    pickup_station = get_station(student.station_id)
     return render_template('student/map.html', 
                          student=student, 
                          bus=bus, 
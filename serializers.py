@@ -0,0 +1,87 @@
+"""Hand-rolled JSON serializers for the hot map and station resources.
+
+``marshal_with`` walks the flask-restx field definitions for every object on
+every request. These functions produce the same documents, field order and
+separators included, from cached byte fragments instead. Fragments hang off
+the metadata snapshots in cache.py, so an admin edit that invalidates a
+snapshot also drops its fragments; location fragments are additionally keyed
+by the fix they were built from.
+
+The restx models in api.py stay the documented schema; keep both in sync.
+"""
+import json
+import hashlib
+from flask import Response
+from cache import LRUCache
+from utils import encode_polyline
+
+ROUTE_FORMAT = 'polyline6'
+ROUTE_PRECISION = 6  # 10**-6 degrees, about 0.1 m
+
+_encode = json.JSONEncoder(ensure_ascii=True).encode
+
+def json_response(body, status=200, headers=None):
+    return Response(body + b'\n', status=status, headers=headers, mimetype='application/json')
+
+def with_field(fragment, name, value):
+    """Append one more key to an encoded object"""
+    return b'%s, %s: %s}' % (fragment[:-1], _encode(name).encode(), _encode(value).encode())
+
+def json_list(fragments):
+    return b'[' + b', '.join(fragments) + b']'
+
+def bus_location_fragment(bus, location):
+    """Encoded BusLocationResponse for a bus snapshot and its latest fix"""
+    cached = getattr(bus, '_location_json', None)
+    if cached is not None and cached[0] == location.bus_location_id:
+        return cached[1]
+
+    encoded = (
+        '{"bus_id": %s, "bus_number": %s, "latitude": %s, "longitude": %s, '
+        '"timestamp": %s, "driver_name": %s}' % (
+            _encode(bus.bus_id), _encode(bus.bus_number),
+            _encode(location.latitude), _encode(location.longitude),
+            _encode(location.timestamp.isoformat()), _encode(bus.driver_name),
+        )
+    ).encode()
+    bus._location_json = (location.bus_location_id, encoded)
+    return encoded
+
+def _station_prefix(station):
+    """Static part of a Station document, without the closing brace"""
+    prefix = getattr(station, '_json_prefix', None)
+    if prefix is None:
+        prefix = station._json_prefix = (
+            '{"station_id": %s, "station_name": %s, "latitude": %s, "longitude": %s, "order": %s' % (
+                _encode(station.station_id), _encode(station.station_name),
+                _encode(station.latitude), _encode(station.longitude), _encode(station.order),
+            )
+        ).encode()
+    return prefix
+
+def station_status_fragment(station, status, eta):
+    """Encoded Station document with per-request status and ETA"""
+    return b'%s, "status": %s, "eta": %s}' % (
+        _station_prefix(station), _encode(status).encode(), _encode(eta).encode()
+    )
+
+_compact_routes = LRUCache()
+
+def compact_route_fragment(bus_id, route, version):
+    """(encoded CompactRoute, digest) for a route snapshot, built once per route version.
+
+    Coordinates go in one encoded polyline and the station fields in parallel
+    arrays, instead of one object with repeated keys per station.
+    """
+    def build(_key):
+        body = (
+            '{"format": %s, "bus_id": %s, "polyline": %s, "station_ids": %s, "station_names": %s, "order": %s}' % (
+                _encode(ROUTE_FORMAT), _encode(bus_id),
+                _encode(encode_polyline(((station.latitude, station.longitude) for station in route), ROUTE_PRECISION)),
+                _encode([station.station_id for station in route]),
+                _encode([station.station_name for station in route]),
+                _encode([station.order for station in route]),
+            )
+        ).encode()
+        return body, hashlib.sha1(body).hexdigest()[:16]
+    return _compact_routes.get((bus_id, version), build)
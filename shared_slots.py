@@ -0,0 +1,126 @@
+"""Small memory-mapped files shared by all gunicorn workers.
+
+Used for state that every worker must agree on without a database round
+trip: per-bus records (rate-limit buckets in ratelimit.py, last-fix times in
+feed_watchdog.py, approach flags in arrivals.py) and a ring of recent
+arrival events. Regions are guarded by byte-range locks, plus a thread lock
+since fcntl locks are per process.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+
+DEFAULT_SLOT_COUNT = 4096
+
+# Config name -> file name in the temp directory, for every shared file the app uses
+SHARED_FILES = (("RATE_LIMIT_FILE", "bustrack-ratelimit.bin"),
+                ("FEED_STATE_FILE", "bustrack-feeds.bin"),
+                ("ARRIVAL_FLAGS_FILE", "bustrack-arrival-flags.bin"),
+                ("ARRIVAL_EVENTS_FILE", "bustrack-arrival-events.bin"),
+                ("STATS_FILE", "bustrack-stats.bin"),
+                ("FRAGMENT_STATE_FILE", "bustrack-fragments.bin"),
+                ("PROFILE_STATE_FILE", "bustrack-profile.bin"))
+
+def use_shared_files(reset=False):
+    """Point the environment at the shared files before the app is imported.
+
+    Anything already set in the environment wins. `reset` removes the files
+    so state starts empty (gunicorn does this once per start); other
+    processes joining a running deployment (gateway.py) leave them alone.
+    """
+    for name, filename in SHARED_FILES:
+        path = os.environ.setdefault(name, os.path.join(tempfile.gettempdir(), filename))
+        if reset and os.path.exists(path):
+            os.remove(path)
+
+class MappedFile:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Reopen after a fork so the locks belong to this process
+        if self._pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+            self._fd = fd
+            self._map = mmap.mmap(fd, self.size)
+            self._pid = os.getpid()
+
+    @contextmanager
+    def locked(self, offset, length):
+        """Hold an exclusive lock on a byte range; yields the mmap"""
+        with self._lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield self._map
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+class SlotFile(MappedFile):
+    """One fixed-size record per bus, at slot ``bus_id % count``.
+
+    Callers store the bus id in the record to detect the rare collision.
+    """
+
+    def __init__(self, path, record, count=DEFAULT_SLOT_COUNT):
+        super().__init__(path, record.size * count)
+        self.record = record  # struct.Struct of one slot
+        self.count = count
+
+    @contextmanager
+    def slot(self, bus_id):
+        """Lock a bus's slot; yields (read, write) functions for its record"""
+        offset = (bus_id % self.count) * self.record.size
+        with self.locked(offset, self.record.size) as data:
+            yield (lambda: self.record.unpack_from(data, offset),
+                   lambda *values: self.record.pack_into(data, offset, *values))
+
+class EventRing(MappedFile):
+    """Append-only ring of fixed-size records, numbered from 1.
+
+    Readers keep the last number they saw and call read_since(); records
+    overwritten before a reader got to them are skipped.
+    """
+    HEADER = struct.Struct('<Q')  # number of the newest record
+
+    def __init__(self, path, record, count=1024):
+        # Every record is prefixed with its own number to detect overwrites
+        self.record = struct.Struct('<Q' + record.format.lstrip('<'))
+        self.count = count
+        super().__init__(path, self.HEADER.size + self.record.size * count)
+
+    def _offset(self, number):
+        return self.HEADER.size + (number % self.count) * self.record.size
+
+    def append(self, *values):
+        with self.locked(0, self.HEADER.size) as data:
+            number = self.HEADER.unpack_from(data, 0)[0] + 1
+            self.record.pack_into(data, self._offset(number), number, *values)
+            self.HEADER.pack_into(data, 0, number)
+        return number
+
+    def newest(self):
+        with self.locked(0, self.HEADER.size) as data:
+            return self.HEADER.unpack_from(data, 0)[0]
+
+    def read_since(self, number):
+        """(newest number, [(number, *values)...]) for records after `number`"""
+        with self.locked(0, self.HEADER.size) as data:
+            newest = self.HEADER.unpack_from(data, 0)[0]
+            if newest < number:
+                number = 0  # the file was reset under us
+            records = []
+            for n in range(max(number + 1, newest - self.count + 1), newest + 1):
+                values = self.record.unpack_from(data, self._offset(n))
+                if values[0] == n:
+                    records.append(values)
+        return newest, records
@@ -1,7 +1,19 @@
+import os
+import sys
 import time
+import json
+import heapq
+import random
+import socket
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import requests
+from gps_codec import BINARY_MIMETYPE, encode_binary
 
-API_BASE = "https://bustrackapi.onrender.com"
+API_BASE = os.environ.get("API_BASE", "https://bustrackapi.onrender.com")
+LOCAL_BASE = "http://127.0.0.1:5000"
 BUS_ID = "1"
 
 # Station coordinates in order
@@ -11,17 +23,38 @@ stations = [
     (27.682233, 84.430120),  # chaubiskothi
 ]
 
-def send_location(bus_id, lat, lon):
-    url = f"{API_BASE}/bus/{bus_id}/location"
+# Synthetic routes are scattered around the first real station
+CITY_CENTER = stations[0]
+LOADTEST_BUS_PREFIX = "LT-"
+LOADTEST_STUDENT_PREFIX = "lt-student-"
+LOADTEST_PASSWORD = "loadtest"
+QUEUED_STEPS_PER_WORKER = 2  # steps allowed to wait for a free worker thread
+
+def retry_delay(response):
+    """Seconds the server asked us to back off for, or 0"""
+    if response.status_code != 429:
+        return 0.0
+    try:
+        return float(response.json()["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return float(response.headers.get("Retry-After", 1))
+
+def send_location(bus_id, lat, lon, base=None):
+    """Post one fix; returns the back-off the server asked for, 0 if none"""
+    url = f"{base or API_BASE}/bus/{bus_id}/location"
     data = {"latitude": lat, "longitude": lon}
     try:
         response = requests.post(url, json=data)
         if response.status_code == 200:
             print(f"✅ Sent location: {lat}, {lon}")
+        elif response.status_code == 429:
+            print(f"⏳ Rate limited, backing off {retry_delay(response):.1f}s")
         else:
             print(f"⚠️ Failed: {response.status_code} - {response.text}")
+        return retry_delay(response)
     except Exception as e:
         print(f"❌ Error: {e}")
+    return 0.0
 
 def interpolate_points(start, end, steps):
     """Generate intermediate lat/lon points between two coordinates"""
@@ -32,21 +65,346 @@ def interpolate_points(start, end, steps):
         lon = lon1 + (lon2 - lon1) * (i / steps)
         yield (lat, lon)
 
-def main():
-    interval = 3   # send update every 10 sec
-    steps = 18      # so each station-to-station trip takes ~3 minutes (18*10 sec)
-
+def drive(bus_id=BUS_ID, interval=3, steps=18, base=None):
+    """Drive one bus along the real route forever"""
     while True:
         for i in range(len(stations) - 1):
             start = stations[i]
             end = stations[i + 1]
 
             for point in interpolate_points(start, end, steps):
-                send_location(BUS_ID, point[0], point[1])
-                time.sleep(interval)
+                backoff = send_location(bus_id, point[0], point[1], base)
+                time.sleep(max(interval, backoff))
 
         print("🔄 Route completed. Restarting...\n")
 
-if __name__ == "__main__":
-    main()
+def synthetic_route(seed, length):
+    """Deterministic random-walk route of `length` stops for a synthetic bus"""
+    rng = random.Random(seed)
+    lat = CITY_CENTER[0] + rng.uniform(-0.05, 0.05)
+    lon = CITY_CENTER[1] + rng.uniform(-0.05, 0.05)
+    route = []
+    for _ in range(length):
+        route.append((lat, lon))
+        lat += rng.uniform(-0.006, 0.006)
+        lon += rng.uniform(-0.006, 0.006)
+    return route
+
+def seed_fleet(bus_count, stations_per_route, students):
+    """Create load-test buses, stations and students in the local database.
+
+    Runs against DATABASE_URL directly and reuses rows from earlier runs, so
+    the same fleet can be seeded once and load-tested many times.
+    """
+    from werkzeug.security import generate_password_hash
+    from app import app, db
+    from models import Bus, Station, Student
+    from bootstrap import init_db
+
+    init_db()
+    with app.app_context():
+        existing = {b.bus_number: b for b in Bus.query.filter(Bus.bus_number.like(LOADTEST_BUS_PREFIX + '%'))}
+        buses = []
+        for i in range(bus_count):
+            number = f"{LOADTEST_BUS_PREFIX}{i:04d}"
+            bus = existing.get(number)
+            if bus is None:
+                bus = Bus(bus_number=number, driver_name=f"Driver {i}", driver_phone="0000000000")
+                db.session.add(bus)
+                db.session.flush()
+                for order, (lat, lon) in enumerate(synthetic_route(bus.bus_id, stations_per_route), start=1):
+                    db.session.add(Station(station_name=f"{number} stop {order}", latitude=lat,
+                                           longitude=lon, bus_id=bus.bus_id, order=order))
+            buses.append(bus)
+        db.session.flush()
+
+        first_stations = {}
+        for station in Station.query.filter(Station.bus_id.in_([b.bus_id for b in buses])).order_by(Station.order):
+            first_stations.setdefault(station.bus_id, station.station_id)
+
+        # One hash for everyone: password hashing is deliberately slow
+        password_hash = generate_password_hash(LOADTEST_PASSWORD)
+        known = {s.username for s in Student.query.filter(Student.username.like(LOADTEST_STUDENT_PREFIX + '%'))}
+        for i in range(students):
+            username = f"{LOADTEST_STUDENT_PREFIX}{i}"
+            if username in known:
+                continue
+            bus = buses[i % len(buses)]
+            db.session.add(Student(username=username, name=f"Load Student {i}", password_hash=password_hash,
+                                   bus_id=bus.bus_id, station_id=first_stations[bus.bus_id]))
+        db.session.commit()
+        return [b.bus_id for b in buses]
+
+class Stats:
+    """Thread-safe latency samples grouped by endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.throttled = {}
+
+    def record(self, endpoint, elapsed, ok, throttled=False):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(elapsed)
+            if throttled:
+                self.throttled[endpoint] = self.throttled.get(endpoint, 0) + 1
+            elif not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, duration):
+        results = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            samples.sort()
+            results[endpoint] = {
+                'requests': len(samples),
+                'errors': self.errors.get(endpoint, 0),
+                'throttled': self.throttled.get(endpoint, 0),
+                'throughput_rps': round(len(samples) / duration, 2),
+                'p50_ms': round(percentile(samples, 50) * 1000, 2),
+                'p95_ms': round(percentile(samples, 95) * 1000, 2),
+                'p99_ms': round(percentile(samples, 99) * 1000, 2),
+            }
+        return results
+
+def percentile(sorted_samples, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, int(round(pct / 100.0 * len(sorted_samples))))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+_local = threading.local()
+
+def _http():
+    """One keep-alive session per worker thread, shared by many virtual clients"""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+class VirtualBus:
+    """Sends fixes along a synthetic route, looping at the end"""
+    endpoint = "POST /bus/<id>/location"
+
+    def __init__(self, bus_id, interval, route_length, binary=False, base=None):
+        self.bus_id = bus_id
+        self.interval = interval
+        self.binary = binary
+        self.base = base  # e.g. gateway.py, instead of the app that serves the students
+        if base:
+            self.endpoint = "POST /bus/<id>/location [ingest-base]"
+        route = synthetic_route(bus_id, route_length)
+        self.points = [p for a, b in zip(route, route[1:]) for p in interpolate_points(a, b, 10)]
+        self.position = random.randrange(len(self.points))
+
+    def step(self, base, stats, scheduled):
+        """Send one fix due at `scheduled` (monotonic); returns when the next is due"""
+        lat, lon = self.points[self.position]
+        self.position = (self.position + 1) % len(self.points)
+        ok = False
+        backoff = 0.0
+        url = f"{self.base or base}/bus/{self.bus_id}/location"
+        try:
+            if self.binary:
+                response = _http().post(url, data=encode_binary([(time.time(), lat, lon)]), timeout=30,
+                                        headers={"Content-Type": BINARY_MIMETYPE})
+            else:
+                response = _http().post(url, json={"latitude": lat, "longitude": lon}, timeout=30)
+            ok = response.status_code == 200
+            backoff = retry_delay(response)
+        except requests.RequestException:
+            pass
+        # Timed from when the fix was due, so waiting for a worker thread counts too
+        finished = time.monotonic()
+        stats.record(self.endpoint, finished - scheduled, ok, throttled=bool(backoff))
+        # A throttled device waits out the hint instead of its usual interval
+        return max(scheduled + self.interval, finished + backoff)
+
+class VirtualStudent:
+    """Logs in once, then polls the map and station endpoints"""
+    endpoints = ("/api/map/student/bus-location", "/api/student/my-bus/stations")
+
+    def __init__(self, username, interval):
+        self.username = username
+        self.interval = interval
+        self.cookie = None
 
+    def step(self, base, stats, scheduled):
+        """Poll once, due at `scheduled` (monotonic); returns when the next poll is due"""
+        session = _http()
+        if self.cookie is None:
+            ok = False
+            try:
+                response = session.post(f"{base}/api/auth/student/login", timeout=30,
+                                        json={"username": self.username, "password": LOADTEST_PASSWORD})
+                ok = response.status_code == 200
+                self.cookie = response.cookies.get('session') if ok else None
+            except requests.RequestException:
+                pass
+            session.cookies.clear()
+            stats.record("POST /api/auth/student/login", time.monotonic() - scheduled, ok)
+            return scheduled + self.interval
+
+        # The first request is timed from when the poll was due, the next from
+        # when the one before it finished, which is when a client would send it
+        started = scheduled
+        for path in self.endpoints:
+            ok = False
+            try:
+                response = session.get(f"{base}{path}", cookies={'session': self.cookie}, timeout=30)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                pass
+            session.cookies.clear()
+            finished = time.monotonic()
+            stats.record(f"GET {path}", finished - started, ok)
+            started = finished
+        return scheduled + self.interval
+
+def run_load(base, clients, duration, workers):
+    """Run virtual clients from a time-ordered heap on a bounded thread pool.
+
+    Each step is due at a time fixed by the client's schedule, and latency is
+    measured from then rather than from when a thread got to it, so an
+    overloaded server (or harness) shows up in the percentiles instead of
+    quietly lowering the request rate. At most QUEUED_STEPS_PER_WORKER steps
+    per worker wait in the executor; beyond that the scheduler stops handing
+    out work and the late steps carry the wait in their latency.
+    """
+    stats = Stats()
+    start = time.monotonic()
+    deadline = start + duration
+    heap = []
+    for i, client in enumerate(clients):
+        # Spread first requests over one interval to avoid a thundering herd
+        heapq.heappush(heap, (start + random.uniform(0, client.interval), i, client))
+
+    lock = threading.Condition()
+    pending = threading.BoundedSemaphore(workers * (1 + QUEUED_STEPS_PER_WORKER))
+
+    def run(client, index, scheduled):
+        try:
+            due = client.step(base, stats, scheduled)
+        finally:
+            pending.release()
+        with lock:
+            heapq.heappush(heap, (due, index, client))
+            lock.notify()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            with lock:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if not heap or heap[0][0] > now:
+                    lock.wait(min(deadline, heap[0][0] if heap else deadline) - now)
+                    continue
+                scheduled, index, client = heapq.heappop(heap)
+            if not pending.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                break
+            pool.submit(run, client, index, scheduled)
+    return stats.report(time.monotonic() - start)
+
+def hold_connections(base, count):
+    """Open `count` idle keep-alive connections, like devices between fixes"""
+    url = urlsplit(base)
+    address = (url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+    held = []
+    for _ in range(count):
+        try:
+            held.append(socket.create_connection(address, timeout=5))
+        except OSError as e:
+            print(f"Could only open {len(held)} of {count} connections: {e}")
+            break
+    return held
+
+def still_open(connections):
+    """How many held connections the server has not closed"""
+    open_count = 0
+    for connection in connections:
+        connection.setblocking(False)
+        try:
+            open_count += connection.recv(1) != b''
+        except BlockingIOError:
+            open_count += 1
+        except OSError:
+            pass
+        connection.close()
+    return open_count
+
+def print_report(results):
+    print(f"{'endpoint':45} {'reqs':>8} {'errs':>6} {'429s':>6} {'rps':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8}")
+    for endpoint, r in results.items():
+        print(f"{endpoint:45} {r['requests']:>8} {r['errors']:>6} {r['throttled']:>6} {r['throughput_rps']:>8} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bus GPS simulator and load-test harness")
+    sub = parser.add_subparsers(dest="command")
+
+    drive_p = sub.add_parser("drive", help="drive one bus along the real route (default)")
+    drive_p.add_argument("--base", default=API_BASE)
+    drive_p.add_argument("--bus-id", default=BUS_ID)
+    drive_p.add_argument("--interval", type=float, default=3)
+
+    seed_p = sub.add_parser("seed", help="create load-test buses, stations and students in DATABASE_URL")
+    load_p = sub.add_parser("loadtest", help="simulate many buses and polling students")
+    for p in (seed_p, load_p):
+        p.add_argument("--buses", type=int, default=100)
+        p.add_argument("--stations", type=int, default=10, help="stations per synthetic route")
+        p.add_argument("--students", type=int, default=1000)
+    load_p.add_argument("--base", default=LOCAL_BASE)
+    load_p.add_argument("--ingest-base", help="send fixes here instead, e.g. http://127.0.0.1:8001 for gateway.py")
+    load_p.add_argument("--hold-connections", type=int, default=0,
+                        help="idle connections to keep open to the ingest server during the run")
+    load_p.add_argument("--seed", action="store_true", help="seed the local database first")
+    load_p.add_argument("--bus-ids", help="comma-separated bus ids to drive instead of seeding")
+    load_p.add_argument("--fix-interval", type=float, default=3, help="seconds between fixes per bus")
+    load_p.add_argument("--poll-interval", type=float, default=10, help="seconds between polls per student")
+    load_p.add_argument("--duration", type=float, default=60)
+    load_p.add_argument("--workers", type=int, default=64, help="concurrent HTTP worker threads")
+    load_p.add_argument("--binary", action="store_true", help="send fixes in the compact binary format")
+    load_p.add_argument("--json", help="also write the report to this file")
+
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        drive()
+        return
+
+    if args.command == "drive":
+        drive(args.bus_id, args.interval, base=args.base)
+        return
+
+    if args.command == "seed":
+        bus_ids = seed_fleet(args.buses, args.stations, args.students)
+        print(f"Seeded {len(bus_ids)} buses and {args.students} students (password: {LOADTEST_PASSWORD})")
+        print(",".join(str(b) for b in bus_ids))
+        return
+
+    if args.seed:
+        bus_ids = seed_fleet(args.buses, args.stations, args.students)
+    elif args.bus_ids:
+        bus_ids = [int(b) for b in args.bus_ids.split(",")]
+    else:
+        parser.error("loadtest needs --seed or --bus-ids")
+
+    clients = [VirtualBus(bus_id, args.fix_interval, args.stations, args.binary, args.ingest_base)
+               for bus_id in bus_ids[:args.buses]]
+    clients += [VirtualStudent(f"{LOADTEST_STUDENT_PREFIX}{i}", args.poll_interval) for i in range(args.students)]
+    held = hold_connections(args.ingest_base or args.base, args.hold_connections)
+    if held:
+        print(f"Holding {len(held)} idle connections to {args.ingest_base or args.base}")
+    print(f"Running {len(clients)} virtual clients against {args.base} for {args.duration}s...")
+
+    results = run_load(args.base, clients, args.duration, args.workers)
+    print_report(results)
+    if held:
+        print(f"{still_open(held)} of {len(held)} held connections still open")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,12 @@
 // Admin panel JavaScript functionality
 
 // Edit Bus Modal
-function editBus(busId, busNumber, driverName, driverPhone) {
+function editBus(busId, busNumber, driverName, driverPhone, ingestRate, ingestBurst) {
     document.getElementById('edit_bus_number').value = busNumber;
     document.getElementById('edit_driver_name').value = driverName;
     document.getElementById('edit_driver_phone').value = driverPhone;
+    document.getElementById('edit_ingest_rate').value = ingestRate || '';
+    document.getElementById('edit_ingest_burst').value = ingestBurst || '';
     document.getElementById('editBusForm').action = `/admin/buses/${busId}/edit`;
     
     const modal = new bootstrap.Modal(document.getElementById('editBusModal'));
@@ -120,6 +122,25 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 
+// Follow background bus deletions and reload the page once they finish
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('[data-deletion-id]').forEach(progress => {
+        const bar = progress.querySelector('.progress-bar');
+        const timer = setInterval(() => {
+            fetch(`/api/admin/deletions/${progress.dataset.deletionId}`)
+                .then(response => response.json())
+                .then(deletion => {
+                    bar.style.width = `${Math.round(deletion.progress * 100)}%`;
+                    if (deletion.status !== 'running') {
+                        clearInterval(timer);
+                        window.location.reload();
+                    }
+                })
+                .catch(error => console.error('Error checking deletion:', error));
+        }, 2000);
+    });
+});
+
 // Utility function to show loading state
 function showLoading(element) {
     element.classList.add('loading');
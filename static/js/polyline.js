@@ -0,0 +1,38 @@
+// Decoding of the compact route format served by /api/map/*/route* endpoints
+
+// Points [[lat, lon], ...] of a Google encoded polyline
+function decodePolyline(encoded, precision = 5) {
+    const factor = Math.pow(10, precision);
+    const points = [];
+    let index = 0, lat = 0, lon = 0;
+    
+    while (index < encoded.length) {
+        const deltas = [];
+        for (let i = 0; i < 2; i++) {
+            let result = 0, shift = 0, byte;
+            do {
+                byte = encoded.charCodeAt(index++) - 63;
+                result |= (byte & 0x1f) << shift;
+                shift += 5;
+            } while (byte >= 0x20);
+            deltas.push(result & 1 ? ~(result >> 1) : result >> 1);
+        }
+        lat += deltas[0];
+        lon += deltas[1];
+        points.push([lat / factor, lon / factor]);
+    }
+    return points;
+}
+
+// Station objects like the full route-stations response, from a CompactRoute
+function expandCompactRoute(route) {
+    const precision = route.format === 'polyline6' ? 6 : 5;
+    return decodePolyline(route.polyline, precision).map(([latitude, longitude], i) => ({
+        station_id: route.station_ids[i],
+        station_name: route.station_names[i],
+        order: route.order[i],
+        latitude,
+        longitude,
+        is_pickup_station: route.station_ids[i] === route.pickup_station_id
+    }));
+}
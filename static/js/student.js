@@ -1,14 +1,24 @@
 // Student dashboard JavaScript functionality
 
-// Auto-refresh functionality
+// Auto-refresh functionality; the server picks the delay from the bus's
+// motion and distance to the pickup station (data-next-poll-after)
 let refreshInterval;
-const REFRESH_INTERVAL = 30000; // 30 seconds
+const REFRESH_INTERVAL = nextPollAfter() * 1000;
+
+function nextPollAfter() {
+    const updatesDiv = document.getElementById('realtime-updates');
+    const seconds = updatesDiv ? parseInt(updatesDiv.dataset.nextPollAfter, 10) : NaN;
+    return seconds > 0 ? seconds : 30;
+}
 
 // Initialize when DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
     // Start auto-refresh
     startAutoRefresh();
     
+    // Listen for "bus approaching" alerts
+    listenForArrivals();
+    
     // Add click handlers for manual refresh
     const refreshButton = document.querySelector('button[onclick="refreshData()"]');
     if (refreshButton) {
@@ -22,23 +32,83 @@ document.addEventListener('DOMContentLoaded', function() {
     document.addEventListener('visibilitychange', function() {
         if (document.hidden) {
             stopAutoRefresh();
+            stopListeningForArrivals();
         } else {
             startAutoRefresh();
+            listenForArrivals();
             refreshData(); // Refresh immediately when page becomes visible
         }
     });
+
+    // Give the server's event slot back before the page goes away (reloads included)
+    window.addEventListener('pagehide', stopListeningForArrivals);
 });
 
 // Start auto-refresh timer
 function startAutoRefresh() {
-    stopAutoRefresh(); // Clear any existing interval
-    refreshInterval = setInterval(refreshData, REFRESH_INTERVAL);
+    stopAutoRefresh(); // Clear any existing timer
+    refreshInterval = setTimeout(refreshData, REFRESH_INTERVAL);
+}
+
+// Alert when the bus nears the pickup station (see arrivals.py). Uses the
+// bounded long-poll endpoint while the page is visible; the last event id
+// survives the dashboard's own reloads so nothing is shown twice or missed.
+const ARRIVAL_POLL_TIMEOUT = 25;
+const ARRIVAL_RETRY_MS = 5000;
+let arrivalPoll = null;
+
+function listenForArrivals() {
+    if (arrivalPoll || document.hidden || !window.fetch || !window.AbortController) return;
+    const controller = new AbortController();
+    arrivalPoll = controller;
+    pollArrivals(controller);
+}
+
+function stopListeningForArrivals() {
+    if (arrivalPoll) {
+        arrivalPoll.abort();
+        arrivalPoll = null;
+    }
+}
+
+async function pollArrivals(controller) {
+    while (!controller.signal.aborted) {
+        let delay = 0;
+        try {
+            const since = sessionStorage.getItem('lastArrivalEvent');
+            const params = new URLSearchParams({timeout: ARRIVAL_POLL_TIMEOUT});
+            if (since) params.set('since', since);
+            const response = await fetch('/api/student/events/poll?' + params, {signal: controller.signal});
+            if (response.ok) {
+                const events = await response.json();
+                events.forEach(showArrival);
+            } else {
+                const retryAfter = parseInt(response.headers.get('Retry-After'), 10);
+                delay = retryAfter > 0 ? retryAfter * 1000 : ARRIVAL_RETRY_MS;
+            }
+        } catch (error) {
+            if (controller.signal.aborted) return;
+            delay = ARRIVAL_RETRY_MS;
+        }
+        if (delay) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+        }
+    }
+}
+
+function showArrival(arrival) {
+    sessionStorage.setItem('lastArrivalEvent', arrival.id);
+    const updatesDiv = document.getElementById('realtime-updates');
+    if (updatesDiv) {
+        updatesDiv.innerHTML = `<i class="fas fa-bus me-2"></i>Bus ${arrival.bus_number} is approaching ${arrival.station_name}`;
+        updatesDiv.className = 'alert alert-warning';
+    }
 }
 
 // Stop auto-refresh timer
 function stopAutoRefresh() {
     if (refreshInterval) {
-        clearInterval(refreshInterval);
+        clearTimeout(refreshInterval);
         refreshInterval = null;
     }
 }
@@ -218,4 +288,7 @@ function shareLocation() {
 // Cleanup on page unload
 window.addEventListener('beforeunload', function() {
     stopAutoRefresh();
+    if (arrivalSource) {
+        arrivalSource.close();
+    }
 });
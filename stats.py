@@ -0,0 +1,156 @@
+"""Dashboard counters kept as rows change rather than counted on every view.
+
+The routes that add or remove buses, stations, students and notices, the
+bulk importer, background bus deletion and GPS ingest each adjust a counter
+after their commit, so reading the dashboard costs no COUNT(*) over the
+tables. Anything that changes rows some other way (a failed request between
+commit and update, edits from a shell) is corrected by reconciling against
+the database every STATS_RECONCILE_SECONDS, done by whichever reader finds
+it due.
+
+With STATS_FILE set (gunicorn.conf.py does this) the counters live in a
+memory-mapped file shared by all workers; otherwise they are per process.
+Fixes today counts fixes timestamped since midnight UTC, so a late batch
+buffered before midnight does not raise it, and restarts at zero when the day
+changes.
+"""
+import time
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from app import app, db
+from models import Bus, Station, Student, Notice
+from locations import count_fixes
+from shared_slots import MappedFile
+
+COUNTERS = ('buses', 'stations', 'students', 'active_notices', 'fixes_today')
+
+# last reconciliation (unix time), day of fixes_today (UTC ordinal), then the counters
+LAYOUT = struct.Struct('<dq' + 'q' * len(COUNTERS))
+_FIXES = 2 + COUNTERS.index('fixes_today')
+
+logger = logging.getLogger(__name__)
+
+def _today():
+    return datetime.now(timezone.utc).toordinal()
+
+class StatsStore:
+    def __init__(self, path=None):
+        self._file = MappedFile(path, LAYOUT.size) if path else None
+        self._buffer = bytearray(LAYOUT.size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        if self._file is not None:
+            with self._file.locked(0, LAYOUT.size) as data:
+                yield data
+        else:
+            with self._lock:
+                yield self._buffer
+
+    @contextmanager
+    def _record(self):
+        """Lock the counters; yields (values list, write function)"""
+        with self._locked() as data:
+            yield list(LAYOUT.unpack_from(data, 0)), lambda values: LAYOUT.pack_into(data, 0, *values)
+
+    def add(self, name, amount=1):
+        index = 2 + COUNTERS.index(name)
+        today = _today()
+        with self._record() as (values, write):
+            if index == _FIXES and values[1] != today:
+                values[1], values[_FIXES] = today, 0
+            values[index] = max(0, values[index] + amount)
+            write(values)
+
+    def snapshot(self):
+        """(last reconciliation time, {counter: value})"""
+        with self._locked() as data:
+            values = LAYOUT.unpack_from(data, 0)
+        counts = dict(zip(COUNTERS, values[2:]))
+        if values[1] != _today():
+            counts['fixes_today'] = 0
+        return values[0], counts
+
+    def claim_reconcile(self, interval):
+        """True for the one caller that should re-count from the database now"""
+        now = time.time()
+        with self._record() as (values, write):
+            if values[0] + interval > now:
+                return False
+            values[0] = now
+            write(values)
+        return True
+
+    def release_reconcile(self):
+        """Let the next reader retry a reconciliation that failed"""
+        with self._record() as (values, write):
+            values[0] = 0.0
+            write(values)
+
+    def replace(self, counts, day):
+        with self._record() as (values, write):
+            values[1] = day
+            values[2:] = [counts[name] for name in COUNTERS]
+            write(values)
+
+def count_from_database():
+    """Every counter from COUNT queries; returns (counts, day)"""
+    day = _today()
+    midnight = datetime.fromordinal(day)
+    counts = {
+        'buses': db.session.query(db.func.count(Bus.bus_id)).scalar(),
+        'stations': db.session.query(db.func.count(Station.station_id)).scalar(),
+        'students': db.session.query(db.func.count(Student.student_id)).scalar(),
+        'active_notices': db.session.query(db.func.count(Notice.notice_id)).filter(
+            Notice.is_active.is_(True)
+        ).scalar(),
+        'fixes_today': count_fixes(since=midnight),
+    }
+    return counts, day
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = StatsStore(app.config.get('STATS_FILE'))
+    return _store
+
+def reconcile():
+    counts, day = count_from_database()
+    get_store().replace(counts, day)
+
+def count(name, amount=1):
+    """Adjust a counter after a committed change; never fails the caller"""
+    try:
+        get_store().add(name, amount)
+    except Exception:
+        logger.exception("Could not update the %s counter", name)
+
+def fixes_today(rows, stored):
+    """How many of `stored` inserted bus_locations rows count_from_database would count"""
+    midnight = datetime.fromordinal(_today())
+    today = sum(1 for row in rows if row['timestamp'] >= midnight)
+    # The insert does not say which rows were duplicates; take them to be the
+    # older ones and let reconciliation correct the rare miss
+    return min(stored, today)
+
+def get_stats():
+    """Current counters, reconciling first when they are due"""
+    store = get_store()
+    if store.claim_reconcile(app.config['STATS_RECONCILE_SECONDS']):
+        try:
+            reconcile()
+        except Exception:
+            store.release_reconcile()
+            raise
+    reconciled_at, counts = store.snapshot()
+    counts['reconciled_at'] = datetime.utcfromtimestamp(reconciled_at)
+    return counts
@@ -1,6 +1,8 @@
 import math
 from datetime import datetime
-from models import BusLocation, Station
+from models import Station
+from locations import latest_fix
+from cache import get_station
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Calculate distance between two points using Haversine formula"""
@@ -19,16 +21,36 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     
     return R * c
 
+def encode_polyline(points, precision=5):
+    """Encode [(lat, lon), ...] with Google's polyline algorithm.
+
+    Each coordinate becomes the delta from the previous point as an integer
+    in units of 10**-precision degrees, written five bits per character.
+    """
+    factor = 10 ** precision
+    output = []
+    previous_lat = previous_lon = 0
+    for lat, lon in points:
+        lat, lon = round(lat * factor), round(lon * factor)
+        for delta in (lat - previous_lat, lon - previous_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                output.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            output.append(chr(value + 63))
+        previous_lat, previous_lon = lat, lon
+    return ''.join(output)
+
 def calculate_eta(bus_id, target_station_id):
     """Calculate estimated time of arrival to target station"""
     # Get latest bus location
-    latest_location = BusLocation.query.filter_by(bus_id=bus_id).order_by(BusLocation.timestamp.desc()).first()
+    latest_location = latest_fix(bus_id)
     
     if not latest_location:
         return "Location not available"
     
     # Get target station
-    target_station = Station.query.get(target_station_id)
+    target_station = get_station(target_station_id)
     if not target_station:
         return "Station not found"
     
@@ -56,12 +78,12 @@ def calculate_eta(bus_id, target_station_id):
 
 def get_station_status(bus_id, station_id):
     """Determine if station is passed, approaching, or yet to come"""
-    latest_location = BusLocation.query.filter_by(bus_id=bus_id).order_by(BusLocation.timestamp.desc()).first()
+    latest_location = latest_fix(bus_id)
     
     if not latest_location:
         return "unknown"
     
-    station = Station.query.get(station_id)
+    station = get_station(station_id)
     if not station:
         return "unknown"
     